@@ -26,10 +26,117 @@
 #  https://github.com/AnimaApp/sketch-web-viewer
 #
 import os
+import zipfile
+import threading
+from collections import OrderedDict
 from pysketchapp.sketchclasses import *
 from pysketchapp.sketchappreader import SketchAppReader
 from pysketchapp.sketchappwriter import SketchAppWriter
 
+TEMPLATE_CACHE_BYTES = 256 * 1024 * 1024 # Default budget of the template cache.
+# Curve points of the shapes made by SketchApi.rect, SketchApi.oval and their batch versions.
+SHAPE_POINTS = [
+    dict(curveFrom='{0, 0}', curveTo='{0, 0}', point='{0, 0}'),
+    dict(curveFrom='{1, 0}', curveTo='{1, 0}', point='{1, 0}'),
+    dict(curveFrom='{1, 1}', curveTo='{1, 1}', point='{1, 1}'),
+    dict(curveFrom='{0, 1}', curveTo='{1, 1}', point='{0, 1}'),
+]
+
+class SketchTemplateCache:
+    """Process-level LRU cache of SketchTemplate instances, read from the
+    .sketch files by their absolute path, mtime, size and inode. So a changed
+    file is read again. The size of a template is counted as the number of
+    bytes of its uncompressed JSON entries. If the total is more than maxBytes,
+    then the least recently used templates are removed. The templates are
+    read without extracting their images, they are read from the archive
+    when needed. The cache can be used by multiple threads.
+
+    >>> import shutil, tempfile
+    >>> path = shutil.copy('../../Test/TestStar.sketch', tempfile.mkdtemp())
+    >>> cache = SketchTemplateCache()
+    >>> skf1, skf2 = cache.fork(path), cache.fork(path)
+    >>> skf1 is skf2, skf1.template is skf2.template, skf1.path == path
+    (False, True, True)
+    >>> cache.hits, cache.misses, len(cache), cache.size > 0
+    (1, 1, 1, True)
+    >>> SketchAppWriter().write(path, SketchAppReader().read('../../Test/TestOval.sketch', extract=False))
+    >>> cache.fork(path).template is skf1.template, cache.misses, len(cache)
+    (False, 2, 1)
+    >>> cache.fork(shutil.copy('../../Test/TestStar.sketch', tempfile.mkdtemp())).template is skf1.template
+    False
+    >>> len(cache)
+    2
+    >>> cache.maxBytes = 1 # Only room for the last one read.
+    >>> _ = cache.fork(shutil.copy('../../Test/TestOval.sketch', tempfile.mkdtemp()))
+    >>> len(cache), cache.evictions
+    (1, 2)
+    >>> cache.clear()
+    >>> len(cache), cache.size, cache.hits, cache.misses, cache.evictions
+    (0, 0, 0, 0, 0)
+    """
+    def __init__(self, maxBytes=TEMPLATE_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.templates = OrderedDict() # (template, size) by key, least recently used first.
+        self.size = 0 # Total size of the cached templates.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock() # Guards the templates and the counters.
+
+    def __repr__(self):
+        return '<%s n=%d size=%d hits=%d misses=%d>' % (self.__class__.__name__,
+            len(self), self.size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.templates)
+
+    def clear(self):
+        """Remove all templates and reset the counters."""
+        with self._lock:
+            self.templates.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def getTemplate(self, path):
+        """Answers the SketchTemplate of the .sketch file at path, reading
+        it if is not cached or if the file changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = path, stat.st_mtime_ns, stat.st_size, stat.st_ino
+        with self._lock:
+            cached = self.templates.get(key)
+            if cached is not None:
+                self.hits += 1
+                self.templates.move_to_end(key)
+                return cached[0]
+            self.misses += 1
+            for cachedKey in list(self.templates):
+                if cachedKey[0] == path: # Older version of the file.
+                    self._remove(cachedKey)
+            # Read while holding the lock, so threads don't read the same file twice.
+            template = SketchTemplate(SketchAppReader().read(path, extract=False))
+            zf = zipfile.ZipFile(path, mode='r')
+            size = sum(info.file_size for info in zf.infolist() if info.filename.endswith('.json'))
+            zf.close()
+            self.templates[key] = template, size
+            self.size += size
+            while self.size > self.maxBytes and len(self.templates) > 1:
+                self._remove(next(iter(self.templates)))
+                self.evictions += 1
+            return template
+
+    def _remove(self, key):
+        template, size = self.templates.pop(key)
+        self.size -= size
+
+    def fork(self, path):
+        """Answers a new copy-on-write fork of the template at path."""
+        return self.getTemplate(path).fork()
+
+TEMPLATE_CACHE = SketchTemplateCache()
+
 class SketchApi:
     """
     >>> api = SketchApi()
@@ -60,11 +167,39 @@ class SketchApi:
     >>> #e.style['fills']
     """
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, template=None, cache=False):
+        """If template is a SketchTemplate, then self.sketchFile is a
+        copy-on-write fork of it, instead of reading the file at path. This
+        is much faster for making many documents from one template.
+        Otherwise, if cache is True, then self.sketchFile is a fork of the
+        template of path in TEMPLATE_CACHE, that is only read the first time.
+        The images of a cached template are not extracted into the _images/
+        folder next to the file, they are read from the archive when needed.
+        By default the file is read, extracting its images.
+
+        >>> hits = TEMPLATE_CACHE.hits
+        >>> api1, api2 = SketchApi(cache=True), SketchApi(cache=True)
+        >>> TEMPLATE_CACHE.hits > hits, api1.sketchFile.template is api2.sketchFile.template
+        (True, True)
+        >>> SketchApi().sketchFile.template is None
+        True
+
+        >>> template = SketchTemplate(SketchAppReader().read(SketchApi().getTemplatePath()))
+        >>> api1, api2 = SketchApi(template=template), SketchApi(template=template)
+        >>> api1.sketchFile.template is template, api1.sketchFile is api2.sketchFile
+        (True, False)
+        >>> api1.selectPage(0).name = 'Changed'
+        >>> api1.page.name, api2.selectPage(0).name
+        ('Changed', 'Page 1')
+        """
         if path is None:
             path = self.getTemplatePath()
-
-        self.sketchFile = SketchAppReader().read(path)
+        if template is not None:
+            self.sketchFile = template.fork()
+        elif cache:
+            self.sketchFile = TEMPLATE_CACHE.fork(path)
+        else:
+            self.sketchFile = SketchAppReader().read(path)
         self.page = None # Current selected page or artboard
         self.layer = None # Curerent selected layer
         self._fill = None # Current fill color
@@ -96,8 +231,11 @@ class SketchApi:
         style.fills = [self._getFill(**kwargs)]
         return style
 
-    def save(self, path=None):
-        """Saves the current self.skethFile as sketch file.
+    def save(self, path=None, incremental=False):
+        """Saves the current self.skethFile as sketch file. If path is None,
+        the file that was read is overwritten. If incremental is True, then
+        only the pages that changed are serialized, the rest is copied from
+        the file that was read.
 
         >>> if not os.path.exists('_export'):
         ...     os.mkdir('_export')
@@ -109,10 +247,13 @@ class SketchApi:
         >>> api.save('_export/Save.sketch')
         >>> api.sketchFile
         <SketchFile path=Template.sketch>
+        >>> api.save('_export/SaveIncremental.sketch', incremental=True)
+        >>> len(SketchApi('_export/SaveIncremental.sketch').sketchFile.find(name='Rectangle'))
+        1
         """
         if path is None:
-            path = self.path
-        SketchAppWriter().write(path, self.sketchFile)
+            path = self.filePath
+        SketchAppWriter().write(path, self.sketchFile, incremental=incremental)
 
     def newPage(self, w=None, h=None):
         pass
@@ -169,12 +310,16 @@ class SketchApi:
         >>> r = api.rect(x=0, y=0, width=100, height=100)
         >>> api.save('_export/SelectPage.sketch')
         """
-        self.page = page = self.pages[index]
+        page = self.pages[index]
+        if isinstance(page, SketchPageProxy): # Not loaded yet, e.g. in a fork of a template.
+            page = page.page
+        self.page = page
         return page
 
-    def selectLayer(self, _class=None, name=None, pattern=None):
+    def selectLayer(self, _class=None, name=None, pattern=None, selector=None):
         """Selects the layer on the current page, indicated by _class, exact
-        name or matching pattern.
+        name or matching pattern, or the first layer that matches the
+        selector string (see SketchSelector).
 
         >>> api = SketchApi()
         >>> page = api.selectPage(0)
@@ -183,22 +328,43 @@ class SketchApi:
         >>> artboard = api.selectLayer(pattern='board')
         >>> artboard
         <SketchArtboard name=Artboard 1 w=576 h=783>
+        >>> r = api.rect(100, 110, 200, 210)
+        >>> api.selectLayer(selector='artboard > *:last-child[frame.x=100]') is r
+        True
         """
         if self.page is None:
             self.page = self.selectPage(0)
 
         if self.page is not None:
-            layers = self.page.find(_class=_class, name=name, pattern=pattern)
-            if layers:
-                self.layer = layers[0] # Select the first that matches.
+            if selector is not None:
+                layer = next(self.page.iterSelect(selector), None)
+                if layer is not None:
+                    self.layer = layer
+            else:
+                layers = self.page.find(_class=_class, name=name, pattern=pattern)
+                if layers:
+                    self.layer = layers[0] # Select the first that matches.
         return self.layer
 
     def getSize(self):
+        """Answers the (w, h) of the document: the largest size of the bounding
+        box of the layers on a page, using the cached absolute geometry, so
+        positions, rotations and flips are included.
+
+        >>> api = SketchApi()
+        >>> api.getSize()
+        (576.0, 783.0)
+        >>> artboard = api.selectLayer(name='Artboard 1')
+        >>> artboard.rotation = 90
+        >>> [round(v) for v in api.getSize()]
+        [783, 576]
+        """
         w = h = 0
         for page in self.getPages():
-            for artboard in page.layers:
-                w = max(w, artboard.frame.width - artboard.frame.x)
-                h = max(h, artboard.frame.height - artboard.frame.y)
+            bounds = page.getGeometry().getUnionBounds(page.layers)
+            if bounds is not None:
+                w = max(w, bounds[2])
+                h = max(h, bounds[3])
         return w, h
 
     def getPages(self):
@@ -231,20 +397,35 @@ class SketchApi:
         >>> api = SketchApi()
         >>> len(api.getIdLayers())
         1
+        >>> page = api.selectPage(0)
+        >>> artboard = api.selectLayer(name='Artboard 1')
+        >>> r = api.rect(100, 110, 200, 210)
+        >>> len(api.getIdLayers())
+        3
+        >>> api.getIdLayers()[r.do_objectID] is r
+        True
         """
         idLayers = {}
-        for page in self.pages:
-            self._getIdLayers(page, idLayers)
+        self.sketchFile.readPages() # Pages that are read are added to the index.
+        index = self.sketchFile.index # Kept up to date by SketchLayer.append
+        for layerId, layer in index.ids.items():
+            if index.parents[layerId] is not None: # Skip the pages
+                idLayers[layerId] = layer
         return idLayers
 
     def _getIdLayers(self, parentLayer, idLayers):
-        """Recursively runs though all layers, answer the dictionary of
+        """Runs though all layers inside parentLayer, answer the dictionary of
         {layer.do_objectID: layer, ...}
+
+        >>> api = SketchApi()
+        >>> artboard = api.selectLayer(name='Artboard 1')
+        >>> r = api.rect(100, 110, 200, 210)
+        >>> api._getIdLayers(api.page, {}) == api.getIdLayers()
+        True
         """
-        for layer in parentLayer.layers:
-            idLayers[layer.do_objectID] = layer
-            if hasattr(layer, 'layers'):
-                self._getIdLayers(layer, idLayers)
+        for depth, parent, layer in parentLayer.walk():
+            if depth:
+                idLayers[layer.do_objectID] = layer
         return idLayers
 
     def frameDuration(self, v):
@@ -307,7 +488,7 @@ class SketchApi:
             h = DEFAULT_HEIGHT
 
         style = self._getStyle(**kwargs)
-        frame = dict(_class='rect', x=x, y=x, width=w, height=h)
+        frame = dict(_class='rect', x=x, y=y, width=w, height=h)
         name = name or DEFAULT_NAME
         g = SketchShapeGroup(do_objectID=newObjectID(), style=style, frame=frame,
             name=name, **kwargs)
@@ -321,7 +502,7 @@ class SketchApi:
             SketchCurvePoint(parent=r, curveFrom='{1, 1}', curveTo='{1, 1}', point='{1, 1}'),
             SketchCurvePoint(parent=r, curveFrom='{0, 1}', curveTo='{1, 1}', point='{0, 1}'),
         ]
-        g.layers.append(r)
+        g.append(r)
         return g
 
     def rect(self, x=None, y=None, w=None, h=None, name=None, **kwargs):
@@ -349,7 +530,7 @@ class SketchApi:
             h = DEFAULT_HEIGHT
 
         style = self._getStyle(**kwargs)
-        frame = dict(_class='rect', x=x, y=x, width=w, height=h)
+        frame = dict(_class='rect', x=x, y=y, width=w, height=h)
         name = name or DEFAULT_NAME
         g = SketchShapeGroup(do_objectID=newObjectID(), style=style, frame=frame,
             name=name, **kwargs)
@@ -362,9 +543,114 @@ class SketchApi:
             SketchCurvePoint(parent=r, curveFrom='{1, 1}', curveTo='{1, 1}', point='{1, 1}'),
             SketchCurvePoint(parent=r, curveFrom='{0, 1}', curveTo='{1, 1}', point='{0, 1}'),
         ]
-        g.layers.append(r)
+        g.append(r)
         return g
 
+    def rects(self, xs, ys, ws, hs, fills=None, name=None, **kwargs):
+        """Draws a rectangle for each index in the columns xs, ys, ws and hs,
+        in the same way as self.rect, but much faster for many rectangles.
+        The columns are sequences or NumPy arrays of the same length. The ws
+        and hs can also be one number for all. The fills is None for the
+        current fill, one color (r, g, b[, a]) for all or a column of colors.
+        The rectangles with the same fill share one SketchStyle. It is not
+        shared as a plain instance: a style is a node with a parent link to
+        its layer, through which changing it marks that layer as changed for
+        incremental saving. Instead it is a shared style, so reading it as
+        group.style answers a private copy first (copy-on-write, see
+        SketchSharedAttr), which can be changed. The curve points are
+        packed (see SketchPackedCurvePoints). Answers the list of new shape
+        groups.
+
+        >>> api = SketchApi()
+        >>> artboard = api.selectLayer(name='Artboard 1')
+        >>> groups = api.rects([0, 10, 20], [5, 15, 25], 100, [10, 20, 30], fills=[(1, 0, 0), (0, 0, 1), (1, 0, 0)])
+        >>> len(artboard.layers), groups[1].frame, groups[1].layers[0].frame
+        (3, <SketchRect x=10 y=15 w=100 h=20>, <SketchRect x=0 y=0 w=100 h=20>)
+        >>> groups[0].getValue('style') is groups[2].getValue('style'), groups[0].getValue('style') is groups[1].getValue('style')
+        (True, False)
+        >>> groups[1].style.fills, groups[2].style.parent is groups[2], groups[0].getValue('style').isShared
+        ([<SketchColor red=0 green=0 blue=1 alpha=0>], True, True)
+        >>> rect = api.rect(10, 15, 100, 20, fill=(0, 0, 1))
+        >>> groups[1].layers[0].asJson()['points'] == rect.layers[0].asJson()['points']
+        True
+        >>> api.rects([], [], 1, 1, fills=[]), len(artboard.layers)
+        ([], 4)
+        >>> api.rects([0, 10], [5, 15], 100, 10, fills=[])
+        Traceback (most recent call last):
+        ...
+        ValueError: 0 fills for 2 shapes
+        >>> api.rects([0, 10], [5, 15, 25], 100, 10)
+        Traceback (most recent call last):
+        ...
+        ValueError: Column of 3 values for 2 shapes
+        """
+        return self._drawShapes(SketchRectangle, xs, ys, ws, hs, fills, name, kwargs)
+
+    def ovals(self, xs, ys, ws, hs, fills=None, name=None, **kwargs):
+        """Draws an oval for each index in the columns xs, ys, ws and hs, in
+        the same way as self.oval. See self.rects for the arguments.
+
+        >>> api = SketchApi()
+        >>> artboard = api.selectLayer(name='Artboard 1')
+        >>> groups = api.ovals([0, 10], [5, 15], [10, 20], [10, 20], fills=(0, 1, 0, 0.5))
+        >>> groups[1].layers, groups[0].getValue('style') is groups[1].getValue('style'), groups[1].style.fills
+        ([<SketchOval name=Path>], True, [<SketchColor red=0 green=1 blue=0 alpha=0.5>])
+        """
+        return self._drawShapes(SketchOval, xs, ys, ws, hs, fills, name, kwargs)
+
+    def _getColumn(self, values, count):
+        """Answers values as a list of count numbers. The values is a sequence,
+        a NumPy array or one number for all."""
+        if hasattr(values, 'tolist'): # NumPy array or number
+            values = values.tolist()
+        if isinstance(values, (int, float)):
+            return [values] * count
+        if len(values) != count:
+            raise ValueError('Column of %d values for %d shapes' % (len(values), count))
+        return values
+
+    def _drawShapes(self, shapeClass, xs, ys, ws, hs, fills, name, kwargs):
+        """Draws a shape group with a shape of shapeClass for each index in the
+        columns. See self.rects."""
+        assert self.layer is not None
+        count = len(xs)
+        if count == 0:
+            return []
+        xs = self._getColumn(xs, count)
+        ys = self._getColumn(ys, count)
+        ws = self._getColumn(ws, count)
+        hs = self._getColumn(hs, count)
+        if hasattr(fills, 'tolist'):
+            fills = fills.tolist()
+        if fills is None or (fills and isinstance(fills[0], (int, float))): # One fill for all.
+            fills = [fills] * count
+        if len(fills) != count:
+            raise ValueError('%d fills for %d shapes' % (len(fills), count))
+
+        points = SketchPackedCurvePoints(SHAPE_POINTS)
+        name = name or DEFAULT_NAME
+        groups = []
+        styles = {} # Shared style for each distinct fill, see self.rects.
+        for x, y, w, h, fill in zip(xs, ys, ws, hs, fills):
+            key = fill if fill is None else tuple(fill)
+            style = styles.get(key)
+            if style is None:
+                if fill is None: # Current fill
+                    style = self._getStyle()
+                else:
+                    style = self._getStyle(fill=fill)
+                style._shared = True
+                styles[key] = style
+            g = SketchShapeGroup(do_objectID=newObjectID(), style=style,
+                frame=SketchRect(x=x, y=y, width=w, height=h), name=name, **kwargs)
+            shape = shapeClass(frame=SketchRect(x=0, y=0, width=w, height=h),
+                do_objectID=newObjectID(), name='Path')
+            shape.points = points.copy()
+            g.append(shape)
+            groups.append(g)
+        self.layer.extend(groups)
+        return groups
+
     def fill(self, r, g=None, b=None, a=None):
         # Covering API inconsistencies in DrawBot
         if g is not None or b is not None:
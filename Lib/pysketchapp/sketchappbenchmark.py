@@ -0,0 +1,728 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#  Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#  www.pagebot.io
+#  Licensed under MIT conditions
+#
+# -----------------------------------------------------------------------------
+#
+#  sketchappbenchmark.py
+#
+#  Timing of reading and writing Sketch files, comparing the optimized
+#  code with the plain implementation it replaces.
+#  Run as script to show the results for the files in Test/
+#
+#  python3 sketchappbenchmark.py
+#
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pysketchapp.sketchclasses import *
+from pysketchapp.sketchappreader import SketchAppReader
+from pysketchapp.sketchappwriter import SketchAppWriter
+from pysketchapp.sketchappcompare import sketchCompare, iterDiffs, iterArchiveDiffs
+from pysketchapp.sketchapi import SketchApi, TEMPLATE_CACHE
+
+TEST_PATH = os.path.dirname(os.path.abspath(__file__)) + '/../../Test/'
+BENCHMARK_FILES = ('TestUI.sketch', 'Re-Cover.sketch')
+
+def timeIt(f, repeat=10):
+  """Answers the best time in seconds of repeat calls of f().
+
+  >>> timeIt(lambda: None, 3) < 1
+  True
+  """
+  best = None
+  for n in range(repeat):
+    t = time.perf_counter()
+    f()
+    t = time.perf_counter() - t
+    if best is None or t < best:
+      best = t
+  return best
+
+def readPageDicts(path):
+  """Answers the list of parsed JSON dictionaries of all pages in path.
+
+  >>> len(readPageDicts(TEST_PATH + 'Re-Cover.sketch'))
+  3
+  """
+  pageDicts = []
+  zf = zipfile.ZipFile(path, mode='r')
+  for key in zf.namelist():
+    if key.startswith(PAGES_JSON):
+      pageDicts.append(json.loads(zf.read(key).decode('utf-8')))
+  zf.close()
+  return pageDicts
+
+def interpretedDecode(self, kwargs):
+  """The plain implementation of SketchBase.setAttributes, before the
+  compiled decoders. Interprets self.ATTRS for every instance."""
+  for name, value in kwargs.items():
+    if name not in self.ATTRS:
+      try:
+        setattr(self, name, value)
+      except AttributeError:
+        self._setExtra(name, value)
+
+  for name, (m, value) in self.ATTRS.items():
+    jsonName = JSON_ATTR_NAMES.get(name, name)
+    if name in kwargs:
+      value = kwargs[name]
+    elif jsonName in kwargs:
+      value = kwargs[jsonName]
+    if isclass(m):
+      if isinstance(value, m):
+        pass
+      elif value is None:
+        value = m()
+      elif not isinstance(value, dict):
+        value = {name: value}
+      else:
+        value = m(**value)
+    elif isfunction(m):
+      value = m(value)
+    setattr(self, name, value)
+
+def buildPages(pageDicts):
+  return [SketchPage(**pageDict) for pageDict in pageDicts]
+
+def benchmarkDecode(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (fileName, interpretedTime, compiledTime) for building
+  the SketchPage trees of the files from their parsed JSON.
+
+  >>> result = benchmarkDecode(repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  >>> SketchPoint.getDecoder() is interpretedDecode
+  False
+  """
+  result = []
+  for fileName in fileNames:
+    pageDicts = readPageDicts(TEST_PATH + fileName)
+    getDecoder = SketchBase.__dict__['getDecoder']
+    SketchBase.getDecoder = classmethod(lambda cls: interpretedDecode)
+    try:
+      interpretedTime = timeIt(lambda: buildPages(pageDicts), repeat)
+    finally:
+      SketchBase.getDecoder = getDecoder
+    compiledTime = timeIt(lambda: buildPages(pageDicts), repeat)
+    result.append((fileName, interpretedTime, compiledTime))
+  return result
+
+def iterNodes(d):
+  """Yields all SketchBase instances in the tree of d, following the slot
+  attributes and layers.
+
+  >>> rect = SketchRect()
+  >>> any(node is rect for node in iterNodes(SketchArtboard(frame=rect)))
+  True
+  """
+  if isinstance(d, SketchBase):
+    yield d
+    for name in d.SLOTS:
+      if name != '_parent':
+        for node in iterNodes(d.getValue(name)):
+          yield node
+  elif isinstance(d, (list, tuple)):
+    for dd in d:
+      for node in iterNodes(dd):
+        yield node
+  elif isinstance(d, dict):
+    for dd in d.values():
+      for node in iterNodes(dd):
+        yield node
+
+_DICT_CLASSES = {} # Plain classes with a __dict__, as SketchBase classes were before __slots__.
+
+def _nodeAttributes(node):
+  attributes = []
+  for name in node.SLOTS:
+    value = node.getValue(name, NO_VALUE)
+    if value is not NO_VALUE:
+      attributes.append((name, value))
+  return attributes + list(getattr(node, '__dict__', {}).items())
+
+def slotsNode(node, attributes):
+  shell = object.__new__(node.__class__)
+  for name, value in attributes:
+    object.__setattr__(shell, name, value) # Without marking the copy as dirty.
+  return shell
+
+def dictNode(node, attributes):
+  cls = _DICT_CLASSES.get(node.__class__)
+  if cls is None:
+    cls = _DICT_CLASSES[node.__class__] = type(node.__class__.__name__, (), {})
+  shell = cls()
+  for name, value in attributes:
+    setattr(shell, name, value)
+  return shell
+
+def nodeBytes(nodes, makeNode):
+  """Answers the number of bytes that are allocated to make a copy of all nodes
+  by makeNode(node, attributes). The attribute values themselves are shared with
+  the original nodes, so only the size of the node objects is measured."""
+  attributes = [_nodeAttributes(node) for node in nodes]
+  copies = [None] * len(nodes)
+  tracemalloc.start()
+  size = tracemalloc.get_traced_memory()[0]
+  for index, node in enumerate(nodes):
+    copies[index] = makeNode(node, attributes[index])
+  size = tracemalloc.get_traced_memory()[0] - size
+  tracemalloc.stop()
+  return size
+
+def benchmarkMemory(fileNames=BENCHMARK_FILES):
+  """Answers a list of (fileName, dictBytes, slotsBytes) with the average
+  number of bytes of node objects per layer in the files, for nodes that
+  store their attributes in a __dict__ and nodes that use __slots__.
+
+  >>> result = benchmarkMemory()
+  >>> [fileName for fileName, b1, b2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  >>> [b1 > b2 for fileName, b1, b2 in result]
+  [True, True]
+  """
+  result = []
+  for fileName in fileNames:
+    pages = buildPages(readPageDicts(TEST_PATH + fileName))
+    nodes = list(iterNodes(pages))
+    layerCount = 0
+    for page in pages:
+      layerCount += len(page.find(pattern=''))
+    dictBytes = nodeBytes(nodes, dictNode)
+    slotsBytes = nodeBytes(nodes, slotsNode)
+    result.append((fileName, dictBytes/layerCount, slotsBytes/layerCount))
+  return result
+
+def regexPositionString(v):
+  """The plain implementation of SketchPositionString, before the fast parser.
+  The fast parsers answer the same numbers for all position strings of the
+  benchmark files.
+
+  >>> positionStrings = []
+  >>> for fileName in BENCHMARK_FILES:
+  ...   for pageDict in readPageDicts(TEST_PATH + fileName):
+  ...     positionStrings = findPositionStrings(pageDict, positionStrings)
+  >>> len(positionStrings) > 1000
+  True
+  >>> regexPoints = [regexPositionString(v) for v in positionStrings]
+  >>> [(p.x, p.y) for p in regexPoints] == [parsePositionString(v) for v in positionStrings]
+  True
+  >>> regexPoints == [SketchPositionString(v) for v in positionStrings]
+  True
+  >>> parsePositionStrings(positionStrings).tolist() == [float(n) for p in regexPoints for n in (p.x, p.y)]
+  True
+  """
+  sxy = POINT_PATTERN.findall(v)
+  assert len(sxy) == 1 and len(sxy[0]) == 2, (sxy, v)
+  return SketchPoint(x=asNumber(sxy[0][0]), y=asNumber(sxy[0][1]))
+
+def benchmarkPositionStrings(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (name, oldTime, newTime) for parsing all position
+  strings of the files: by regular expression against the fast parser for
+  SketchPoint instances, and each string by the regular expression against
+  the batch parser into packed coordinates. See regexPositionString for the
+  test that both parse the same numbers.
+
+  >>> result = benchmarkPositionStrings(repeat=1)
+  >>> [name for name, t1, t2 in result]
+  ['SketchPositionString', 'parsePositionStrings']
+  >>> all(isinstance(t, float) and t > 0 for name, t1, t2 in result for t in (t1, t2))
+  True
+  """
+  positionStrings = []
+  for fileName in fileNames:
+    for pageDict in readPageDicts(TEST_PATH + fileName):
+      findPositionStrings(pageDict, positionStrings)
+  def regexParse():
+    for v in positionStrings:
+      regexPositionString(v)
+  def fastParse():
+    for v in positionStrings:
+      SketchPositionString(v)
+  def regexBatch():
+    values = array('d')
+    for v in positionStrings:
+      sxy = POINT_PATTERN.findall(v)
+      values.extend((asNumber(sxy[0][0]), asNumber(sxy[0][1])))
+  return [
+    ('SketchPositionString', timeIt(regexParse, repeat), timeIt(fastParse, repeat)),
+    ('parsePositionStrings', timeIt(regexBatch, repeat),
+      timeIt(lambda: parsePositionStrings(positionStrings), repeat)),
+  ]
+
+def countLayers(skf):
+  """Reduce function for SketchAppReader.readMany, answering the number of
+  layers in skf, including the pages.
+
+  >>> countLayers(SketchAppReader().read(TEST_PATH + 'TestStar.sketch'))
+  3
+  """
+  return len(skf.find(pattern=''))
+
+def benchmarkReadMany(copies=4, workers=None, repeat=1):
+  """Answers a list of (name, serialTime, parallelTime) for reading all files
+  in Test/, duplicated copies times in a temporary directory: one by one, and
+  by SketchAppReader.readMany with a pool of workers processes. Reading the
+  files in parallel only is faster on machines with multiple CPU's.
+
+  >>> result = benchmarkReadMany(copies=1, workers=2)
+  >>> [name for name, t1, t2 in result]
+  ['readMany']
+  """
+  reader = SketchAppReader()
+  tmpPath = tempfile.mkdtemp()
+  try:
+    paths = []
+    for fileName in sorted(os.listdir(TEST_PATH)):
+      if fileName.endswith('.' + FILETYPE_SKETCH):
+        for n in range(copies):
+          path = '%s/%d-%s' % (tmpPath, n, fileName)
+          shutil.copyfile(TEST_PATH + fileName, path)
+          paths.append(path)
+    def readSerial():
+      for path in paths:
+        countLayers(reader.read(path))
+    def readParallel():
+      for path, layerCount, error in reader.readMany(paths, workers, countLayers):
+        assert error is None, error
+    return [('readMany', timeIt(readSerial, repeat), timeIt(readParallel, repeat))]
+  finally:
+    shutil.rmtree(tmpPath)
+
+class NullFile:
+  """File that ignores what is written, to measure encoding without storage."""
+  def write(self, data):
+    return len(data)
+
+def benchmarkEncode(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (fileName, dictTime, streamTime) for encoding all pages
+  of the files as JSON bytes: by json.dumps(page.asJson()) and by the encoder
+  of page.asJsonBytes().
+
+  >>> result = benchmarkEncode(repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  """
+  result = []
+  for fileName in fileNames:
+    pages = buildPages(readPageDicts(TEST_PATH + fileName))
+    def encodeDicts():
+      for page in pages:
+        json.dumps(page.asJson()).encode('utf-8')
+    def encodeStream():
+      for page in pages:
+        page.asJsonBytes()
+    result.append((fileName, timeIt(encodeDicts, repeat), timeIt(encodeStream, repeat)))
+  return result
+
+def peakBytes(f):
+  """Answers the peak number of bytes allocated while calling f()."""
+  tracemalloc.start()
+  f()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return peak
+
+def benchmarkEncodeMemory(fileNames=BENCHMARK_FILES):
+  """Answers a list of (fileName, dictBytes, streamBytes) with the peak memory
+  of writing the JSON of the largest page of the files into a file: by
+  json.dump(page.asJson(), f) and by page.writeJson(f). The stream only
+  keeps the JSON of the last layers, so it uses less memory on larger pages.
+
+  >>> result = benchmarkEncodeMemory()
+  >>> fileName, dictBytes, streamBytes = result[-1]
+  >>> fileName, dictBytes > 2 * streamBytes
+  ('Re-Cover.sketch', True)
+  """
+  result = []
+  for fileName in fileNames:
+    pages = buildPages(readPageDicts(TEST_PATH + fileName))
+    page = max(pages, key=lambda page: len(page.find(pattern='')))
+    page.asJsonBytes() # Compile the encoders before measuring.
+    dictBytes = peakBytes(lambda: json.dump(page.asJson(), NullFile()))
+    streamBytes = peakBytes(lambda: page.writeJson(NullFile()))
+    result.append((fileName, dictBytes, streamBytes))
+  return result
+
+def readJsonEntries(path):
+  """Answers the list of raw bytes of all JSON entries in path.
+
+  >>> len(readJsonEntries(TEST_PATH + 'Re-Cover.sketch'))
+  6
+  """
+  zf = zipfile.ZipFile(path, mode='r')
+  entries = [zf.read(key) for key in zf.namelist() if key.endswith('.json')]
+  zf.close()
+  return entries
+
+def benchmarkJsonBackends(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (label, jsonTime, backendTime) for parsing all JSON
+  entries of the files and for dumping the parsed dictionaries, by the
+  standard json module and by each other installed JSON backend.
+
+  >>> result = benchmarkJsonBackends(repeat=1)
+  >>> len(result) == 2 * (len(getJsonBackends()) - 1)
+  True
+  """
+  entries = []
+  for fileName in fileNames:
+    entries += readJsonEntries(TEST_PATH + fileName)
+  default = getJsonBackend('json')
+  dicts = [default.loads(data) for data in entries]
+  result = []
+  for name in getJsonBackends():
+    if name == default.NAME:
+      continue
+    backend = getJsonBackend(name)
+    for label, f, args in (('loads', 'loads', entries), ('dumps', 'dumps', dicts)):
+      t1 = timeIt(lambda: [getattr(default, f)(arg) for arg in args], repeat)
+      t2 = timeIt(lambda: [getattr(backend, f)(arg) for arg in args], repeat)
+      result.append(('%s %s' % (name, label), t1, t2))
+  return result
+
+def clearHashes(layer):
+  """Clear the cached hashes of layer and all layers in it."""
+  layer._hashes = None
+  for child in layer.layers:
+    if isinstance(child, SketchLayer):
+      clearHashes(child)
+
+def benchmarkCompare(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (fileName, coldTime, changedTime) for comparing the
+  pages of two readings of the file: first with empty hash caches, so all
+  layers are hashed, then after changing the name of the deepest last layer,
+  so only the layers on its path are hashed and compared again.
+
+  >>> result = benchmarkCompare(repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  """
+  reader = SketchAppReader()
+  result = []
+  for fileName in fileNames:
+    pages1 = list(reader.read(TEST_PATH + fileName).pages.values())
+    pages2 = list(reader.read(TEST_PATH + fileName).pages.values())
+    layer = pages2[-1]
+    while getattr(layer, 'layers', None):
+      layer = layer.layers[-1]
+    def compareCold():
+      for page in pages1 + pages2:
+        clearHashes(page)
+      assert not sketchCompare(pages1, pages2)
+    def compareChanged():
+      layer.name += 'x'
+      assert sketchCompare(pages1, pages2)
+      layer.name = layer.name[:-1]
+    result.append((fileName, timeIt(compareCold, repeat), timeIt(compareChanged, repeat)))
+  return result
+
+def benchmarkArchiveCompare(fileNames=BENCHMARK_FILES, repeat=5):
+  """Answers a list of (fileName, readTime, archiveTime) for comparing the
+  file with a copy in which the first layer of the smallest page is renamed:
+  by reading both files completely, and by iterArchiveDiffs, which only
+  parses the page that differs.
+
+  >>> result = benchmarkArchiveCompare(repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  """
+  reader = SketchAppReader()
+  result = []
+  tmpPath = tempfile.mkdtemp()
+  try:
+    for fileName in fileNames:
+      path1 = TEST_PATH + fileName
+      path2 = shutil.copy(path1, tmpPath)
+      skf = reader.read(path2, extract=False)
+      page = min(skf.pages.values(), key=countLayers)
+      page.layers[0].name += 'x'
+      SketchAppWriter().write(path2, skf, incremental=True)
+      def compareRead():
+        assert list(iterDiffs(reader.read(path1, extract=False), reader.read(path2, extract=False)))
+      def compareArchive():
+        assert list(iterArchiveDiffs(path1, path2))
+      result.append((fileName, timeIt(compareRead, repeat), timeIt(compareArchive, repeat)))
+  finally:
+    shutil.rmtree(tmpPath)
+  return result
+
+def benchmarkSelect(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (fileName, findTime, selectTime) for selecting the
+  texts in artboards that are not hidden: by chained find calls per
+  artboard, and by the compiled selector "artboard text:visible".
+
+  >>> result = benchmarkSelect(repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  """
+  reader = SketchAppReader()
+  result = []
+  for fileName in fileNames:
+    skf = reader.read(TEST_PATH + fileName, extract=False)
+    def selectFind():
+      found = []
+      for artboard in skf.find(_class='artboard'):
+        for text in artboard.find(_class='text'):
+          if text.isVisible and text not in found:
+            found.append(text)
+      return found
+    def selectCompiled():
+      return skf.select('artboard text:visible')
+    assert selectFind() == selectCompiled()
+    result.append((fileName, timeIt(selectFind, repeat), timeIt(selectCompiled, repeat)))
+  return result
+
+def benchmarkOverlaps(counts=(500, 2000), repeat=3):
+  """Answers a list of (name, pairwiseTime, indexTime) for finding the
+  overlapping rectangles of an artboard with count random rectangles: by
+  comparing all pairs, and by building a SketchSpatialIndex and its sweep in
+  overlaps().
+
+  >>> result = benchmarkOverlaps(counts=(50,), repeat=1)
+  >>> [name for name, t1, t2 in result]
+  ['50 layers']
+  """
+  result = []
+  rnd = random.Random(1)
+  for count in counts:
+    artboard = SketchArtboard(frame=SketchRect(width=5000, height=5000))
+    for n in range(count):
+      artboard.append(SketchRectangle(frame=SketchRect(x=rnd.uniform(0, 4900), y=rnd.uniform(0, 4900),
+        width=rnd.uniform(1, 100), height=rnd.uniform(1, 100))))
+    layers = artboard.layers
+    def overlapsPairwise():
+      pairs = []
+      for i, l1 in enumerate(layers):
+        f1 = l1.frame
+        for l2 in layers[i+1:]:
+          f2 = l2.frame
+          if f1.x < f2.x + f2.width and f2.x < f1.x + f1.width and \
+             f1.y < f2.y + f2.height and f2.y < f1.y + f1.height:
+            pairs.append((l1, l2))
+      return pairs
+    def overlapsIndex():
+      return SketchSpatialIndex(artboard).overlaps(siblings=True)
+    assert [(id(l1), id(l2)) for l1, l2 in overlapsPairwise()] == \
+      [(id(l1), id(l2)) for l1, l2 in overlapsIndex()]
+    result.append(('%d layers' % count, timeIt(overlapsPairwise, repeat), timeIt(overlapsIndex, repeat)))
+  return result
+
+def buildNestedPage(count=2000, depth=6):
+  """Answers a page with an artboard holding count rectangles in groups that
+  are nested depth levels deep, rotated by 10 degrees each.
+
+  >>> len(list(buildNestedPage(count=10, depth=2).walk()))
+  14
+  """
+  page = SketchPage()
+  artboard = SketchArtboard(frame=SketchRect(width=5000, height=5000))
+  page.append(artboard)
+  parent = artboard
+  groups = []
+  for n in range(depth):
+    group = SketchGroup(frame=SketchRect(x=10, y=10, width=4000, height=4000), rotation=10)
+    parent.append(group)
+    groups.append(group)
+    parent = group
+  for n in range(count):
+    groups[n % depth].append(SketchRectangle(frame=SketchRect(x=n % 400, y=n // 400, width=10, height=10)))
+  return page
+
+def benchmarkGeometry(fileNames=BENCHMARK_FILES, repeat=20):
+  """Answers a list of (name, perLayerTime, geometryTime) for computing the
+  absolute transforms of all layers: by composing the transforms through
+  the parents of each layer, and by one SketchGeometry per page.
+
+  >>> result = benchmarkGeometry(repeat=1)
+  >>> [name for name, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch', 'Nested 2000 layers']
+  """
+  result = []
+  samples = [(fileName, buildPages(readPageDicts(TEST_PATH + fileName))) for fileName in fileNames]
+  samples.append(('Nested 2000 layers', [buildNestedPage()]))
+  for name, pages in samples:
+    def boundsPerLayer():
+      for page in pages:
+        for depth, parent, layer in page.walk():
+          getAbsoluteTransform(layer)
+    def boundsGeometry():
+      for page in pages:
+        SketchGeometry(page)
+    result.append((name, timeIt(boundsPerLayer, repeat), timeIt(boundsGeometry, repeat)))
+  return result
+
+def readLibraryLayers(path):
+  """Answers the list of layer dictionaries of the symbol masters that are
+  used from libraries in the document of path.
+
+  >>> len(readLibraryLayers(TEST_PATH + 'TestUI.sketch'))
+  13
+  """
+  zf = zipfile.ZipFile(path, mode='r')
+  document = json.loads(zf.read(DOCUMENT_JSON).decode('utf-8'))
+  zf.close()
+  layers = []
+  for foreignSymbol in document.get('foreignSymbols', []):
+    layers += foreignSymbol['symbolMaster'].get('layers', [])
+  return layers
+
+def benchmarkSharedStyles(fileName='TestUI.sketch', copies=50):
+  """Answers a list of (name, unsharedValue, sharedValue) with the number of
+  style objects (SketchSharedBase instances) and the number of bytes that
+  are allocated to decode the layers of the library symbols of the file copies
+  times, without and with sharing them in a SketchSharedStyles table.
+
+  >>> result = benchmarkSharedStyles(copies=2)
+  >>> [name for name, n1, n2 in result]
+  ['Style objects', 'Bytes']
+  >>> [n1 > n2 for name, n1, n2 in result]
+  [True, True]
+  """
+  layers = readLibraryLayers(TEST_PATH + fileName)
+  counts = []
+  sizes = []
+  for sharedStyles in (None, SketchSharedStyles()):
+    tracemalloc.start()
+    size = tracemalloc.get_traced_memory()[0]
+    with useSharedStyles(sharedStyles):
+      pages = [SketchPage(layers=layers) for n in range(copies)]
+    sizes.append(tracemalloc.get_traced_memory()[0] - size)
+    tracemalloc.stop()
+    styleIds = set()
+    for node in iterNodes(pages):
+      if isinstance(node, SketchSharedBase):
+        styleIds.add(id(node))
+    counts.append(len(styleIds))
+    del pages
+  return [('Style objects', counts[0], counts[1]), ('Bytes', sizes[0], sizes[1])]
+
+def benchmarkFork(fileNames=BENCHMARK_FILES, copies=20, repeat=3):
+  """Answers a list of (fileName, readTime, forkTime) for making copies
+  variants of the file, each with one changed layer name, and saving them
+  into memory: by reading the file for each variant, and by forking a
+  SketchTemplate that is read once.
+
+  >>> result = benchmarkFork(copies=2, repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['TestUI.sketch', 'Re-Cover.sketch']
+  """
+  reader = SketchAppReader()
+  writer = SketchAppWriter()
+  result = []
+  for fileName in fileNames:
+    path = TEST_PATH + fileName
+    def saveVariant(skf, n):
+      page = skf.orderedPages[0]
+      if page.layers:
+        page.layers[0].name = 'Variant %d' % n
+      writer.write(io.BytesIO(), skf)
+    def variantsRead():
+      for n in range(copies):
+        saveVariant(reader.read(path, extract=False), n)
+    def variantsFork():
+      template = SketchTemplate(reader.read(path, extract=False))
+      for n in range(copies):
+        saveVariant(template.fork(), n)
+    result.append((fileName, timeIt(variantsRead, repeat), timeIt(variantsFork, repeat)))
+  return result
+
+def benchmarkTemplateCache(fileNames=('Template.sketch', 'Re-Cover.sketch'), count=20, repeat=3):
+  """Answers a list of (fileName, readTime, cacheTime) for a worker that
+  makes count documents from the template file, each with one new rectangle,
+  saved into memory: by SketchApi(path, cache=False), that reads the template
+  every time, and by SketchApi(path, cache=True), that forks the template in
+  TEMPLATE_CACHE. The cache is cleared first, so its first read is included.
+  Template.sketch is the default template of SketchApi.
+
+  >>> result = benchmarkTemplateCache(count=2, repeat=1)
+  >>> [fileName for fileName, t1, t2 in result]
+  ['Template.sketch', 'Re-Cover.sketch']
+  """
+  result = []
+  tmpPath = tempfile.mkdtemp()
+  try:
+    for fileName in fileNames:
+      if fileName == 'Template.sketch':
+        path = shutil.copy(SketchApi().getTemplatePath(), tmpPath)
+      else:
+        path = shutil.copy(TEST_PATH + fileName, tmpPath)
+      def makeDocuments(cache):
+        for n in range(count):
+          api = SketchApi(path, cache=cache)
+          api.layer = api.selectPage(0).layers[0]
+          api.rect(x=n, y=n, w=100, h=100)
+          api.save(io.BytesIO())
+      def makeDocumentsCached():
+        TEMPLATE_CACHE.clear()
+        makeDocuments(True)
+      result.append((fileName, timeIt(lambda: makeDocuments(False), repeat), timeIt(makeDocumentsCached, repeat)))
+  finally:
+    shutil.rmtree(tmpPath)
+  return result
+
+def benchmarkRects(counts=(1000, 5000), repeat=3):
+  """Answers a list of (name, rectTime, rectsTime) for drawing count rectangles
+  with 10 different fills on an artboard: by a loop of SketchApi.rect and by
+  one call to SketchApi.rects with the columns.
+
+  >>> result = benchmarkRects(counts=(10,), repeat=1)
+  >>> [name for name, t1, t2 in result]
+  ['10 rectangles']
+  """
+  result = []
+  for count in counts:
+    xs = [n % 100 * 10 for n in range(count)]
+    ys = [n // 100 * 10 for n in range(count)]
+    fills = [(n % 10 / 10, 0, 1 - n % 10 / 10) for n in range(count)]
+    def newApi():
+      api = SketchApi()
+      api.selectLayer(name='Artboard 1')
+      return api
+    def drawRect():
+      api = newApi()
+      for x, y, fill in zip(xs, ys, fills):
+        api.rect(x, y, 8, 8, fill=fill)
+    def drawRects():
+      newApi().rects(xs, ys, 8, 8, fills=fills)
+    result.append(('%d rectangles' % count, timeIt(drawRect, repeat), timeIt(drawRects, repeat)))
+  return result
+
+def printResults(title, result, unit='ms', scale=1000):
+  """Print the (name, oldValue, newValue) results as table."""
+  print(title)
+  for name, v1, v2 in result:
+    print('  %-24s %9.2f%s %9.2f%s %6.2fx' % (name, v1*scale, unit, v2*scale, unit, v1/v2))
+
+def runBenchmarks():
+  printResults('Decode pages: interpreted, compiled', benchmarkDecode())
+  printResults('Bytes per layer: __dict__, __slots__', benchmarkMemory(), 'B', 1)
+  printResults('Position strings: regex, fast parser', benchmarkPositionStrings())
+  printResults('Read %d CPU: serial, parallel' % (os.cpu_count() or 1), benchmarkReadMany())
+  printResults('Encode pages: asJson+dumps, stream', benchmarkEncode())
+  printResults('Peak bytes encoding a page: asJson+dump, stream', benchmarkEncodeMemory(), 'B', 1)
+  printResults('JSON backends: json, backend', benchmarkJsonBackends())
+  printResults('Compare: all layers, 1 changed', benchmarkCompare())
+  printResults('Compare files: read, archive', benchmarkArchiveCompare())
+  printResults('Select texts: find, selector', benchmarkSelect())
+  printResults('Overlapping layers: pairwise, spatial index', benchmarkOverlaps())
+  printResults('Absolute bounds: per layer, geometry', benchmarkGeometry())
+  printResults('Library styles of TestUI x 50: unshared, shared', benchmarkSharedStyles(), '', 1)
+  printResults('Save 20 variants: read, fork template', benchmarkFork())
+  printResults('Make 20 documents: read template, cache', benchmarkTemplateCache())
+  printResults('Draw rectangles: rect, rects', benchmarkRects())
+
+if __name__ == '__main__':
+  import doctest
+  import sys
+  failed = doctest.testmod()[0]
+  if not failed:
+    runBenchmarks()
+  sys.exit(failed)
@@ -14,6 +14,7 @@
 #  Output an oveview of differences.
 #
 import os
+import zipfile
 from pysketchapp.sketchclasses import *
 from pysketchapp.sketchappreader import SketchAppReader
 from pysketchapp.sketchappwriter import SketchAppWriter
@@ -24,51 +25,325 @@ IGNORE = ['userInfo']
 if not CHECK_ID:
     IGNORE.append('do_objectID')
 
-def _compare(d1, d2, result, path=None):
-    if path is None:
-        path = ''
+# Kinds of SketchDiff records.
+DIFF_CHANGED = 'changed' # Different values.
+DIFF_TYPE = 'type' # Values of different types, not compared deeper.
+DIFF_ADDED = 'added' # Only in the second tree, old is None.
+DIFF_REMOVED = 'removed' # Only in the first tree, new is None.
+DIFF_MOVED = 'moved' # Element with the same id at another index in the list.
 
+class SketchDiff:
+    """Difference between two Sketch trees. The path is the location in the
+    first tree (in the second tree for added values), kind is one of the
+    DIFF_* names, old and new are the values in the first and second tree.
+
+    >>> SketchDiff('/name', DIFF_CHANGED, 'A', 'B')
+    <SketchDiff changed /name 'A' -> 'B'>
+    """
+    __slots__ = ('path', 'kind', 'old', 'new')
+
+    def __init__(self, path, kind, old=None, new=None):
+        self.path = path
+        self.kind = kind
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return '<SketchDiff %s>' % self
+
+    def __str__(self):
+        return '%s %s %r -> %r' % (self.kind, self.path, self.old, self.new)
+
+    def __eq__(self, diff):
+        return isinstance(diff, SketchDiff) and self.asTuple() == diff.asTuple()
+
+    def asTuple(self):
+        return self.path, self.kind, self.old, self.new
+
+    def asJson(self):
+        """Answers the diff as JSON compatible dictionary. Values that are
+        not JSON types, such as layers, are written as their repr.
+
+        >>> SketchDiff('/layers[0]', DIFF_ADDED, None, SketchPage(name='P')).asJson()
+        {'path': '/layers[0]', 'kind': 'added', 'old': None, 'new': '<SketchPage name=P>'}
+        """
+        return dict(path=self.path, kind=self.kind, old=_jsonValue(self.old), new=_jsonValue(self.new))
+
+def _jsonValue(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+def _hashIndex():
+    """Answers the index of the digest in SketchBase.getHashes() that can be
+    used to skip identical layers: the content digest if it leaves out no
+    more than IGNORE, otherwise the full digest.
+
+    >>> _hashIndex()
+    0
+    """
+    if HASH_IGNORE.issubset(IGNORE):
+        return 0
+    return 1
+
+def _getIds(l):
+    """Answers the list of do_objectID of the elements in list l, or None if
+    not all elements have a unique id."""
+    ids = []
+    for e in l:
+        eId = getattr(e, 'do_objectID', None) if isinstance(e, SketchBase) else None
+        if eId is None:
+            return None
+        ids.append(eId)
+    if len(set(ids)) != len(ids):
+        return None
+    return ids
+
+def _increasingIndices(values):
+    """Answers the set of indices of a longest increasing subsequence of
+    values, the elements that keep their relative order.
+
+    >>> sorted(_increasingIndices([0, 3, 1, 2]))
+    [0, 2, 3]
+    """
+    tails = [] # Index of the smallest tail of an increasing run per length.
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if values[tails[mid]] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous[index] = tails[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(index)
+        else:
+            tails[lo] = index
+    result = set()
+    index = tails[-1] if tails else None
+    while index is not None:
+        result.add(index)
+        index = previous[index]
+    return result
+
+def _iterListDiffs(l1, l2, path):
+    """Yields the differences between lists l1 and l2. If the elements of
+    both lists have unique ids that are (partially) the same, then elements
+    are matched by do_objectID, otherwise by index."""
+    ids1 = _getIds(l1)
+    ids2 = _getIds(l2) if ids1 is not None else None
+    if ids2 is not None and not set(ids1).isdisjoint(ids2):
+        indices2 = {eId: index for index, eId in enumerate(ids2)}
+        matched = [(index1, indices2[eId]) for index1, eId in enumerate(ids1) if eId in indices2]
+        inOrder = _increasingIndices([index2 for index1, index2 in matched])
+        for index1, e1 in enumerate(l1):
+            if ids1[index1] not in indices2:
+                yield SketchDiff('%s[%d]' % (path, index1), DIFF_REMOVED, e1, None)
+        for n, (index1, index2) in enumerate(matched):
+            if n not in inOrder:
+                yield SketchDiff('%s[%d]' % (path, index1), DIFF_MOVED, index1, index2)
+            yield from iterDiffs(l1[index1], l2[index2], '%s[%d]' % (path, index1))
+        ids1 = set(ids1)
+        for index2, e2 in enumerate(l2):
+            if ids2[index2] not in ids1:
+                yield SketchDiff('%s[%d]' % (path, index2), DIFF_ADDED, None, e2)
+    else:
+        for index, (e1, e2) in enumerate(zip(l1, l2)):
+            yield from iterDiffs(e1, e2, '%s[%d]' % (path, index))
+        for index in range(len(l2), len(l1)):
+            yield SketchDiff('%s[%d]' % (path, index), DIFF_REMOVED, l1[index], None)
+        for index in range(len(l1), len(l2)):
+            yield SketchDiff('%s[%d]' % (path, index), DIFF_ADDED, None, l2[index])
+
+def iterDiffs(d1, d2, path=''):
+    """Generator of the SketchDiff records between d1 and d2, which can be
+    SketchBase nodes or JSON values. Layers with equal content hashes are
+    skipped and attributes in IGNORE are not compared. Pages of a lazy read
+    SketchFile are compared as their SketchPage, reading them if needed.
+
+    >>> page1 = SketchPage(name='Page')
+    >>> page2 = SketchPage(name='Page 2')
+    >>> for name in ('A', 'B', 'C'):
+    ...     page1.append(SketchArtboard(name=name, do_objectID=name))
+    ...     page2.append(SketchArtboard(name=name, do_objectID=name))
+    >>> page2.layers.insert(0, SketchArtboard(name='New', do_objectID='N'))
+    >>> page2.layers[-1].name = 'C2'
+    >>> for diff in iterDiffs(page1, page2):
+    ...     print(diff)
+    changed /name 'Page' -> 'Page 2'
+    changed /layers[2]/name 'C' -> 'C2'
+    added /layers[0] None -> <SketchArtboard name=New w=100 h=100>
+    >>> page2.layers.reverse()
+    >>> [diff.kind for diff in iterDiffs(page1, page2)]
+    ['changed', 'moved', 'moved', 'changed', 'added']
+    >>> list(iterDiffs({'a': [1, 2]}, {'a': [1], 'b': 3}))
+    [<SketchDiff removed /a[1] 2 -> None>, <SketchDiff added /b None -> 3>]
+    >>> path = '../../Test/TestRectangles.sketch'
+    >>> skf1 = SketchAppReader().read(path, extract=False)
+    >>> skf2 = SketchAppReader().read(path, lazy=True)
+    >>> list(iterDiffs(skf1, skf2))
+    []
+    >>> skf1.orderedPages[0].layers[0].name = 'Changed'
+    >>> [diff.path.split('/', 3)[-1] for diff in iterDiffs(skf1, skf2)]
+    ['layers[0]/name']
+    """
+    if isinstance(d1, SketchPageProxy):
+        d1 = d1.page
+    if isinstance(d2, SketchPageProxy):
+        d2 = d2.page
+    if isinstance(d1, SketchPackedCurvePoints):
+        d1 = list(d1)
+    if isinstance(d2, SketchPackedCurvePoints):
+        d2 = list(d2)
     if isinstance(d1, SketchBase):
-        if not isinstance(d2, SketchBase):
-            result.append("%s is not SketchBase instance" % d2)
+        if d1.__class__ is not d2.__class__:
+            yield SketchDiff(path, DIFF_TYPE, d1, d2)
+        elif isinstance(d1, SketchLayer) and d1.getHashes()[_hashIndex()] == d2.getHashes()[_hashIndex()]:
+            return # Same content, skip comparing the layer tree.
         else:
             for attrName in d1.ATTRS:
-                if attrName in IGNORE:
-                    continue
-                v1 = getattr(d1, attrName)
-                v2 = getattr(d2, attrName)
-                _compare(v1, v2, result, path + '/' + attrName)
-        if hasattr(d1, 'layers') != hasattr(d2, 'layers'):
-            result.append("%s: %s does not have key %s" % (path, d2, dKey1))
-        elif hasattr(d1, 'layers'):
-            for index, layer1 in enumerate(d1.layers):
-                layer2 = d2.layers[index]
-                _compare(layer1, layer2, result, path + '/layers[%d]' % index)
+                if attrName not in IGNORE:
+                    yield from iterDiffs(d1.getValue(attrName), d2.getValue(attrName),
+                        path + '/' + attrName)
+            if 'layers' not in d1.ATTRS and isinstance(d1, SketchLayer):
+                yield from _iterListDiffs(d1.layers, d2.layers, path + '/layers')
     elif isinstance(d1, dict):
         if not isinstance(d2, dict):
-            result.append("%s: %s and %s are not both dict" % (path, d1, d2))
+            yield SketchDiff(path, DIFF_TYPE, d1, d2)
         else:
-            for dKey1, dd1 in d1.items():
-                if not dKey1 in d2:
-                    result.append("%s: %s does not have key %s" % (path, d2, dKey1))
+            for key, value in d1.items():
+                if key not in d2:
+                    yield SketchDiff('%s/%s' % (path, key), DIFF_REMOVED, value, None)
                 else:
-                    dd2 = d2[dKey1]
-                    _compare(dd1, dd2, result, path + '/' + dKey1)
+                    yield from iterDiffs(value, d2[key], '%s/%s' % (path, key))
+            for key, value in d2.items():
+                if key not in d1:
+                    yield SketchDiff('%s/%s' % (path, key), DIFF_ADDED, None, value)
     elif isinstance(d1, (list, tuple)):
-        if not isinstance(d2,  (list, tuple)):
-            result.append("%s: %s is not list/tuple instance" % (path, d2))
-        elif (len(d1) != len(d2)):
-            result.append("%s: Lists not same length %d - %d" % (path, d1, d2))
+        if not isinstance(d2, (list, tuple)):
+            yield SketchDiff(path, DIFF_TYPE, d1, d2)
         else:
-            for index, dd1 in enumerate(d1):
-                dd2 = d2[index]
-                _compare(dd1, dd2, result, path + '[%d]' % index)
+            yield from _iterListDiffs(d1, d2, path)
+    elif isinstance(d2, (SketchBase, dict, list, tuple)):
+        yield SketchDiff(path, DIFF_TYPE, d1, d2)
     elif d1 != d2:
-        result.append("%s: Value %s different from %s" % (path, d1, d2))
+        yield SketchDiff(path, DIFF_CHANGED, d1, d2)
+
+# Classes of the JSON entries in a Sketch archive, other than the pages.
+# SketchMeta is build from the pages of its SketchFile, so meta.json is
+# compared as dictionary.
+ARCHIVE_CLASSES = {
+    DOCUMENT_JSON: SketchDocument,
+    USER_JSON: SketchUser,
+    META_JSON: None,
+}
+
+def _readArchiveNode(zf, name, jsonBackend):
+    """Answers the node of the JSON entry name in zip file zf."""
+    d = jsonBackend.loads(zf.read(name))
+    if name.startswith(PAGES_JSON):
+        return SketchPage(**d)
+    if ARCHIVE_CLASSES[name] is None:
+        return d
+    return ARCHIVE_CLASSES[name](**d)
+
+def iterArchiveDiffs(path1, path2, jsonBackend=None):
+    """Generator of the SketchDiff records between two Sketch files, without
+    reading them completely. Zip entries with the same CRC32 and size are
+    skipped. Only the JSON entries (pages, document, user, meta) that differ
+    are parsed and compared by iterDiffs. Other entries, such as images and
+    previews, are compared by CRC32, without extracting them. The paths of
+    the diffs are the same as comparing the SketchFiles, e.g.
+    /pages/<pageId>/layers[0]/name and /images/<name>.png
+
+    >>> import shutil, tempfile
+    >>> path1 = '../../Test/TestRectangles.sketch'
+    >>> path2 = shutil.copy(path1, tempfile.mkdtemp())
+    >>> list(iterArchiveDiffs(path1, path2))
+    []
+    >>> skf = SketchAppReader().read(path2, extract=False)
+    >>> page = list(skf.pages.values())[0]
+    >>> page.layers[0].name = 'Changed'
+    >>> SketchAppWriter().write(path2, skf)
+    >>> for diff in iterArchiveDiffs(path1, path2):
+    ...     print(diff.kind, diff.path.split('/')[-1], diff.new)
+    changed name Changed
+    changed saveHistory[0] NONAPPSTORE.57544
+    """
+    jsonBackend = getJsonBackend(jsonBackend)
+    zf1 = zipfile.ZipFile(path1, mode='r')
+    zf2 = zipfile.ZipFile(path2, mode='r')
+    try:
+        infos1 = zf1.NameToInfo
+        infos2 = zf2.NameToInfo
+        for name, info1 in infos1.items():
+            path = '/' + name.replace('.json', '')
+            info2 = infos2.get(name)
+            if info2 is None:
+                yield SketchDiff(path, DIFF_REMOVED, name, None)
+            elif info1.CRC == info2.CRC and info1.file_size == info2.file_size:
+                continue # Same bytes, no need to parse the entry.
+            elif name in ARCHIVE_CLASSES or (name.startswith(PAGES_JSON) and name.endswith('.json')):
+                yield from iterDiffs(_readArchiveNode(zf1, name, jsonBackend),
+                    _readArchiveNode(zf2, name, jsonBackend), path)
+            else:
+                yield SketchDiff(path, DIFF_CHANGED, '%08x' % info1.CRC, '%08x' % info2.CRC)
+        for name in infos2:
+            if name not in infos1:
+                yield SketchDiff('/' + name.replace('.json', ''), DIFF_ADDED, None, name)
+    finally:
+        zf1.close()
+        zf2.close()
+
+def _iterFileDiffs(sketchFile1, sketchFile2, archive=False):
+    """Answers the generator of diffs between the Sketch files. If archive is
+    True and both are paths, then compare them by iterArchiveDiffs."""
+    if archive and isinstance(sketchFile1, str) and isinstance(sketchFile2, str):
+        return iterArchiveDiffs(sketchFile1, sketchFile2)
+    return iterDiffs(_readSketchFile(sketchFile1), _readSketchFile(sketchFile2))
+
+def _readSketchFile(sketchFile):
+    if isinstance(sketchFile, str):
+        sketchFile = SketchAppReader().read(sketchFile)
+    return sketchFile
 
+def writeDiffs(f, sketchFile1, sketchFile2, jsonLines=False, archive=False):
+    """Write the differences between the Sketch files (or paths, compared
+    by iterArchiveDiffs if archive is True) into text file f, one per line,
+    as text or as JSON Lines. The diffs are written
+    while they are found, so memory use does not depend on their number.
+    Answers the number of differences.
 
-def sketchCompare(sketchFile1, sketchFile2, result=None):
+    >>> import io
+    >>> f = io.StringIO()
+    >>> writeDiffs(f, SketchPage(name='A'), SketchPage(name='B'), jsonLines=True)
+    1
+    >>> f.getvalue()
+    '{"path": "/name", "kind": "changed", "old": "A", "new": "B"}\\n'
     """
+    count = 0
+    for diff in _iterFileDiffs(sketchFile1, sketchFile2, archive):
+        if jsonLines:
+            f.write(json.dumps(diff.asJson()) + '\n')
+        else:
+            f.write(str(diff) + '\n')
+        count += 1
+    return count
+
+def sketchCompare(sketchFile1, sketchFile2, result=None, archive=False):
+    """Answers the list of differences between the Sketch files (or paths)
+    as strings. Use iterDiffs() to get them as SketchDiff records. Paths are
+    read and compared as SketchFile trees. If archive is True, then two paths
+    are compared by iterArchiveDiffs() instead, so unchanged pages are not
+    read, but their diffs are of the JSON in the archives.
+
+    >>> path1, path2 = '../../Test/TestRectangles.sketch', '../../Test/TestRectanglesWrite.sketch'
+    >>> diffs = sketchCompare(path1, path2)
+    >>> sorted(set(sketchCompare(path1, path2, archive=True)) - set(diffs))
+    ["changed /meta/saveHistory[0] 'NONAPPSTORE.67469' -> 'NONAPPSTORE.57544'"]
+
     >>> from sketchappreader import SketchAppReader
     >>> PATH = '../../Test/'
     >>> EXPORT_PATH = '_export/'
@@ -91,6 +366,7 @@ def sketchCompare(sketchFile1, sketchFile2, result=None):
     ...     writer.write(writePath, skf1)
     ...     skf2 = reader.read(writePath)
     ...     result = sketchCompare(skf1, skf2) # Should not give any differences
+    ...     result = [error for error in result if '/image/_ref ' not in error] # Except images stored by SHA-1.
     ...     if result:
     ...         print('--- Difference ---', readPath)
     ...         for error in result:
@@ -99,14 +375,8 @@ def sketchCompare(sketchFile1, sketchFile2, result=None):
     """
     if result is None:
         result = []
-    if isinstance(sketchFile1, str):
-        reader = SketchAppReader()
-        sketchFile1 = reader.read(sketchFile1)
-    if isinstance(sketchFile2, str):
-        reader = SketchAppReader()
-        sketchFile2 = reader.read(sketchFile2)
-    _compare(sketchFile1, sketchFile2, result)
-
+    for diff in _iterFileDiffs(sketchFile1, sketchFile2, archive):
+        result.append(str(diff))
     return result
 
 def prettyPrint(d, name=None, result=None, tab=0):
@@ -129,14 +399,18 @@ def prettyPrint(d, name=None, result=None, tab=0):
     """
     if result is None:
         result = []
-    if isinstance(d, SketchBase):
+    if isinstance(d, SketchFile):
         result.append('\t'*tab + str(d))
         for attrName in sorted(d.ATTRS.keys()):
-            if hasattr(d, attrName):
-                prettyPrint(getattr(d, attrName), attrName, result, tab+1)
-        if hasattr(d, 'layers'):
-            for layer in d.layers:
-                prettyPrint(layer, 'layers', result, tab+1)
+            if attrName == 'pages':
+                result.append('\t'*(tab+1) + 'pages{%d}' % len(d.pages))
+                for depth, parent, layer in d.walk():
+                    _prettyPrintNode(layer, result, tab+2+depth)
+            elif d.getValue(attrName, NO_VALUE) is not NO_VALUE:
+                prettyPrint(d.getValue(attrName), attrName, result, tab+1)
+    elif isinstance(d, SketchBase):
+        for depth, parent, layer in d.walk():
+            _prettyPrintNode(layer, result, tab+depth)
     elif isinstance(d, dict):
         result.append('\t'*tab + name + '{%d}' % len(d))
         for key, value in sorted(d.items()):
@@ -150,6 +424,16 @@ def prettyPrint(d, name=None, result=None, tab=0):
 
     return result
 
+def _prettyPrintNode(d, result, tab):
+    """Add the lines of node d and its attributes to result. The layers in
+    d are added by the walk in prettyPrint."""
+    result.append('\t'*tab + str(d))
+    for attrName in sorted(d.ATTRS.keys()):
+        if attrName == 'layers' and isinstance(d, SketchLayer):
+            continue
+        if d.getValue(attrName, NO_VALUE) is not NO_VALUE:
+            prettyPrint(d.getValue(attrName), attrName, result, tab+1)
+
 if __name__ == '__main__':
     import doctest
     import sys
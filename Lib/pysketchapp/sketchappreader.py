@@ -22,12 +22,71 @@
 #  Webviewer
 #  https://github.com/AnimaApp/sketch-web-viewer
 #
+import sys
+import pickle
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pysketchapp.sketchclasses import *
 
+def _readManyItem(args):
+  """Worker function of SketchAppReader.readMany. Answers (path, result, error),
+  where error is the formatted exception if reading or reducing failed.
+  If pickled is True, then the result is answered as pickle, so a result that
+  cannot be pickled is an error of this file, not of the whole pool.
+  Defined on module level, so the process pool can pickle it."""
+  path, reduce, lazy, packPoints, jsonBackend, shareStyles, pickled = args
+  try:
+    reader = SketchAppReader(jsonBackend=jsonBackend, shareStyles=shareStyles)
+    result = reader.read(path, lazy=lazy, packPoints=packPoints)
+    if reduce is not None and result is not None:
+      result = reduce(result)
+    if pickled:
+      result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+  except Exception:
+    return path, None, ''.join(traceback.format_exception_only(*sys.exc_info()[:2])).strip()
+  return path, result, None
+
+def _unpickleManyItem(item):
+  path, result, error = item
+  if result is not None:
+    result = pickle.loads(result)
+  return path, result, error
+
 class SketchAppReader(SketchAppBase):
+  """Reads .sketch files as SketchFile. If shareStyles is True, then equal
+  colors, context settings, fonts and paragraph styles (SketchSharedBase
+  instances) of the files that are read by this reader are one shared
+  instance. Changing them as attribute of their owner changes a private
+  copy (copy-on-write), see SketchSharedAttr.
+
+  >>> reader = SketchAppReader(shareStyles=True)
+  >>> path = '../../Test/TestRectangles.sketch'
+  >>> fill1 = reader.read(path).find(_class='rectangle')[0].style.fills[0]
+  >>> fill2 = reader.read(path).find(_class='rectangle')[0].style.fills[0]
+  >>> fill1.getValue('color') is fill2.getValue('color')
+  True
+  >>> fill1.color.red = 0.5
+  >>> fill1.color.red, fill2.getValue('color').red == 0.5, fill2.getValue('color').isShared
+  (0.5, False, True)
+  >>> SketchAppReader().read(path).find(_class='rectangle')[0].style.fills[0].getValue('color').isShared
+  False
+  """
+  def __init__(self, overwriteImages=False, jsonBackend=None, shareStyles=False):
+    SketchAppBase.__init__(self, overwriteImages, jsonBackend)
+    self.sharedStyles = SketchSharedStyles() if shareStyles else None
 
-  def read(self, path):
+  def read(self, path, lazy=False, packPoints=False, extract=None):
     """Read a sketch file and answer a SketchDocument that contains the interpreted data.
+    If lazy is True, then SketchFile.pages holds SketchPageProxy instances, that
+    only read and build their SketchPage when used for the first time.
+    If packPoints is True, then the curve points of shapes are read into
+    SketchPackedCurvePoints arrays, instead of SketchCurvePoint instances.
+    If extract is False, then no _images/ folder is made. The images stay in
+    the archive and are read on demand through skf.images or bitmap.imageData.
+    Use self.extractImages(skf) to write them as files later. By default the
+    images are extracted, except in lazy mode, where reading a page then would
+    write its bitmaps. With extract=True the lazy pages do export them.
 
     >>> path = '../../Test/TestStar.sketch'
     >>> reader = SketchAppReader()
@@ -57,92 +116,227 @@ class SketchAppReader(SketchAppBase):
     >>> bitmap = artboard.layers[0]
     >>> bitmap.frame
     <SketchRect x=60 y=181 w=345 h=345>
+
+    >>> skf = reader.read('../../Test/Re-Cover.sketch', lazy=True)
+    >>> [page.isLoaded for pageId, page in sorted(skf.pages.items())]
+    [False, False, False]
+    >>> sorted(page['name'] for page in skf.meta.pagesAndArtboards.values())
+    ['Page 1', 'Page 2', 'Page 3']
+    >>> page = skf.orderedPages[0]
+    >>> page.__class__.__name__, page.isLoaded
+    ('SketchPageProxy', False)
+    >>> page.name, page.isLoaded
+    ('Page 1', True)
+    >>> sorted(page.__class__.__name__ for page in skf.pages.values())
+    ['SketchPage', 'SketchPageProxy', 'SketchPageProxy']
+    >>> len(skf.find(_class='artboard')) == len(reader.read('../../Test/Re-Cover.sketch').find(_class='artboard'))
+    True
+
+    >>> skf = reader.read(path, packPoints=True)
+    >>> star = skf.find(_class='star')[0]
+    >>> star.points
+    <SketchPackedCurvePoints n=10>
+    >>> star.asJson() == bitmap.asJson()
+    True
+
+    >>> import shutil, tempfile
+    >>> path = shutil.copy('../../Test/TestImage.sketch', tempfile.mkdtemp())
+    >>> skf = reader.read(path, extract=False)
+    >>> skf.images, os.path.exists(skf.imagesPath)
+    (<SketchImageArchive path=TestImage.sketch n=2>, False)
+    >>> skf = reader.read(path, lazy=True)
+    >>> len(skf.find(_class='bitmap')), os.path.exists(skf.imagesPath)
+    (1, False)
+    >>> skf = reader.read(path, lazy=True, extract=True)
+    >>> os.path.exists(skf.imagesPath + 'preview.png'), len(os.listdir(skf.imagesPath))
+    (True, 2)
+    >>> len(skf.find(_class='bitmap')), len(os.listdir(skf.imagesPath))
+    (1, 3)
     """
 
     assert path.endswith('.'+FILETYPE_SKETCH)
     fileName = path.split('/')[-1] # Use file name as document name and storage of images
 
+    if extract is None:
+      extract = not lazy
     skf = SketchFile(path)
 
-    # Construct the directory name to store images. Create the directory if it does not exist.
-    # aPath/fileName.sketch --> aPath/fileName_images/
-    # Answer the newly constructed image path.
-    imagesPath = skf.imagesPath
-    if not os.path.exists(imagesPath):
-      os.makedirs(imagesPath)
-
     zf = zipfile.ZipFile(path, mode='r') # Open the file.sketch as Zip.
     zipInfo = zf.NameToInfo
+    skf.images = SketchImageArchive(path, zf.infolist()) # Images are read on demand.
 
     # Set general document info
     if DOCUMENT_JSON in zipInfo:
-      fc = zf.read(DOCUMENT_JSON).decode("utf-8")
-      d = json.loads(fc)
-      skf.document = SketchDocument(parent=skf, **d)
+      d = self.jsonBackend.loads(zf.read(DOCUMENT_JSON))
+      skf.document = self._decode(SketchDocument, parent=skf, **d)
     else:
       return None # Cannot readw this file.
 
     # Set general user info
     if USER_JSON in zipInfo:
-      fc = zf.read(USER_JSON).decode("utf-8")
-      d = json.loads(fc)
-      skf.user = SketchUser(parent=skf, **d)
+      d = self.jsonBackend.loads(zf.read(USER_JSON))
+      skf.user = self._decode(SketchUser, parent=skf, **d)
 
     # Read pages and build self.imagesId2Path dictionary, as we find sId-->name relations.
     for key in zipInfo:
       if key.startswith(PAGES_JSON): # This much be a page.
-        fc = zf.read(key).decode("utf-8")
-        sketchPageInfo = json.loads(fc)
-        # Reading pages/layers will find all docment images, and store them in self.imagesId2Path
-        sketchPage = SketchPage(parent=skf, **sketchPageInfo)
-        skf.pages[sketchPage.do_objectID] = sketchPage
+        if lazy:
+          # Only keep the reference to the page. Reading of the page and its
+          # bitmaps is postponed until the first time the proxy is used.
+          pageId = key[len(PAGES_JSON):].replace('.json', '')
+          load = partial(self._readLazyPage, skf, path, key, packPoints, extract)
+          skf.pages[pageId] = SketchPageProxy(skf, pageId, load)
+        else:
+          # Reading pages/layers will find all docment images, and store them in self.imagesId2Path
+          sketchPage = self._readPage(skf, zf, key, packPoints)
+          skf.pages[sketchPage.do_objectID] = sketchPage
 
     # Set general meta info
     if META_JSON in zipInfo:
-      fc = zf.read(META_JSON).decode("utf-8")
-      d = json.loads(fc)
-      skf.meta = SketchMeta(parent=skf, **d)
-
-    # Find all images used in the file tree, so we can save them with their layer name.
-    # Note that for now this is not a safe method, in case there are layers with
-    # the same name in the document that refer to different bitmap files.
-    # Also note that renaming the files in the _images/ folder, will disconnect them
-    # from placements by bitmap layers.
-    # TODO: Solve this later, creating unique file names.
-    imageRefs = set()
-    for image in skf.find(_class='bitmap'): # Recursively find all bitmap layers.
-      imageBinary = zf.read(image.image._ref)
-      # Save by internal name, that we already copied this image.
-      imageRefs.add(image.image._ref)
-      # If the image cannot be found by key, then use BitMap id as used in the file.
-      # Export the image as separate file in _images directory.
-      fbm = open(imagesPath + image.name + '.png', 'wb')
-      fbm.write(imageBinary)
-      fbm.close()
+      d = self.jsonBackend.loads(zf.read(META_JSON))
+      skf.meta = self._decode(SketchMeta, parent=skf, **d)
 
-    # Now copy all remaining images (if not used in bitmap layer), under their own name.
-    for key in zipInfo:
-      if key.startswith(IMAGES_JSON) and key not in imageRefs:
-        imageBinary = zf.read(key)
-        fileName = key.split('/')[-1]
-        fbm = open(imagesPath + fileName, 'wb')
-        fbm.write(imageBinary)
-        fbm.close()
-
-    # Save any previews in the _images/ directory too.
-    # Note that there may be an potential naming conflict here, in case a layer is called
-    # "preview".
-    # TODO: To be solved later.
-    for key in zipInfo:
-      if key.startswith(PREVIEWS_JSON): # This is a preview image
-        previewBinary = zf.read(key)
-        fp = open(imagesPath + key.split('/')[-1], 'wb') # Save in _images/ folder
-        fp.write(previewBinary)
-        fp.close()
+    if extract:
+      # In lazy mode the bitmaps are exported when their page is read.
+      self.extractImages(skf, bitmaps=not lazy)
+      skf.images.close() # Opened again when images are read from the archive.
 
+    zf.close()
     return skf
 
+  def readMany(self, paths, workers=None, reduce=None, lazy=False, packPoints=False):
+    """Read the sketch files in paths in parallel by a pool of worker processes
+    and answer a list of (path, result, error) in the order of paths.
+    The result is the SketchFile, or reduce(skf) if reduce is defined. The reduce
+    function then is called inside the worker, so only its (picklable, small)
+    output is sent back. It needs to be a module level function.
+    If reading a file fails, then result is None and error is the formatted
+    exception, without stopping the other files.
+    The number of workers defaults to the number of CPU's. If workers is 1,
+    then the files are read in this process. Otherwise styles of a reader
+    with shareStyles are only shared inside each file. The lazy pages of a
+    SketchFile cannot be sent back to this process, so lazy without reduce
+    raises a ValueError, unless workers is 1.
+
+    >>> reader = SketchAppReader()
+    >>> paths = ['../../Test/TestStar.sketch', '../../Test/Missing.sketch']
+    >>> result = reader.readMany(paths, workers=1)
+    >>> [(path.split('/')[-1], error is None) for path, skf, error in result]
+    [('TestStar.sketch', True), ('Missing.sketch', False)]
+    >>> result[0][1].find(_class='star')
+    [<SketchStar name=Star>]
+    >>> result[1][2].split(':')[0]
+    'FileNotFoundError'
+    >>> result = reader.readMany(paths[:1]*2, workers=2, reduce=repr)
+    >>> [skfRepr for path, skfRepr, error in result]
+    ['<SketchFile path=TestStar.sketch>', '<SketchFile path=TestStar.sketch>']
+    >>> result = reader.readMany(paths[:1]*2, workers=2, lazy=True)
+    Traceback (most recent call last):
+    ...
+    ValueError: Lazy reading needs a reduce function or workers=1
+    >>> result = reader.readMany(paths[:1], workers=1, lazy=True)
+    >>> [(skf.pages[pageId].__class__.__name__, error) for path, skf, error in result for pageId in skf.pages]
+    [('SketchPageProxy', None)]
+    >>> result = reader.readMany(paths[:1]*2, workers=2, reduce=weakref.ref) # Cannot be pickled.
+    >>> [(skf, error.split(':')[0]) for path, skf, error in result]
+    [(None, 'TypeError'), (None, 'TypeError')]
+    """
+    if lazy and reduce is None and workers != 1:
+      raise ValueError('Lazy reading needs a reduce function or workers=1')
+    if workers is None:
+      workers = os.cpu_count() or 1
+    workers = min(workers, len(paths))
+    shareStyles = self.sharedStyles is not None
+    if workers <= 1:
+      return [_readManyItem((path, reduce, lazy, packPoints, self.jsonBackend.NAME, shareStyles, False)) for path in paths]
+    items = [(path, reduce, lazy, packPoints, self.jsonBackend.NAME, shareStyles, True) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      return [_unpickleManyItem(item) for item in executor.map(_readManyItem, items)]
+
+  def _readPage(self, skf, zf, key, packPoints=False):
+    """Answers the SketchPage, built from the JSON in zip entry key."""
+    sketchPageInfo = self.jsonBackend.loads(zf.read(key))
+    return self._decode(SketchPage, parent=skf, packPoints=packPoints, **sketchPageInfo)
+
+  def _decode(self, cls, **d):
+    """Answers the cls instance for dictionary d, sharing its styles through
+    self.sharedStyles if it is set."""
+    with useSharedStyles(self.sharedStyles):
+      return cls(**d)
+
+  def _readLazyPage(self, skf, path, key, packPoints=False, extract=True):
+    """Load function of a SketchPageProxy. Opens the zip file again, to read
+    the page. Export the bitmaps it is using, if extract is True."""
+    zf = zipfile.ZipFile(path, mode='r')
+    sketchPage = self._readPage(skf, zf, key, packPoints)
+    zf.close()
+    if extract:
+      self._writeImages(skf, self._getBitmapImages(skf, sketchPage.find(_class='bitmap')))
+      skf.images.close()
+    return sketchPage
+
+  def extractImages(self, skf, bitmaps=True, workers=1):
+    """Write the images of skf.images as files into the skf.imagesPath folder.
+    Create the folder if it does not exist.
+    If bitmaps is True, then the images of bitmap layers are written by their
+    layer name. All other images and previews are written under their own name.
+    Note that for now this is not a safe method, in case there are layers with
+    the same name in the document that refer to different bitmap files.
+    Also note that renaming the files in the _images/ folder, will disconnect them
+    from placements by bitmap layers.
+    If workers is larger than 1, then the files are written by a pool of threads.
+    Answers the list of written file paths.
+
+    >>> import shutil, tempfile
+    >>> reader = SketchAppReader()
+    >>> path = shutil.copy('../../Test/TestImage.sketch', tempfile.mkdtemp())
+    >>> skf = reader.read(path, extract=False)
+    >>> filePaths = reader.extractImages(skf, workers=2)
+    >>> sorted(filePath.split('/')[-1] for filePath in filePaths)
+    ['Bitcount_cheese_e.png', 'preview.png']
+    >>> sorted(os.listdir(skf.imagesPath)) == sorted(filePath.split('/')[-1] for filePath in filePaths)
+    True
+    """
+    images = []
+    imageRefs = set()
+    if bitmaps:
+      images = self._getBitmapImages(skf, skf.find(_class='bitmap'))
+      imageRefs = set(imageRef for filePath, imageRef in images)
+    # Now copy all remaining images (if not used in bitmap layer), under their own name.
+    # Note that there may be an potential naming conflict with previews, in case
+    # a layer is called "preview".
+    # TODO: To be solved later, creating unique file names.
+    for imageRef in skf.images:
+      if imageRef not in imageRefs:
+        images.append((skf.imagesPath + imageRef.split('/')[-1], imageRef))
+    return self._writeImages(skf, images, workers)
+
+  def _getBitmapImages(self, skf, bitmaps):
+    """Answers the list of (filePath, imageRef) for the bitmap layers, to
+    export their image as file by the name of the layer."""
+    images = []
+    for bitmap in bitmaps:
+      images.append((skf.imagesPath + bitmap.name + '.png', bitmap.image._ref))
+    return images
+
+  def _writeImages(self, skf, images, workers=1):
+    """Write the (filePath, imageRef) images from skf.images. Answers the list
+    of file paths."""
+    # Construct the directory name to store images. Create the directory if it does not exist.
+    # aPath/fileName.sketch --> aPath/fileName_images/
+    if not os.path.exists(skf.imagesPath):
+      os.makedirs(skf.imagesPath)
+    def writeImage(image):
+      filePath, imageRef = image
+      f = open(filePath, 'wb')
+      f.write(skf.images[imageRef])
+      f.close()
+      return filePath
+    if workers > 1:
+      with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(writeImage, images))
+    return [writeImage(image) for image in images]
+
 if __name__ == '__main__':
   import doctest
-  import sys
   sys.exit(doctest.testmod()[0])
@@ -22,6 +22,10 @@
 #  Webviewer
 #  https://github.com/AnimaApp/sketch-web-viewer
 #
+import hashlib
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pysketchapp.sketchclasses import *
 
 class SketchAppWriter(SketchAppBase):
@@ -42,70 +46,566 @@ class SketchAppWriter(SketchAppBase):
   ...     writer = SketchAppWriter()
   ...     writer.write(writePath, skf)
   """
+  # Default (compression, compresslevel) for each type of entry in the zip
+  # archive. JSON is deflated, images already are compressed.
+  COMPRESSION = {
+    'json': (zipfile.ZIP_DEFLATED, 6),
+    'images': (zipfile.ZIP_STORED, None),
+    'previews': (zipfile.ZIP_STORED, None),
+  }
 
-  def write(self, path, sketchFile):
-    assert path.endswith('.sketch')
-    zf = zipfile.ZipFile(path, mode='w') # Open the file.sketch as Zip.
-
-    tmpPath = '/tmp/'+DOCUMENT_JSON
-    f = open(tmpPath, 'w')
-    d = sketchFile.document.asJson()
-    ds = json.dumps(d)
-    f.write(ds)
-    f.close()
-    zf.write(tmpPath, arcname=DOCUMENT_JSON)
-    os.remove(tmpPath)
-
-    tmpPath = '/tmp/'+USER_JSON
-    f = open(tmpPath, 'w')
-    d = sketchFile.user.asJson()
-    ds = json.dumps(d)
-    f.write(ds)
-    f.close()
-    zf.write(tmpPath, arcname=USER_JSON)
-    #os.remove(tmpPath)
-
-    tmpPath = '/tmp/'+META_JSON
-    f = open(tmpPath, 'w')
-    d = sketchFile.meta.asJson()
-    ds = json.dumps(d)
-    f.write(ds)
-    f.close()
-    zf.write(tmpPath, arcname=META_JSON)
-    os.remove(tmpPath)
-
-    for pageId, page in sorted(sketchFile.pages.items()):
-      tmpPath = '/tmp/pages_'+pageId+'.json'
-      f = open(tmpPath, 'w')
-      d = page.asJson()
-      ds = json.dumps(d)
-      f.write(ds)
-      f.close()
-
-      zf.write(tmpPath, arcname='pages/'+pageId+'.json')
-      os.remove(tmpPath)
-
-    # Recursively find all images in the node tree, so we can reconstruct
-    # the internal file name from external file name (in _images/)
-    imageRefs = set(['images/preview.png']) # Keep track of images that we did or don't want to
+  def __init__(self, overwriteImages=False, compression=None, workers=1, jsonBackend=None):
+    """Optional compression is a dictionary with (compression, compresslevel)
+    by entry type, that overwrites the default values in self.COMPRESSION.
+    If workers is larger than 1, then the JSON entries are serialized and
+    deflated by a pool of threads.
+
+    >>> writer = SketchAppWriter(compression=dict(json=(zipfile.ZIP_DEFLATED, 9)))
+    >>> writer.compression['json'], writer.compression['images']
+    ((8, 9), (0, None))
+    """
+    # The jsonBackend is not used for writing, as the encoder of the tree is
+    # faster than any library on the dictionaries of node.asJson().
+    SketchAppBase.__init__(self, overwriteImages, jsonBackend)
+    self.compression = dict(self.COMPRESSION)
+    if compression is not None:
+      self.compression.update(compression)
+    self.workers = workers
+
+  def write(self, path, sketchFile, incremental=False):
+    """Write the sketchFile as zip archive. The path is a file path ending
+    with ".sketch" or a writable binary file-like object (e.g. io.BytesIO),
+    so a Sketch file can be streamed without using the disk. The JSON of each
+    document is serialized directly into its zip entry.
+    If incremental is True and sketchFile was read from a .sketch file, then
+    only the pages that changed are serialized. See self.writeIncremental.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> skf = SketchAppReader().read('../../Test/TestStar.sketch')
+    >>> f = io.BytesIO()
+    >>> SketchAppWriter().write(f, skf)
+    >>> zf = zipfile.ZipFile(f)
+    >>> sorted(zf.namelist())[:3]
+    ['document.json', 'meta.json', 'pages/17A52721-C47A-4B8C-80E5-62F16728D664.json']
+    >>> json.loads(zf.read(DOCUMENT_JSON))['_class']
+    'document'
+
+    Images that were not extracted by the reader are copied from the source file.
+
+    >>> import shutil, tempfile
+    >>> path = shutil.copy('../../Test/TestImage.sketch', tempfile.mkdtemp())
+    >>> skf = SketchAppReader().read(path, extract=False)
+    >>> f = io.BytesIO()
+    >>> SketchAppWriter().write(f, skf)
+    >>> sorted(name for name in zipfile.ZipFile(f).namelist() if name.endswith('.png'))
+    ['images/2a6cac27cecef245ec280ec39f351e3bf975ec11.png', 'previews/preview.png']
+
+    The source file can be overwritten, as it is replaced when the new archive
+    is complete. Then all pages are marked clean, so the next incremental
+    write copies the pages that did not change since.
+
+    >>> skf.orderedPages[0].layers[0].name = 'Changed'
+    >>> SketchAppWriter().write(path, skf)
+    >>> zf = zipfile.ZipFile(path)
+    >>> zf.testzip() is None, 'images/2a6cac27cecef245ec280ec39f351e3bf975ec11.png' in zf.namelist()
+    (True, True)
+    >>> skf.dirtyPages
+    []
+    >>> pageName = PAGES_JSON + skf.orderedPages[0].do_objectID + '.json'
+    >>> pageJson = zf.read(pageName)
+    >>> SketchAppWriter().write(path, skf, incremental=True)
+    >>> zipfile.ZipFile(path).read(pageName) == pageJson
+    True
+
+    Writing to another path or stream keeps the pages dirty, as they are
+    dirty compared to sketchFile.path, the source of incremental writes.
+
+    Pages of a fork of a SketchTemplate that are not loaded are written from
+    the JSON that is cached in the template. Loaded pages are encoded, also
+    if they did not change.
+
+    >>> template = SketchTemplate(SketchAppReader().read('../../Test/Re-Cover.sketch', extract=False))
+    >>> fork = template.fork()
+    >>> fork.orderedPages[0].layers[0].name = 'Changed'
+    >>> f = io.BytesIO()
+    >>> SketchAppWriter().write(f, fork)
+    >>> [page.isLoaded for page in fork.orderedPages[1:]]
+    [False, False]
+    >>> fork.orderedPages[1].markClean() # Loads the page.
+    >>> fork.orderedPages[1].layers[0].frame.x += 1
+    >>> fork.orderedPages[1].markClean()
+    >>> f3 = io.BytesIO()
+    >>> SketchAppWriter().write(f3, fork)
+    >>> zf = zipfile.ZipFile(f)
+    >>> pageNames = [PAGES_JSON + page.do_objectID + '.json' for page in fork.orderedPages]
+    >>> [json.loads(zf.read(pageName))['layers'][0]['name'] == 'Changed' for pageName in pageNames]
+    [True, False, False]
+    >>> f2 = io.BytesIO()
+    >>> SketchAppWriter().write(f2, template.sketchFile)
+    >>> [zipfile.ZipFile(f2).read(pageName) == zf.read(pageName) for pageName in pageNames]
+    [False, True, True]
+    >>> [zipfile.ZipFile(f2).read(pageName) == zipfile.ZipFile(f3).read(pageName) for pageName in pageNames]
+    [False, False, True]
+
+    The cached JSON is also written to a stream that cannot seek.
+
+    >>> class Stream(io.RawIOBase):
+    ...   def __init__(self):
+    ...     self.data = bytearray()
+    ...   def writable(self):
+    ...     return True
+    ...   def write(self, b):
+    ...     self.data += b
+    ...     return len(b)
+    >>> stream = Stream()
+    >>> SketchAppWriter().write(stream, template.fork())
+    >>> zfStream = zipfile.ZipFile(io.BytesIO(bytes(stream.data)))
+    >>> zfStream.testzip() is None, [zfStream.read(pageName) == zipfile.ZipFile(f2).read(pageName) for pageName in pageNames]
+    (True, [True, True, True])
+
+    JSON entries are deflated by default, also when written in parallel.
+
+    >>> skf = SketchAppReader().read('../../Test/Re-Cover.sketch')
+    >>> stored, serial, parallel = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    >>> SketchAppWriter(compression=dict(json=(zipfile.ZIP_STORED, None))).write(stored, skf)
+    >>> SketchAppWriter().write(serial, skf)
+    >>> SketchAppWriter(workers=4).write(parallel, skf)
+    >>> len(serial.getvalue()) < len(stored.getvalue())/3
+    True
+    >>> zfSerial, zfParallel = zipfile.ZipFile(serial), zipfile.ZipFile(parallel)
+    >>> [info.compress_type for info in zfParallel.infolist()] == [info.compress_type for info in zfSerial.infolist()]
+    True
+    >>> all(zfParallel.read(name) == zfSerial.read(name) for name in zfSerial.namelist())
+    True
+    >>> zfParallel.testzip() is None
+    True
+    """
+    if isinstance(path, str):
+      assert path.endswith('.sketch')
+    if incremental and zipfile.is_zipfile(sketchFile.path):
+      self.writeIncremental(path, sketchFile)
+      return
+    # Images that were not extracted are read from the source file, so it
+    # can only be replaced when the new archive is complete.
+    images = sketchFile.images
+    writePath = path
+    replaceSource = isinstance(path, str) and images is not None and \
+      os.path.abspath(path) == os.path.abspath(images.path)
+    if replaceSource:
+      fd, writePath = tempfile.mkstemp(suffix='.' + FILETYPE_SKETCH, dir=os.path.dirname(os.path.abspath(path)))
+      os.close(fd)
+    zf = self._openZip(writePath)
+    refs = {} # New _ref of image references, by id, for the JSON of this archive.
+    try:
+      # Write the images first, as this decides the names of the bitmap images.
+      renamed = self._writeImages(zf, sketchFile, refs)
+
+      entries = [
+        (DOCUMENT_JSON, 'document', sketchFile.document),
+        (USER_JSON, 'user', sketchFile.user),
+        (META_JSON, 'meta', sketchFile.meta),
+      ]
+      for pageId, page in sorted(sketchFile.pages.items()):
+        entries.append((PAGES_JSON+pageId+'.json', pageId, page))
+      template = sketchFile.template
+      for index, (arcname, name, node) in enumerate(entries):
+        if template is not None and self._isTemplateNode(template, name, node):
+          node = self._getTemplateEntry(template, name)
+        entries[index] = arcname, node
+      self._writeJsonEntries(zf, entries, refs)
+    except BaseException:
+      zf.close()
+      if replaceSource:
+        os.remove(writePath) # Keep the source as it was.
+      raise
+
+    zf.close()
+    if images is not None:
+      images.close() # Opened again on the next use.
+    if replaceSource:
+      os.replace(writePath, path)
+      sketchFile.images = SketchImageArchive(path)
+      for oldRef, imageRef in renamed.items():
+        if oldRef not in sketchFile.images:
+          sketchFile.images.addAlias(oldRef, imageRef) # Bitmaps keep their _ref.
+    if isinstance(path, str) and sketchFile.path is not None and \
+        os.path.abspath(path) == os.path.abspath(sketchFile.path):
+      sketchFile.markClean() # The file is the source of the next incremental write.
+
+  def writeIncremental(self, path, sketchFile):
+    """Write sketchFile as zip archive, using the .sketch file at
+    sketchFile.path as source. The images, previews, user.json and the pages
+    that did not change (see SketchLayer.isDirty) are copied from the source
+    byte for byte, without decompressing. The changed pages, document.json and
+    meta.json are serialized. Images of new bitmaps are added.
+    Note that in this mode, changed files in the _images/ folder are ignored.
+    If path is the source file itself, then the archive is written into a
+    temporary file that replaces the source when done. Then all pages are
+    marked clean.
+
+    >>> import shutil, tempfile
+    >>> from sketchappreader import SketchAppReader
+    >>> path = shutil.copy('../../Test/Re-Cover.sketch', tempfile.mkdtemp())
+    >>> skf = SketchAppReader().read(path, extract=False)
+    >>> page1, page2 = skf.orderedPages[:2]
+    >>> page1.layers[0].name = 'Changed'
+    >>> skf.dirtyPages == [page1]
+    True
+    >>> source = zipfile.ZipFile(path)
+    >>> SketchAppWriter().write(path, skf, incremental=True)
+    >>> skf.dirtyPages
+    []
+    >>> zf = zipfile.ZipFile(path)
+    >>> pageName1, pageName2 = (PAGES_JSON + page.do_objectID + '.json' for page in (page1, page2))
+    >>> zf.read(pageName1) == source.read(pageName1), zf.read(pageName2) == source.read(pageName2)
+    (False, True)
+    >>> sorted(zf.namelist()) == sorted(source.namelist()), zf.testzip() is None
+    (True, True)
+    >>> SketchAppReader().read(path, extract=False).orderedPages[0].layers[0].name
+    'Changed'
+    """
+    sourcePath = sketchFile.path
+    writePath = path
+    replaceSource = isinstance(path, str) and os.path.abspath(path) == os.path.abspath(sourcePath)
+    if replaceSource:
+      fd, writePath = tempfile.mkstemp(suffix='.' + FILETYPE_SKETCH, dir=os.path.dirname(os.path.abspath(path)))
+      os.close(fd)
+    source = zipfile.ZipFile(sourcePath, mode='r')
+    sourceFile = open(sourcePath, 'rb')
+    zf = self._openZip(writePath)
+    try:
+      # Copy all images and previews. Then add the images of new bitmaps in the
+      # changed pages, as these may rename the image references.
+      imageRefs = set()
+      refs = {}
+      for info in source.infolist():
+        if info.filename.startswith((IMAGES_JSON, PREVIEWS_JSON)):
+          self._copyEntry(zf, source, sourceFile, info)
+          imageRefs.add(info.filename)
+      dirtyPages = sketchFile.dirtyPages
+      for page in dirtyPages:
+        for bitmap in page.find(_class='bitmap'):
+          if bitmap.image is not None and bitmap.image._ref not in imageRefs:
+            self._writeBitmapImage(zf, bitmap, imageRefs, refs)
+
+      entries = [(DOCUMENT_JSON, sketchFile.document), (META_JSON, sketchFile.meta)]
+      if USER_JSON in source.NameToInfo:
+        self._copyEntry(zf, source, sourceFile, source.getinfo(USER_JSON))
+      else:
+        entries.append((USER_JSON, sketchFile.user))
+      for pageId, page in sorted(sketchFile.pages.items()):
+        arcname = PAGES_JSON+pageId+'.json'
+        if arcname in source.NameToInfo and (isinstance(page, SketchPageProxy) or not page.isDirty):
+          self._copyEntry(zf, source, sourceFile, source.getinfo(arcname)) # Loaded proxies are replaced by the page.
+        else:
+          entries.append((arcname, page))
+      self._writeJsonEntries(zf, entries, refs)
+    except BaseException:
+      zf.close()
+      if replaceSource:
+        os.remove(writePath) # Keep the source as it was.
+      raise
+    finally:
+      sourceFile.close()
+      source.close()
+
+    zf.close()
+    if sketchFile.images is not None:
+      sketchFile.images.close() # Opened again on the next use.
+    if replaceSource:
+      os.replace(writePath, path)
+      if sketchFile.images is not None:
+        sketchFile.images = SketchImageArchive(path) # Entries moved in the new file.
+      sketchFile.markClean()
+
+  def _openZip(self, path):
+    """Answers the zip file at path, open for writing with the JSON compression as default."""
+    compression, compressLevel = self.compression['json']
+    return zipfile.ZipFile(path, mode='w', compression=compression, compresslevel=compressLevel)
+
+  def _writeJsonEntries(self, zf, entries, refs=None):
+    """Write the JSON of the (arcname, node) entries in zf. See
+    SketchBase.asJsonBytes for refs."""
+    compression, compressLevel = self.compression['json']
+    if self.workers > 1 and compression == zipfile.ZIP_DEFLATED:
+      # zlib releases the GIL, so the entries are deflated in parallel. Then
+      # they are added to the archive in order.
+      with ThreadPoolExecutor(max_workers=self.workers) as executor:
+        for arcname, data, deflated in executor.map(partial(self._deflateJson, refs=refs), entries):
+          self._writeDeflated(zf, arcname, data, deflated)
+    else:
+      for arcname, node in entries:
+        if isinstance(node, tuple): # Cached (data, deflated) of a template page.
+          self._writeCached(zf, arcname, *node)
+        else:
+          self._writeJson(zf, arcname, node, refs)
+
+  def _isTemplateNode(self, template, name, node):
+    """Answers if node of a fork of template is unchanged, so it is written
+    from the JSON of template.getNode(name). The name is the id of a page, or
+    "document", "user" or "meta", which are compared to the template. Pages
+    are unchanged if they are not loaded, loaded pages are always encoded."""
+    if name in TEMPLATE_NODES:
+      return node is not None and node == template.getNode(name)
+    return name in template.sketchFile.pages and \
+      isinstance(node, SketchPageProxy) and not node.isLoaded
+
+  def _getTemplateEntry(self, template, name):
+    """Answers the cached (data, deflated) of template.getNode(name), with
+    the JSON as UTF-8 bytes and as raw deflate stream. The deflated data is
+    None if the JSON is not deflated."""
+    compression, compressLevel = self.compression['json']
+    key = compression, compressLevel, name
+    entry = template.entries.get(key)
+    if entry is None:
+      data = template.getJson(name)
+      deflated = None
+      if compression == zipfile.ZIP_DEFLATED:
+        deflated = self._deflate(data)
+      entry = template.entries[key] = data, deflated
+    return entry
+
+  def _writeCached(self, zf, arcname, data, deflated):
+    """Add entry arcname to zf from the cached JSON data, see self._getTemplateEntry."""
+    if deflated is None:
+      zf.writestr(arcname, data)
+    else:
+      self._writeDeflated(zf, arcname, data, deflated)
+
+  def _writeBitmapImage(self, zf, bitmap, imageRefs, refs, rename=True):
+    """Write the image of bitmap in zf by the SHA-1 of the data, if that name
+    is not in imageRefs yet. The bitmap is not changed, the name is stored in
+    refs by the id of bitmap.image, for the JSON. If rename is False, then the
+    image is written by its own _ref, as the JSON of the bitmap is cached.
+    Answers the own _ref, or None if there is no image data."""
+    imageData = bitmap.imageData
+    if imageData is None:
+      return None
+    oldRef = bitmap.image._ref
+    if not rename:
+      if oldRef not in imageRefs:
+        zf.writestr(oldRef, imageData, *self._getCompression(oldRef))
+        imageRefs.add(oldRef)
+      return oldRef
+    imageRef = IMAGES_JSON + hashlib.sha1(imageData).hexdigest() + '.png'
+    if imageRef not in imageRefs:
+      zf.writestr(imageRef, imageData, *self._getCompression(imageRef))
+      imageRefs.add(imageRef)
+    if imageRef != oldRef:
+      refs[id(bitmap.image)] = imageRef
+    return oldRef
+
+  def _getCompression(self, arcname):
+    """Answers the (compression, compresslevel) for zip entry arcname."""
+    if arcname.startswith(IMAGES_JSON):
+      return self.compression['images']
+    if arcname.startswith(PREVIEWS_JSON):
+      return self.compression['previews']
+    return self.compression['json']
+
+  def _deflateJson(self, entry, refs=None):
+    """Answers (arcname, data, deflated) for the (arcname, node) entry, with
+    the JSON of node as UTF-8 bytes and as raw deflate stream."""
+    arcname, node = entry
+    if isinstance(node, tuple): # Cached (data, deflated) of a template page.
+      return (arcname,) + node
+    data = node.asJsonBytes(refs)
+    return arcname, data, self._deflate(data)
+
+  def _deflate(self, data):
+    """Answers data as raw deflate stream, with the JSON compress level."""
+    compressLevel = self.compression['json'][1]
+    if compressLevel is None:
+      compressLevel = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+  def _writeDeflated(self, zf, arcname, data, deflated):
+    """Add entry arcname to zf, with the data that is already deflated."""
+    zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16 # ?rw-------
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    if not self._writeRaw(zf, zinfo, deflated):
+      zf.writestr(zinfo, data, compresslevel=self.compression['json'][1])
+
+  def _copyEntry(self, zf, source, sourceFile, info):
+    """Copy the entry of info from the open zip sourceFile into zf, without
+    decompressing and compressing it again. Entries that cannot be written
+    raw (see self._canWriteRaw) are copied through the ZipFile source."""
+    zinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    if not self._canWriteRaw(zf, info.file_size, info.compress_size):
+      zf.writestr(zinfo, source.read(info))
+      return
+    zinfo.file_size = info.file_size
+    zinfo.CRC = info.CRC
+    # The data starts after the local file header, with its own name and extra lengths.
+    sourceFile.seek(info.header_offset + zipfile.sizeFileHeader - 4)
+    nameLength, extraLength = struct.unpack('<HH', sourceFile.read(4))
+    sourceFile.seek(nameLength + extraLength, 1)
+    self._writeRaw(zf, zinfo, sourceFile.read(info.compress_size))
+
+  def _canWriteRaw(self, zf, fileSize, compressSize):
+    """Answers if an entry of these sizes can be added to zf by _writeRaw.
+    That needs a seekable output, as for a stream zipfile writes data
+    descriptors after the data, and a local header without zip64 extensions."""
+    return zf._seekable and fileSize <= zipfile.ZIP64_LIMIT and compressSize <= zipfile.ZIP64_LIMIT
+
+  def _writeRaw(self, zf, zinfo, rawData):
+    """Add entry zinfo to zf, with the data as it already is compressed.
+    The zipfile module has no public method for this, so the local header is
+    written in the same way as ZipFile.writestr does it, holding the lock of
+    zf. Answers False without writing if zf is a stream that cannot seek or
+    the entry needs zip64, then the caller writes it with ZipFile.writestr,
+    which compresses the data again.
+
+    >>> zf = zipfile.ZipFile(io.BytesIO(), mode='w')
+    >>> zinfo = zipfile.ZipInfo('pages/big.json')
+    >>> zinfo.file_size = zipfile.ZIP64_LIMIT + 1
+    >>> SketchAppWriter()._writeRaw(zf, zinfo, b''), zf.namelist()
+    (False, [])
+
+    Writing in parallel to a stream that cannot seek, such as the output of a
+    web service, falls back to ZipFile.writestr.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> class Stream(io.RawIOBase):
+    ...   def __init__(self):
+    ...     self.data = bytearray()
+    ...   def writable(self):
+    ...     return True
+    ...   def write(self, b):
+    ...     self.data += b
+    ...     return len(b)
+    >>> skf = SketchAppReader().read('../../Test/Re-Cover.sketch', extract=False)
+    >>> stream, f = Stream(), io.BytesIO()
+    >>> SketchAppWriter(workers=4).write(stream, skf)
+    >>> SketchAppWriter(workers=4).write(f, skf)
+    >>> zfStream, zf = zipfile.ZipFile(io.BytesIO(bytes(stream.data))), zipfile.ZipFile(f)
+    >>> zfStream.testzip() is None, all(zfStream.read(name) == zf.read(name) for name in zf.namelist())
+    (True, True)
+    """
+    if not self._canWriteRaw(zf, zinfo.file_size, len(rawData)):
+      return False
+    zinfo.compress_size = len(rawData)
+    with zf._lock:
+      if zf._writing:
+        raise ValueError("Can't write to the ZIP file while there is an open writing handle on it.")
+      zf.fp.seek(zf.start_dir)
+      zinfo.header_offset = zf.start_dir
+      zf.fp.write(zinfo.FileHeader(False))
+      zf.fp.write(rawData)
+      zf.filelist.append(zinfo)
+      zf.NameToInfo[zinfo.filename] = zinfo
+      zf.start_dir = zf.fp.tell()
+    return True
+
+  def _writeImages(self, zf, sketchFile, refs):
+    """Write the images of sketchFile into zf. The image of each bitmap layer
+    is stored once per unique content, by the SHA-1 of the data, in the same
+    way Sketch names them. The bitmaps keep their _ref, the name is stored in
+    refs by the id of bitmap.image, for the JSON that is written. Answers the
+    dictionary {oldRef: newRef} of the renamed images.
+    Images are read from the _images/ folder, if the reader extracted them.
+    Otherwise they are copied from sketchFile.images. Other images keep their
+    own name, as they may be referred to by fills.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> skf = SketchAppReader().read('../../Test/TestImage.sketch')
+    >>> page = skf.orderedPages[0]
+    >>> bitmap = page.find(_class='bitmap')[0]
+    >>> page.layers[0].append(SketchBitmap(name=bitmap.name, image=SketchMSJSONFileReference(_ref=bitmap.image._ref)))
+    >>> page.markClean()
+    >>> f = io.BytesIO()
+    >>> SketchAppWriter().write(f, skf)
+    >>> zf = zipfile.ZipFile(f)
+    >>> sorted(name for name in zf.namelist() if name.endswith('.png'))
+    ['images/2a6cac27cecef245ec280ec39f351e3bf975ec11.png', 'previews/preview.png']
+    >>> pageJson = json.loads(zf.read(PAGES_JSON + page.do_objectID + '.json'))
+    >>> [layer['image']['_ref'] for layer in pageJson['layers'][0]['layers'] if layer['_class'] == 'bitmap']
+    ['images/2a6cac27cecef245ec280ec39f351e3bf975ec11.png', 'images/2a6cac27cecef245ec280ec39f351e3bf975ec11.png']
+    >>> [bitmap.image._ref for bitmap in skf.find(_class='bitmap')], page.isDirty
+    (['images/206e0b3f11f4d5ed9823234438bd68de1ef06967.png', 'images/206e0b3f11f4d5ed9823234438bd68de1ef06967.png'], False)
+    """
+    imageRefs = set() # Names of the images in zf
+    renamed = {}
+    sourceRefs = set() # Names of the images in sketchFile.images that are written by hash
+    sourceFileNames = set(['preview.png']) # Names of files in _images/ that are written
     imagesPath = sketchFile.imagesPath
-    for image in sketchFile.find('bitmap'): # Recursively find all bitmap layers
-      zf.write(imagesPath + image.name + '.png', arcname=image.image._ref)
-      imageRefs.add(image.image._ref)
+    images = sketchFile.images
+    hasImagesPath = os.path.exists(imagesPath)
+
+    for bitmap, isCached in self._iterBitmaps(sketchFile): # Recursively find all bitmap layers
+      oldRef = self._writeBitmapImage(zf, bitmap, imageRefs, refs, rename=not isCached)
+      if oldRef is None:
+        continue
+      if id(bitmap.image) in refs:
+        renamed[oldRef] = refs[id(bitmap.image)]
+      sourceFileNames.add(bitmap.name + '.png')
+      if images is not None and oldRef in images:
+        sourceRefs.add(oldRef)
 
-    # Now copy all the remaining images in the directory into the zip
-    # keeping their own name. Filter out the preview.png
-    for fileName in os.listdir(imagesPath):
-      if fileName.startswith('.') or ('images/'+fileName) in imageRefs:
-        continue # Skip OS-related based files or file we already did
-      zf.write(imagesPath+fileName, arcname=IMAGES_JSON+fileName)
+    # Now copy all the remaining images into the zip keeping their own name.
+    if hasImagesPath:
+      for fileName in os.listdir(imagesPath):
+        imageRef = IMAGES_JSON + fileName
+        if fileName.startswith('.') or fileName in sourceFileNames or imageRef in imageRefs:
+          continue # Skip OS-related based files or file we already did
+        zf.write(imagesPath + fileName, imageRef, *self._getCompression(imageRef))
+        imageRefs.add(imageRef)
+    elif images is not None:
+      for imageRef in images:
+        if imageRef.startswith(IMAGES_JSON) and imageRef not in sourceRefs and imageRef not in imageRefs:
+          zf.writestr(imageRef, images[imageRef], *self._getCompression(imageRef))
+          imageRefs.add(imageRef)
 
     # Copy the preview to the right zip directory
     previewFileName = 'preview.png' # TODO: Make more generic?
-    if os.path.exists(imagesPath + previewFileName):
-      zf.write(imagesPath + previewFileName, arcname=PREVIEWS_JSON + previewFileName)
+    previewRef = PREVIEWS_JSON + previewFileName
+    if hasImagesPath:
+      if os.path.exists(imagesPath + previewFileName):
+        zf.write(imagesPath + previewFileName, previewRef, *self._getCompression(previewRef))
+    elif images is not None and previewRef in images:
+      zf.writestr(previewRef, images[previewRef], *self._getCompression(previewRef))
+    return renamed
 
-    zf.close()
+  def _iterBitmaps(self, sketchFile):
+    """Answers the list of (bitmap, isCached) for the bitmap layers of
+    sketchFile. For the pages of a fork that are written from the JSON of
+    their template page, the bitmaps of the template page are answered with
+    isCached True, so the fork pages are not loaded for this. These must not
+    be changed, as the template is shared by all forks.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> template = SketchTemplate(SketchAppReader().read('../../Test/TestImage.sketch', extract=False))
+    >>> fork = template.fork()
+    >>> [(bitmap.name, isCached) for bitmap, isCached in SketchAppWriter()._iterBitmaps(fork)]
+    [('Bitcount_cheese_e', True)]
+    >>> fork.orderedPages[0].layers[0].name = 'Changed'
+    >>> [(bitmap.root is fork, isCached) for bitmap, isCached in SketchAppWriter()._iterBitmaps(fork)]
+    [(True, False)]
+    """
+    template = sketchFile.template
+    if template is None:
+      return [(bitmap, False) for bitmap in sketchFile.find(_class='bitmap')]
+    bitmaps = []
+    for pageId, page in sketchFile.pages.items():
+      isCached = self._isTemplateNode(template, pageId, page)
+      if isCached:
+        page = template.getPage(pageId)
+      elif isinstance(page, SketchPageProxy):
+        page = page.page
+      bitmaps += [(bitmap, isCached) for bitmap in page.iterLayers('bitmap')]
+    return bitmaps
+
+  def _writeJson(self, zf, arcname, node, refs=None):
+    """Encode the JSON of node incrementally into zip entry arcname,
+    without building the dictionaries and the complete string first."""
+    with zf.open(arcname, mode='w') as f:
+      node.writeJson(f, refs)
 
 
 if __name__ == '__main__':
@@ -29,14 +29,45 @@
 
 import os
 import zipfile
+import hashlib
+import mmap
+import struct
 import json
 import re
 import io
 import weakref
 import time
+import keyword
+import pickle
+import fnmatch
+import heapq
+import math
+import contextvars
+from contextlib import contextmanager
+from array import array
+from functools import partial
 from random import randint
 from inspect import isclass, isfunction
 
+try:
+  import numpy
+except ImportError:
+  numpy = None # Optional, used by SketchPackedCurvePoints.asArrays(), SketchSpatialIndex and SketchGeometry
+
+# Optional JSON libraries, see getJsonBackend()
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  import ujson
+except ImportError:
+  ujson = None
+try:
+  import simdjson
+except ImportError:
+  simdjson = None
+
 FILETYPE_SKETCH = 'sketch' # SketchApp file extension
 UNTITLED_SKETCH = 'untitled.' + FILETYPE_SKETCH # Name for untitled SketchFile.path
 IMAGES_PATH = '_images/' # Path extension for image cache directory
@@ -51,6 +82,19 @@ MS_IMMUTABLE_PAGE = 'MSImmutablePage' # MSJSONFileReference._ref_class value
 
 # Translating Python-valid attribute names to JSON names for Sketch file.
 JSON_ATTR_NAMES = dict(_from='from', _to='to')
+# Attributes for the administration of nodes, that don't change the document.
+CLEAN_ATTRS = frozenset(('_class', '_parent', 'parent', '_extra', '_dirty', '_index', '_hashes',
+  '_spatialIndex', '_geometry', '_shared', '_uncached'))
+# Layer attributes that change the position or size of a layer on the page.
+GEOMETRY_ATTRS = frozenset(('frame', 'rotation', 'isFlippedHorizontal', 'isFlippedVertical'))
+# Attributes that are keys of layers in the SketchLayerIndex.
+INDEXED_ATTRS = frozenset(('name', 'do_objectID'))
+# Attributes that are left out of the content hash, as in sketchappcompare.IGNORE
+HASH_IGNORE = frozenset(('userInfo', 'do_objectID'))
+HASH_SIZE = 16 # Number of bytes of the blake2b digests.
+# Orders of walkLayers(): parents before (pre) or after (post) their layers.
+WALK_PRE = 'pre'
+WALK_POST = 'post'
 
 # Defaults
 BASE_FRAME = {}
@@ -93,16 +137,244 @@ def newObjectID():
   id4 = ('%012X' % randint(0, 999999999999))[:12]
   return '%s-%s-%s-%s-%s' % (t, id1, id2, id3, id4)
 
+class SketchJsonBackend:
+  """JSON library that is used by SketchAppReader to parse the JSON entries.
+  This backend uses the json module of the standard library. Subclasses use
+  faster libraries, if they are installed. Writing does not need a backend,
+  the tree encodes itself, see SketchBase.asJsonBytes()."""
+  NAME = 'json'
+  LIBRARY = json # None if the library is not installed.
+
+  def __repr__(self):
+    return '<%s name=%s>' % (self.__class__.__name__, self.NAME)
+
+  def loads(self, data):
+    """Answers the parsed JSON of data, bytes as read from the zip file.
+
+    >>> SketchJsonBackend().loads(b'{"a": [1, 2.5]}')
+    {'a': [1, 2.5]}
+    """
+    return json.loads(data)
+
+  def dumps(self, d):
+    """Answers the JSON of d as UTF-8 bytes."""
+    return json.dumps(d).encode('utf-8')
+
+class SketchOrjsonBackend(SketchJsonBackend):
+  NAME = 'orjson'
+  LIBRARY = orjson
+
+  def loads(self, data):
+    return orjson.loads(data)
+
+  def dumps(self, d):
+    return orjson.dumps(d)
+
+class SketchUjsonBackend(SketchJsonBackend):
+  NAME = 'ujson'
+  LIBRARY = ujson
+
+  def loads(self, data):
+    return ujson.loads(data)
+
+  def dumps(self, d):
+    return ujson.dumps(d, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+class SketchSimdjsonBackend(SketchJsonBackend):
+  NAME = 'simdjson'
+  LIBRARY = simdjson
+
+  def loads(self, data):
+    return simdjson.loads(data)
+
+# JSON backends in order of preference.
+JSON_BACKENDS = (SketchOrjsonBackend, SketchUjsonBackend, SketchSimdjsonBackend, SketchJsonBackend)
+
+def getJsonBackends():
+  """Answers the names of the JSON backends that are installed.
+
+  >>> getJsonBackends()[-1]
+  'json'
+  """
+  return [backend.NAME for backend in JSON_BACKENDS if backend.LIBRARY is not None]
+
+def getJsonBackend(name=None):
+  """Answers the JSON backend by name. If name is None, then answer the
+  fastest one that is installed, in the order of JSON_BACKENDS. The
+  standard json module is always available as 'json'.
+
+  >>> getJsonBackend().NAME == getJsonBackends()[0]
+  True
+  >>> getJsonBackend('json')
+  <SketchJsonBackend name=json>
+  >>> getJsonBackend('unknown')
+  Traceback (most recent call last):
+  ...
+  ValueError: JSON backend "unknown" is not installed
+  """
+  for backend in JSON_BACKENDS:
+    if backend.LIBRARY is not None and name in (None, backend.NAME):
+      return backend()
+  raise ValueError('JSON backend "%s" is not installed' % name)
+
 class SketchAppBase:
-  """Base class for SketchAppReader and SketchAppWriter."""
+  """Base class for SketchAppReader and SketchAppWriter. The optional
+  jsonBackend is the name of the JSON library to use, see getJsonBackend().
+  By default the fastest one that is installed.
 
-  def __init__(self, overwriteImages=False):
-    self.overwriteImages = overwriteImages
+  >>> SketchAppBase(jsonBackend='json').jsonBackend
+  <SketchJsonBackend name=json>
+  >>> SketchAppBase().jsonBackend.NAME == getJsonBackends()[0]
+  True
+  """
 
-class SketchBase:
+  def __init__(self, overwriteImages=False, jsonBackend=None):
+    self.overwriteImages = overwriteImages
+    self.jsonBackend = getJsonBackend(jsonBackend)
+
+def _hashValue(value, content, full):
+  """Update the content and full hash objects with value. Numbers are hashed
+  the same if they are equal, e.g. 1, 1.0 and True, lists the same as tuples.
+  Other values than nodes, containers, numbers, strings and binary data
+  raise a TypeError, as their repr() may depend on their address.
+
+  >>> h1, h2 = hashlib.blake2b(), hashlib.blake2b()
+  >>> _hashValue([1, 2.0, 'a'], h1, h1)
+  >>> _hashValue((1.0, 2, 'a'), h2, h2)
+  >>> h1.digest() == h2.digest()
+  True
+  >>> _hashValue(object(), h1, h1)
+  Traceback (most recent call last):
+  ...
+  TypeError: Cannot hash value of type object
+  """
+  if isinstance(value, SketchBase):
+    contentDigest, fullDigest = value.getHashes()
+    content.update(contentDigest)
+    full.update(fullDigest)
+    return
+  if isinstance(value, SketchPageProxy):
+    value = value.page # Loads the page if it is lazy.
+    content.update(value.getHashes()[0])
+    full.update(value.getHashes()[1])
+    return
+  if isinstance(value, SketchPackedCurvePoints):
+    value = list(value)
+  if isinstance(value, (list, tuple)):
+    data = b'[%d' % len(value)
+    content.update(data)
+    full.update(data)
+    for v in value:
+      _hashValue(v, content, full)
+  elif isinstance(value, dict):
+    data = b'{%d' % len(value)
+    content.update(data)
+    full.update(data)
+    for key in sorted(value, key=str):
+      _hashValue(key, content, full)
+      _hashValue(value[key], content, full)
+  elif isinstance(value, (bytes, bytearray, memoryview, array)):
+    data = memoryview(value).cast('B')
+    content.update(b'<%d' % len(data))
+    full.update(b'<%d' % len(data))
+    content.update(data)
+    full.update(data)
+  elif value is None or isinstance(value, (str, int, float)):
+    if isinstance(value, float) and value.is_integer():
+      value = int(value)
+    elif isinstance(value, bool):
+      value = int(value)
+    data = repr(value).encode('utf-8') + b'\0'
+    content.update(data)
+    full.update(data)
+  else:
+    raise TypeError('Cannot hash value of type %s' % value.__class__.__name__)
+
+LINK_CLASSES = set() # SketchBase classes that cannot be shared, filled by SketchBaseType.
+NO_VALUE = object() # Default of SketchBase.getValue for attributes that are not set.
+
+class SketchSharedAttr:
+  """Descriptor of an attribute that can hold a shared SketchSharedBase
+  value, installed by SketchBaseType instead of the slot. Reading the
+  attribute from its owner answers a private copy of a shared value, that
+  replaces it in the slot first (copy-on-write), so the caller can change
+  it. Code that only reads the value, such as encoding, hashing and
+  comparing, uses owner.getValue(name), which keeps it shared.
+  """
+  def __init__(self, slot):
+    self.slot = slot
+
+  def __get__(self, obj, cls=None):
+    if obj is None:
+      return self
+    value = self.slot.__get__(obj, cls)
+    # Attributes of a shared owner stay shared, the owner cannot be changed.
+    if getattr(value, '_shared', False) and not getattr(obj, '_shared', False):
+      value = value.copy()
+      self.slot.__set__(obj, value)
+      setParent(value, weakref.ref(obj))
+    return value
+
+  def __set__(self, obj, value):
+    self.slot.__set__(obj, value)
+
+  def __delete__(self, obj):
+    self.slot.__delete__(obj)
+
+  def getValue(self, obj, default=None):
+    """Answers the value in the slot of obj, also if it is shared."""
+    try:
+      return self.slot.__get__(obj, obj.__class__)
+    except AttributeError:
+      return default
+
+class SketchBaseType(type):
+  """Metaclass of SketchBase. Adds the names in the ATTRS table of each class
+  to its __slots__, so instances keep their Sketch attributes in fixed slots
+  instead of a __dict__ per instance. Attributes that are not in ATTRS (such as
+  unknown keys in the JSON of a Sketch file) are stored in the self._extra
+  dictionary, which is only created when needed. Classes that need free
+  attributes add "__dict__" to their own __slots__.
+  The names of all slots, including the inherited ones, are stored in
+  cls.SLOTS. Slots of attributes with a SketchSharedBase class in ATTRS get
+  a SketchSharedAttr, these are stored by name in cls.SHARED_SLOTS.
+
+  >>> SketchColor.SLOTS
+  ('_class', '_parent', '_extra', '_shared', 'do_objectID', 'red', 'green', 'blue', 'alpha')
+  >>> SketchArtboard.SLOTS.count('layers')
+  1
+  >>> sorted(SketchFill.SHARED_SLOTS)
+  ['color', 'contextSettings']
+  """
+  def __new__(mcs, name, bases, namespace):
+    inherited = []
+    for base in bases:
+      inherited += getattr(base, 'SLOTS', ())
+    slots = list(namespace.get('__slots__', ()))
+    for attrName in namespace.get('ATTRS', {}):
+      if attrName not in inherited and attrName not in slots:
+        slots.append(attrName)
+    namespace['__slots__'] = tuple(slots)
+    cls = type.__new__(mcs, name, bases, namespace)
+    cls.SLOTS = tuple(inherited) + tuple(slotName for slotName in slots
+      if slotName not in ('__dict__', '__weakref__'))
+    if '_shared' not in cls.SLOTS:
+      LINK_CLASSES.add(cls)
+    sharedSlots = {}
+    for base in bases:
+      sharedSlots.update(getattr(base, 'SHARED_SLOTS', {}))
+    for attrName, (m, default) in namespace.get('ATTRS', {}).items():
+      if attrName in slots and isclass(m) and '_shared' in getattr(m, 'SLOTS', ()):
+        sharedSlots[attrName] = SketchSharedAttr(cls.__dict__[attrName])
+        type.__setattr__(cls, attrName, sharedSlots[attrName])
+    cls.SHARED_SLOTS = sharedSlots
+    return cls
+
+class SketchBase(metaclass=SketchBaseType):
 
   REPR_ATTRS = ['name'] # Attributes to be show in __repr__
   ATTRS = {}
+  __slots__ = ('_class', '_parent', '_extra', '__weakref__')
 
   def __init__(self, **kwargs):
     """Using **kwargs, the attributes can be set as name values, as well as
@@ -110,9 +382,132 @@ class SketchBase:
 
     >>>
     """
-    self._class = self.CLASS # Forces values to default, in case it is not None
-    self.parent = None # Save reference to parent layer as weakref.
-    self.setAttributes(**kwargs)
+    object.__setattr__(self, '_class', self.CLASS) # Forces values to default, in case it is not None
+    object.__setattr__(self, '_parent', None) # Save reference to parent layer as weakref.
+    self.getDecoder()(self, kwargs)
+
+  def _setDirtyAttr(self, name, value):
+    """The __setattr__ of all nodes. Set the attribute. SketchBase values
+    get self as parent and lists become a SketchList of self, see
+    linkValue(). Then if self is part of a tree of layers, the layers from
+    self up to the page are marked as changed, so an incremental save knows
+    which pages to write. As attribute values know their parent, this also
+    works for changes inside them, e.g. layer.frame.x = 10.
+
+    >>> page = SketchPage(name='Page')
+    >>> artboard = SketchArtboard(name='Board')
+    >>> page.append(artboard)
+    >>> page.markClean()
+    >>> artboard.name = 'Other'
+    >>> artboard.isDirty, page.isDirty
+    (True, True)
+    >>> page.markClean()
+    >>> artboard.frame.x = 10
+    >>> artboard.isDirty, page.isDirty
+    (True, True)
+    >>> page.markClean()
+    >>> artboard.style.fills = [SketchFill()]
+    >>> page.isDirty
+    True
+    >>> page.markClean()
+    >>> artboard.style.fills[0].color.red = 1
+    >>> page.isDirty
+    True
+    """
+    if name in CLEAN_ATTRS:
+      object.__setattr__(self, name, value)
+      return
+    if name in INDEXED_ATTRS:
+      self._setIndexedAttr(name, value)
+      return
+    object.__setattr__(self, name, linkValue(value, weakref.ref(self)))
+    if name in GEOMETRY_ATTRS:
+      self._geometryChanged()
+    else:
+      self._changed()
+  __setattr__ = _setDirtyAttr
+
+  def _setIndexedAttr(self, name, value):
+    """Set the name or do_objectID of self and update the SketchLayerIndex
+    of the SketchFile that self is part of."""
+    oldValue = getattr(self, name, None)
+    object.__setattr__(self, name, value)
+    self._changed()
+    if self._parent is not None:
+      index = getattr(self.root, '_index', None)
+      if index is not None:
+        index.update(self, name, oldValue)
+
+  def _changed(self):
+    """Called after an attribute or a list of self changed. If self is part of
+    a tree, then mark it as changed. Otherwise only clear the cached values."""
+    if self._parent is not None:
+      self.markDirty()
+    elif isinstance(self, SketchLayer):
+      self.__dict__.pop('_hashes', None)
+      self.__dict__.pop('_geometry', None)
+
+  def _geometryChanged(self):
+    """Called after the frame of self (a layer) or one of the other
+    GEOMETRY_ATTRS changed. Marks self as changed and updates its bounds in
+    the spatial indexes of its parents."""
+    if self._parent is not None:
+      self.markDirty((self,))
+    else:
+      self._changed()
+
+  def _listChanged(self, values, added, removed):
+    """Called by the SketchList values of an attribute of self after it was
+    changed in place. The added and removed are lists of elements."""
+    self._changed()
+
+  def markDirty(self, changed=(), removed=()):
+    """Mark self (if it is a SketchLayer) and its parent layers up to the
+    page as changed and clear their cached hashes and geometry. The spatial
+    indexes of these layers are updated for the changed layers (of which
+    the frame changed or that were added) and the removed layers.
+    Layers above the top spatial index are marked as _uncached: the walk of
+    the next change stops there, as the layers up to the page are dirty and
+    have no cached values. Building a cached value clears the mark.
+
+    >>> page = SketchPage()
+    >>> artboard = SketchArtboard()
+    >>> page.append(artboard)
+    >>> artboard.name = 'Board'
+    >>> page._uncached, artboard._uncached
+    (True, True)
+    >>> geometry = page.getGeometry()
+    >>> page._uncached, artboard._uncached
+    (False, False)
+    >>> artboard.frame.x = 10
+    >>> page._uncached, page.getGeometry() is geometry
+    (True, False)
+    """
+    node = self
+    uncached = [] # Visited layers without a spatial index above them.
+    while node is not None:
+      if isinstance(node, SketchLayer):
+        if node._uncached:
+          break # Its parents are dirty and have no cached values or spatial index.
+        if not node._dirty:
+          node._dirty = True
+        if node._hashes is not None:
+          node._hashes = None
+        if node._geometry is not None:
+          node._geometry = None
+        spatialIndex = node._spatialIndex
+        if spatialIndex is not None:
+          for layer in removed:
+            spatialIndex.remove(layer)
+          for layer in changed:
+            if layer is not node: # The index checks the origin of node on use.
+              spatialIndex.update(layer)
+          uncached = []
+        else:
+          uncached.append(node)
+      node = node.parent
+    for node in uncached:
+      node._uncached = True
 
   def setAttributes(self, **kwargs):
     """Expects keyword arguments of attrNames and (method_Or_SketchBaseClass,
@@ -143,35 +538,62 @@ class SketchBase:
     >>> artboard.frame
     <SketchRect x=10 y=20 w=30 h=40>
     """
-    for name, value in kwargs.items():
-        # If not part of the Sketch ATTRS attribute, just set value unchanged.
-        if name not in self.ATTRS:
-          setattr(self, name, value)
-
-    for name, (m, value) in self.ATTRS.items(): # Create attribute, using method or class
-      jsonName = JSON_ATTR_NAMES.get(name, name)
-      if name in kwargs: # Valid if "_from" or "_to" are used as direct attribute names.
-        value = kwargs[name]
-      elif jsonName in kwargs: # In case "from" and "to" are used
-        value = kwargs[jsonName]
-      if isclass(m):
-        if isinstance(value, m):
-          pass # Already SketchBase instance, leave untouched
-        elif value is None:
-          value = m()
-        elif not isinstance(value, dict):
-          value = {name: value}
-        else:
-          value = m(**value)
-      elif isfunction(m):
-        value = m(value)
-      setattr(self, name, value)
+    self.getDecoder()(self, kwargs)
+    if 'frame' in self.ATTRS: # All attributes are set, including the frame.
+      self._geometryChanged()
+    else:
+      self._changed()
+
+  @classmethod
+  def getDecoder(cls):
+    """Answers the decoder function of this class, that sets all attributes of
+    an instance from a dictionary in a single pass. The decoder is compiled
+    from cls.ATTRS on first use and then cached in the class.
+
+    >>> decode = SketchColor.getDecoder()
+    >>> decode is SketchColor.getDecoder()
+    True
+    >>> decode is SketchBorder.getDecoder()
+    False
+    >>> color = SketchColor()
+    >>> decode(color, dict(red=0.5, blue=2))
+    >>> color
+    <SketchColor red=0.5 green=0 blue=1 alpha=0>
+    """
+    decoder = cls.__dict__.get('_decoder') # Not inherited from the parent class.
+    if decoder is None:
+      decoder = cls._decoder = compileDecoder(cls)
+    return decoder
+
+  def __getattr__(self, name):
+    """Answers the attributes that have no slot, as stored in self._extra.
+    Only called if the normal attribute lookup failed.
+
+    >>> p = SketchPoint(x=0, y=100, name='myPoint')
+    >>> p.name, p._extra
+    ('myPoint', {'name': 'myPoint'})
+    >>> hasattr(p, 'myName')
+    False
+    """
+    if name != '_extra':
+      extra = getattr(self, '_extra', None)
+      if extra is not None and name in extra:
+        return extra[name]
+    raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+  def _setExtra(self, name, value):
+    """Store the value of an attribute that has no slot in self._extra."""
+    extra = getattr(self, '_extra', None)
+    if extra is None:
+      extra = self._extra = {}
+    extra[name] = value
 
   def __repr__(self):
     s = ['<%s' % (self.__class__.__name__ or '')]
     for attrName in self.REPR_ATTRS:
-      if hasattr(self, attrName):
-        s.append('%s=%s' % (attrName, getattr(self, attrName)))
+      value = self.getValue(attrName, NO_VALUE)
+      if value is not NO_VALUE:
+        s.append('%s=%s' % (attrName, value))
     return ' '.join(s) + '>'
 
   def __eq__(self, sko):
@@ -184,11 +606,23 @@ class SketchBase:
     >>> p2.x = 100
     >>> p1 == p2
     False
+    >>> a1, a2 = SketchArtboard(name='Board'), SketchArtboard(name='Board')
+    >>> a1.append(SketchRectangle())
+    >>> a2.append(SketchRectangle())
+    >>> a1 == a2
+    True
+    >>> a2.layers[0].frame.x = 100
+    >>> a1 == a2
+    False
     """
     if not isinstance(sko, self.__class__):
       return False
-    for name in self.__dict__.keys():
-      if getattr(self, name) != getattr(sko, name):
+    if self is sko:
+      return True
+    for name in self.SLOTS + tuple(getattr(self, '__dict__', ())):
+      if name in CLEAN_ATTRS and name != '_extra':
+        continue # E.g. comparing the parent weakrefs would compare the parents.
+      if self.getValue(name) != sko.getValue(name):
         #print('XXX', name, self, getattr(self, name), sko, getattr(sko, name))
         return False
     return True
@@ -196,6 +630,99 @@ class SketchBase:
   def __ne__(self, sko):
     return not (self == sko)
 
+  def getHashes(self):
+    """Answers the tuple (contentDigest, fullDigest) of the Merkle hash of
+    self, build from the hashes of all attribute values. The content digest
+    leaves out the attributes in HASH_IGNORE, the full digest includes them.
+    Nodes with equal digests have equal content.
+
+    >>> c1 = SketchColor(red=0.5, do_objectID='A')
+    >>> c2 = SketchColor(red=0.5, do_objectID='B')
+    >>> c1.getHashes()[0] == c2.getHashes()[0], c1.getHashes()[1] == c2.getHashes()[1]
+    (True, False)
+    """
+    content = hashlib.blake2b(self.__class__.__name__.encode('utf-8'), digest_size=HASH_SIZE)
+    full = content.copy()
+    for name in self.SLOTS + tuple(getattr(self, '__dict__', ())):
+      if name == '_extra' or name in CLEAN_ATTRS:
+        continue
+      value = self.getValue(name, NO_VALUE)
+      if value is NO_VALUE:
+        continue
+      if name in HASH_IGNORE:
+        full.update(name.encode('utf-8') + b'\0')
+        _hashValue(value, full, full)
+      else:
+        data = name.encode('utf-8') + b'\0'
+        content.update(data)
+        full.update(data)
+        _hashValue(value, content, full)
+    extra = getattr(self, '_extra', None)
+    if extra:
+      for name in sorted(extra):
+        value = extra[name]
+        if name in HASH_IGNORE:
+          full.update(name.encode('utf-8') + b'\0')
+          _hashValue(value, full, full)
+        else:
+          data = name.encode('utf-8') + b'\0'
+          content.update(data)
+          full.update(data)
+          _hashValue(value, content, full)
+    return content.digest(), full.digest()
+
+  def _get_contentHash(self):
+    """Answers the hexadecimal content digest of self, see getHashes().
+
+    >>> SketchColor(red=1).contentHash == SketchColor(red=1.0).contentHash
+    True
+    """
+    return self.getHashes()[0].hex()
+  contentHash = property(_get_contentHash)
+
+  def getValue(self, name, default=None):
+    """Answers the value of attribute name, or default if it is not set. A
+    shared value is answered as it is, see SketchSharedAttr, so it is only
+    for reading. Use getattr(self, name) to get a value that can be changed.
+
+    >>> with useSharedStyles(SketchSharedStyles()):
+    ...   border1 = SketchBorder(color=dict(red=1))
+    ...   border2 = SketchBorder(color=dict(red=1))
+    >>> border1.getValue('color') is border2.getValue('color'), border1.getValue('missing', 0)
+    (True, 0)
+    """
+    attr = self.SHARED_SLOTS.get(name)
+    if attr is None:
+      return getattr(self, name, default)
+    return attr.getValue(self, default)
+
+  def __getstate__(self):
+    """Answers the attributes for pickle and copy, without the weakref to the
+    parent, which cannot be pickled. Parents restore the link to their
+    children in __setstate__.
+
+    >>> import pickle
+    >>> page = SketchPage(name='Page')
+    >>> page.append(SketchArtboard(name='Board'))
+    >>> page2 = pickle.loads(pickle.dumps(page))
+    >>> page2.layers, page2.layers[0].parent is page2
+    ([<SketchArtboard name=Board w=100 h=100>], True)
+    """
+    state = {}
+    for name in self.SLOTS:
+      if name != '_parent':
+        value = self.getValue(name, NO_VALUE)
+        if value is not NO_VALUE:
+          state[name] = value
+    state.update(getattr(self, '__dict__', {}))
+    return state
+
+  def __setstate__(self, state):
+    object.__setattr__(self, '_parent', None)
+    ref = weakref.ref(self)
+    for name, value in state.items():
+      object.__setattr__(self, name, linkValue(value, ref))
+
   def _get_parent(self):
     if self._parent is not None:
       return self._parent() # Get weakref to parent node
@@ -208,11 +735,21 @@ class SketchBase:
 
   def _get_root(self):
     """Answers the root (SketchFile instance) of self, searching upwards through
-    the chain of parents. Answers None if no root can be found."""
-    parent = self.parent # Expand weakref
-    if parent is not None:
-      return self.parent # Still searching in layer.parent sequence
-    return None
+    the chain of parents. Answers None if no root can be found.
+
+    >>> skf = SketchFile()
+    >>> page = SketchPage(parent=skf)
+    >>> artboard = SketchArtboard()
+    >>> page.append(artboard)
+    >>> artboard.root is skf, page.root is skf, skf.root
+    (True, True, None)
+    """
+    root = None
+    parent = getattr(self, 'parent', None) # Expand weakref
+    while parent is not None: # Still searching in layer.parent sequence
+      root = parent
+      parent = getattr(root, 'parent', None)
+    return root
   root = property(_get_root)
 
   def asDict(self):
@@ -220,7 +757,7 @@ class SketchBase:
     if self._class is not None:
       d['_class'] = self._class
     for attrName, (m, default) in self.ATTRS.items():
-      d[attrName] = getattr(self, attrName)
+      d[attrName] = self.getValue(attrName)
     return d
 
   def find(self, _class=None, name=None, pattern=None, found=None):
@@ -253,10 +790,48 @@ class SketchBase:
       found.append(self)
     return found
 
+  def walk(self, order=WALK_PRE, prune=None):
+    """Generator of (depth, parent, layer) tuples for self (at depth 0) and
+    all layers in it, see walkLayers().
+
+    >>> list(SketchPoint(x=0, y=100).walk())
+    [(0, None, <SketchPoint x=0 y=100>)]
+    """
+    return walkLayers([(0, getattr(self, 'parent', None), self)], order, prune)
+
+  def select(self, selector):
+    """Answers the list of layers in self (including self) that match the
+    selector string, see SketchSelector.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> skf = SketchAppReader().read('../../Test/TestRectangles.sketch')
+    >>> skf.select('artboard > rectangle[name$="Copy"]')
+    [<SketchRectangle name=Rectangle1 Copy>]
+    >>> skf.select('page rectangle[frame.y>=192]') == skf.orderedPages[0].select('rectangle[frame.y>=192]')
+    True
+    """
+    return compileSelector(selector).select(self)
+
+  def iterSelect(self, selector):
+    """Generator of the layers in self that match the selector string, to
+    stop at the first ones."""
+    return compileSelector(selector).iterSelect(self)
+
+  def iterLayers(self, _class=None, order=WALK_PRE, prune=None):
+    """Generator of the layers in self.walk(), only the ones with class
+    _class (a SketchBase class or its CLASS name) if defined. Stop iterating
+    when done, e.g. to answer the first bitmap: next(page.iterLayers('bitmap'), None)
+    """
+    if isclass(_class):
+      _class = _class.CLASS
+    for depth, parent, layer in self.walk(order, prune):
+      if _class is None or layer._class == _class:
+        yield layer
+
   def asJson(self):
     d = {}
     for attrName in self.ATTRS.keys():
-      attr = getattr(self, attrName)
+      attr = self.getValue(attrName)
       # Translate Python name to JSON name
       attrJsonName = JSON_ATTR_NAMES.get(attrName, attrName)
       if isinstance(attr, (list, tuple)):
@@ -279,6 +854,444 @@ class SketchBase:
 
     return d
 
+  def asJsonBytes(self, refs=None):
+    """Answers the JSON of self as UTF-8 bytes, the same as
+    json.dumps(self.asJson()). The JSON is encoded directly from the tree,
+    without building the dictionaries of self.asJson() first. The optional
+    refs is a dictionary {id(fileReference): _ref} with the _ref to write for
+    SketchMSJSONFileReference nodes, instead of their own.
+
+    >>> artboard = SketchArtboard(name='Board', frame=dict(x=10, y=20.5))
+    >>> artboard.append(SketchRectangle(name='Rect'))
+    >>> artboard.asJsonBytes() == json.dumps(artboard.asJson()).encode('utf-8')
+    True
+    """
+    out = SketchJsonStream(refs=refs)
+    if not getJsonEncoder(self.__class__)(self, out):
+      return b'null'
+    return ''.join(out).encode('utf-8')
+
+  def writeJson(self, f, refs=None):
+    """Write the JSON of self as UTF-8 bytes into binary file f, the same as
+    json.dumps(self.asJson()). Large trees of layers are written in parts.
+    See self.asJsonBytes for refs.
+
+    >>> f = io.BytesIO()
+    >>> SketchPage(name='Page').writeJson(f)
+    >>> json.loads(f.getvalue())['name']
+    'Page'
+    """
+    out = SketchJsonStream(f, refs)
+    if not getJsonEncoder(self.__class__)(self, out):
+      out.append('null')
+    out.flush()
+
+def setParent(value, ref):
+  """Set the weakref ref as parent of value, if it is a node that is not
+  shared. SketchPackedCurvePoints keep it as their owner."""
+  if isinstance(value, SketchBase):
+    if not (isinstance(value, SketchSharedBase) and value._shared):
+      object.__setattr__(value, '_parent', ref)
+  elif isinstance(value, SketchPackedCurvePoints):
+    value._owner = ref
+
+def linkValue(value, ref):
+  """Answers value as attribute value of the node with weakref ref. Nodes
+  get the node as parent and lists are answered as SketchList of the node,
+  so changes inside them mark the node as changed.
+
+  >>> style = SketchStyle()
+  >>> fills = linkValue([SketchFill()], weakref.ref(style))
+  >>> fills.__class__.__name__, fills[0].parent is style
+  ('SketchList', True)
+  """
+  if isinstance(value, list):
+    if value.__class__ is not SketchList or value._owner is not ref:
+      value = SketchList(value, ref)
+  else:
+    setParent(value, ref)
+  return value
+
+class SketchList(list):
+  """List value of an attribute of a node, such as layer.layers or
+  style.fills. Changing the list in place is a change of its owner node: the
+  nodes that are added get the owner as parent and the owner is called by
+  owner._listChanged(values, added, removed). Pickled as a normal list.
+
+  >>> style = SketchStyle(fills=[dict()])
+  >>> fill = SketchFill()
+  >>> style.fills.append(fill)
+  >>> len(style.fills), fill.parent is style, style.fills[0].parent is style
+  (2, True, True)
+  >>> del style.fills[1]
+  >>> len(style.fills), fill.parent
+  (1, None)
+  >>> pickle.loads(pickle.dumps(style.fills)).__class__.__name__
+  'list'
+  """
+  __slots__ = ('_owner',)
+
+  def __init__(self, values=(), owner=None):
+    list.__init__(self, values)
+    self._owner = owner # Weakref to the owner node.
+    if owner is not None:
+      setattr = object.__setattr__
+      for value in self:
+        if value.__class__ in LINK_CLASSES: # Most elements, same as setParent.
+          setattr(value, '_parent', owner)
+        else:
+          setParent(value, owner)
+
+  def __reduce__(self):
+    return list, (list(self),)
+
+  def _changed(self, added=(), removed=()):
+    owner = self._owner
+    if owner is None or owner() is None:
+      return
+    for value in removed:
+      if isinstance(value, SketchBase) and value._parent is owner:
+        object.__setattr__(value, '_parent', None)
+    for value in added:
+      setParent(value, owner)
+    owner()._listChanged(self, added, removed)
+
+  def append(self, value):
+    list.append(self, value)
+    self._changed([value])
+
+  def extend(self, values):
+    values = list(values)
+    list.extend(self, values)
+    self._changed(values)
+
+  def __iadd__(self, values):
+    self.extend(values)
+    return self
+
+  def __imul__(self, n):
+    removed = list(self)
+    list.__imul__(self, n)
+    self._changed(list(self), removed)
+    return self
+
+  def insert(self, index, value):
+    list.insert(self, index, value)
+    self._changed([value])
+
+  def remove(self, value):
+    del self[self.index(value)]
+
+  def pop(self, index=-1):
+    value = list.pop(self, index)
+    self._changed(removed=[value])
+    return value
+
+  def clear(self):
+    removed = list(self)
+    list.clear(self)
+    self._changed(removed=removed)
+
+  def __setitem__(self, index, value):
+    removed = self[index]
+    if isinstance(index, slice):
+      value = list(value)
+      list.__setitem__(self, index, value)
+      self._changed(value, removed)
+    else:
+      list.__setitem__(self, index, value)
+      self._changed([value], [removed])
+
+  def __delitem__(self, index):
+    removed = self[index]
+    list.__delitem__(self, index)
+    self._changed(removed=list(removed) if isinstance(index, slice) else [removed])
+
+  def sort(self, *args, **kwargs):
+    list.sort(self, *args, **kwargs)
+    self._changed()
+
+  def reverse(self):
+    list.reverse(self)
+    self._changed()
+
+def compileDecoder(cls):
+  """Answers a decoder function for cls, generated as Python source from the
+  cls.ATTRS table. Instead of interpreting the table for every instance (resolving
+  JSON names, testing if the method is a class or a function), the decoder
+  only holds one direct assignment for each attribute.
+  Attributes in the dictionary that are not part of ATTRS are set unchanged.
+
+  >>> decode = compileDecoder(SketchGradient)
+  >>> gradient = SketchGradient()
+  >>> decode(gradient, {'from': '{0.5, 1}', 'gradientType': '2', 'extra': 3})
+  >>> gradient._from, gradient.gradientType, gradient.extra
+  (<SketchPoint x=0.5 y=1>, 2, 3)
+  """
+  attrs = cls.ATTRS
+  # Decoding is no change of a node, so the attributes are set by
+  # object.__setattr__, without marking the node as dirty in
+  # SketchBase._setDirtyAttr. The values that are nodes or lists are linked
+  # to self, in the same way as linkValue does.
+  namespace = dict(ATTRS_KEYS=frozenset(attrs), CLEAN_ATTRS=CLEAN_ATTRS, setattr=object.__setattr__,
+    setParent=setParent, linkValue=linkValue, ref=weakref.ref, SketchList=SketchList,
+    SketchBase=SketchBase, SketchSharedBase=SketchSharedBase)
+  source = [
+    '  selfRef = ref(self)',
+    '  for name in kwargs.keys() - ATTRS_KEYS:',
+    '    value = kwargs[name]',
+    '    if name not in CLEAN_ATTRS:', # E.g. the parent is no value of self.
+    '      value = linkValue(value, selfRef)',
+    '    try:',
+    '      setattr(self, name, value)',
+    '    except AttributeError:', # No slot or property for this name.
+    '      self._setExtra(name, value)',
+  ]
+  for index, (name, (m, default)) in enumerate(attrs.items()):
+    mName = 'm%d' % index
+    defaultName = 'default%d' % index
+    namespace[mName] = m
+    namespace[defaultName] = default
+    jsonName = JSON_ATTR_NAMES.get(name, name)
+    if jsonName != name: # Valid if "_from" or "_to" are used as direct attribute names.
+      value = 'kwargs[%r] if %r in kwargs else kwargs.get(%r, %s)' % (name, name, jsonName, defaultName)
+    else:
+      value = 'kwargs.get(%r, %s)' % (name, defaultName)
+    target = 'setattr(self, %r, %%s)' % name
+    if isclass(m) and issubclass(m, SketchSharedBase):
+      # Instances made from a value are shared, instances given by the caller are kept.
+      sharedName = 'shared%d' % index
+      namespace[sharedName] = m.getShared
+      source += [
+        '  value = %s' % value,
+        '  if not isinstance(value, %s):' % mName,
+        '    if value is None or isinstance(value, dict):',
+        '      value = %s(value)' % sharedName,
+        '    else:',
+        '      value = {%r: value}' % name,
+        '  setParent(value, selfRef)',
+      ]
+      value = 'value'
+    elif isclass(m):
+      source += [
+        '  value = %s' % value,
+        '  if not isinstance(value, %s):' % mName,
+        '    if value is None:',
+        '      value = %s()' % mName,
+        '    elif isinstance(value, dict):',
+        '      value = %s(**value)' % mName,
+        '    else:',
+        '      value = {%r: value}' % name,
+        '  if value.__class__ is not dict:',
+        "    setattr(value, '_parent', selfRef)",
+      ]
+      value = 'value'
+    elif isfunction(m) and m not in SCALAR_DECODERS:
+      # Same as linkValue, for the values that the function can answer.
+      source += [
+        '  value = %s(%s)' % (mName, value),
+        '  if value.__class__ is list:',
+        '    value = SketchList(value, selfRef)',
+        '  elif isinstance(value, SketchBase):',
+        '    if isinstance(value, SketchSharedBase):',
+        '      setParent(value, selfRef)',
+        '    else:',
+        "      setattr(value, '_parent', selfRef)",
+      ]
+      value = 'value'
+    elif isfunction(m):
+      value = '%s(%s)' % (mName, value)
+    source.append('  ' + target % value)
+  source = ['def decode(self, kwargs):'] + source
+  exec(compile('\n'.join(source), '<decoder %s>' % cls.__name__, 'exec'), namespace)
+  return namespace['decode']
+
+JSON_FLUSH_SIZE = 1000 # Number of strings in a SketchJsonStream before it is written.
+
+class SketchJsonStream(list):
+  """List of the JSON strings made by the encoders of getJsonEncoder. If a
+  binary file f is defined, then the strings are written into it as UTF-8
+  bytes on flush(). The optional refs are the _ref values to write for
+  SketchMSJSONFileReference nodes, by their id."""
+  def __init__(self, f=None, refs=None):
+    list.__init__(self)
+    self.f = f
+    self.refs = refs
+
+  def flush(self):
+    if self.f is not None and self:
+      self.f.write(''.join(self).encode('utf-8'))
+      del self[:]
+
+def _encodeString(value, out):
+  out.append(encodeJsonString(value))
+  return True
+
+def _encodeInt(value, out):
+  out.append(int.__repr__(value))
+  return True
+
+def _encodeFloat(value, out):
+  """Encode the float in the same way as the json module does.
+
+  >>> out = []
+  >>> [_encodeFloat(v, out) for v in (0.5, 1e20, float('inf'), float('nan'))] and out
+  ['0.5', '1e+20', 'Infinity', 'NaN']
+  """
+  if value != value:
+    out.append('NaN')
+  elif value == float('inf'):
+    out.append('Infinity')
+  elif value == -float('inf'):
+    out.append('-Infinity')
+  else:
+    out.append(float.__repr__(value))
+  return True
+
+def _encodeBool(value, out):
+  out.append('true' if value else 'false')
+  return True
+
+def _encodeNone(value, out):
+  out.append('null')
+  return True
+
+def _encodeList(value, out):
+  """Encode the list or tuple as in SketchBase.asJson, where elements that
+  answer None for asJson() become null."""
+  out.append('[')
+  for index, e in enumerate(value):
+    if index:
+      out.append(', ')
+    if not (JSON_ENCODERS.get(e.__class__) or getJsonEncoder(e.__class__))(e, out):
+      out.append('null')
+  out.append(']')
+  return True
+
+def _encodeLayers(layers, out):
+  """Encode the layers of a SketchLayer. As nothing before them can be undone
+  anymore, the stream can be written from here."""
+  out.append('[')
+  for index, layer in enumerate(layers):
+    if index:
+      out.append(', ')
+    if not (JSON_ENCODERS.get(layer.__class__) or getJsonEncoder(layer.__class__))(layer, out):
+      out.append('null')
+    if len(out) > JSON_FLUSH_SIZE and isinstance(out, SketchJsonStream):
+      out.flush()
+  out.append(']')
+
+def _encodeAsJson(value, out):
+  """Encode the JSON of classes with their own asJson method."""
+  d = value.asJson()
+  if d is None:
+    return False
+  out.append(json.dumps(d))
+  return True
+
+def _encodeDumps(value, out):
+  out.append(json.dumps(value))
+  return True
+
+encodeJsonString = json.encoder.encode_basestring_ascii # Same as json.dumps
+
+# Class --> encoder function(value, out), that appends the JSON of value to the
+# list out. It answers False (and adds nothing), if the value is None as JSON.
+JSON_ENCODERS = {
+  str: _encodeString,
+  int: _encodeInt,
+  float: _encodeFloat,
+  bool: _encodeBool,
+  type(None): _encodeNone,
+  list: _encodeList,
+  tuple: _encodeList,
+  SketchList: _encodeList,
+}
+
+def getJsonEncoder(cls):
+  """Answers the JSON encoder function for values of cls. SketchBase classes
+  that use the default asJson method get a compiled encoder.
+
+  >>> getJsonEncoder(SketchColor) is getJsonEncoder(SketchColor)
+  True
+  >>> getJsonEncoder(SketchPoint).__name__, getJsonEncoder(dict).__name__
+  ('_encodeAsJson', '_encodeDumps')
+  """
+  encoder = JSON_ENCODERS.get(cls)
+  if encoder is None:
+    if issubclass(cls, SketchBase) and cls.asJson in (SketchBase.asJson, SketchLayer.asJson):
+      encoder = compileEncoder(cls)
+    elif hasattr(cls, 'asJson'):
+      encoder = _encodeAsJson
+    else:
+      encoder = _encodeDumps
+    JSON_ENCODERS[cls] = encoder
+  return encoder
+
+def compileEncoder(cls):
+  """Answers an encoder function for cls, generated as Python source from the
+  cls.ATTRS table, that makes the same JSON as json.dumps(self.asJson()). The
+  JSON key of every attribute is made once, instead of building a dictionary
+  for every instance.
+
+  >>> encode = compileEncoder(SketchColor)
+  >>> out = []
+  >>> encode(SketchColor(red=0.5), out)
+  True
+  >>> ''.join(out)
+  '{"red": 0.5, "green": 0, "blue": 0, "alpha": 0, "_class": "color"}'
+  """
+  namespace = dict(encoders=JSON_ENCODERS, getEncoder=getJsonEncoder, encodeLayers=_encodeLayers)
+  source = [
+    'def encode(self, out):',
+    '  mark = len(out)',
+  ]
+  isLayer = cls.asJson is SketchLayer.asJson
+  for name in cls.ATTRS:
+    key = ', %s: ' % encodeJsonString(JSON_ATTR_NAMES.get(name, name))
+    if isLayer and name == 'layers':
+      # SketchLayer.asJson replaces the value by the layers. They are always
+      # written, so the first key can be made final.
+      source += [
+        '  out.append(%r)' % key,
+        '  out[mark] = "{" + out[mark][2:]',
+        '  encodeLayers(self.layers, out)',
+      ]
+      continue
+    if name in cls.SHARED_SLOTS: # Read shared values without copying them.
+      getterName = 'getValue%d' % len(namespace)
+      namespace[getterName] = cls.SHARED_SLOTS[name].getValue
+      value = '%s(self)' % getterName
+    elif name.isidentifier() and not keyword.iskeyword(name):
+      value = 'self.%s' % name
+    else:
+      value = 'getattr(self, %r)' % name
+    source += [
+      '  value = %s' % value,
+      '  if value is not None:',
+      '    out.append(%r)' % key,
+      '    if not (encoders.get(value.__class__) or getEncoder(value.__class__))(value, out):',
+      '      del out[-1]', # Value is None as JSON, remove the key.
+    ]
+  if not (isLayer and 'layers' in cls.ATTRS):
+    source += [
+      '  if len(out) == mark:', # No attributes, then the object is None as JSON.
+      '    return False',
+      '  out[mark] = "{" + out[mark][2:]', # First key without separator.
+    ]
+  if cls.CLASS is not None:
+    source.append('  out.append(%r)' % (', "_class": %s' % encodeJsonString(cls.CLASS)))
+  if isLayer and 'layers' not in cls.ATTRS:
+    source += [
+      '  out.append(\', "layers": \')',
+      '  encodeLayers(self.layers, out)',
+    ]
+  source += [
+    '  out.append("}")',
+    '  return True',
+  ]
+  exec(compile('\n'.join(source), '<encoder %s>' % cls.__name__, 'exec'), namespace)
+  return namespace['encode']
 
 def asRect(sketchNestedPositionString):
   """type SketchNestedPositionString = string // '{{0, 0}, {75.5, 15}}'
@@ -292,6 +1305,12 @@ def asRect(sketchNestedPositionString):
   """
   if sketchNestedPositionString is None:
     return None
+  try:
+    # Fast path for the regular format '{{x, y}, {w, h}}'
+    xy, wh = sketchNestedPositionString[2:-2].split('}, {')
+    return parsePositionNumbers(xy) + parsePositionNumbers(wh)
+  except (ValueError, TypeError, OverflowError):
+    pass
   try:
     (x, y), (w, h) = POINT_PATTERN.findall(sketchNestedPositionString)
     return asNumber(x), asNumber(y), asNumber(w), asNumber(h)
@@ -299,6 +1318,117 @@ def asRect(sketchNestedPositionString):
     pass
   return None
 
+# Cache of parsed values for position strings. Sketch files repeat a small
+# number of literals (such as '{0, 0}' and '{1, 1}') very often. The cache is
+# filled until it reaches POSITION_CACHE_SIZE, so unique coordinates of large
+# files don't keep growing it.
+POSITION_CACHE_SIZE = 4096
+POSITION_CACHE = {}
+
+def parsePositionNumbers(sxy):
+  """Answers the (x, y) numbers of the 'x, y' string, in the asNumber format.
+  Raises ValueError if sxy does not contain two numbers.
+
+  >>> parsePositionNumbers('10, 0.5')
+  (10, 0.5)
+  """
+  sx, sy = sxy.split(',')
+  x = float(sx)
+  ix = int(x)
+  if ix == x:
+    x = ix
+  y = float(sy)
+  iy = int(y)
+  if iy == y:
+    y = iy
+  return x, y
+
+def parsePositionString(v):
+  """Answers the (x, y) numbers of the SketchPositionString v. Numbers that
+  are integer are answered as int, same as asNumber does.
+
+  >>> parsePositionString('{0, 0}')
+  (0, 0)
+  >>> parsePositionString('{0000021, -12345}')
+  (21, -12345)
+  >>> parsePositionString('{10.05, -1e-2}')
+  (10.05, -0.01)
+  >>> parsePositionString('{1.0,2.5}'), parsePositionString('{ -0.0, 1E3 }')
+  ((1, 2.5), (0, 1000))
+  >>> parsePositionString('{1, 2}}') # Not the fast format, parsed by pattern.
+  (1, 2)
+  >>> parsePositionString('{1, 1}') is parsePositionString('{1, 1}') # Cached
+  True
+  """
+  xy = POSITION_CACHE.get(v)
+  if xy is None:
+    try:
+      if v[0] != '{' or v[-1] != '}':
+        raise ValueError(v)
+      xy = parsePositionNumbers(v[1:-1])
+    except (ValueError, OverflowError):
+      # Fall back to the pattern for all other formats.
+      sxy = POINT_PATTERN.findall(v)
+      assert len(sxy) == 1 and len(sxy[0]) == 2, (sxy, v)
+      xy = asNumber(sxy[0][0]), asNumber(sxy[0][1])
+    if len(POSITION_CACHE) < POSITION_CACHE_SIZE:
+      POSITION_CACHE[v] = xy
+  return xy
+
+def parsePositionStrings(positionStrings, values=None):
+  """Parse all SketchPositionString in one batch. Answers the array('d') with
+  the interleaved (x, y) values. If values is defined, then the coordinates
+  are appended to that array.
+
+  >>> parsePositionStrings(['{0, 0}', '{1, 0.5}', '{-2, 3}']).tolist()
+  [0.0, 0.0, 1.0, 0.5, -2.0, 3.0]
+  >>> values = array('d', [9])
+  >>> parsePositionStrings(['{1e2, -4}'], values) is values, values.tolist()
+  (True, [9.0, 100.0, -4.0])
+  >>> len(parsePositionStrings([]))
+  0
+  """
+  if values is None:
+    values = array('d')
+  cache = POSITION_CACHE
+  for v in positionStrings:
+    xy = cache.get(v)
+    if xy is None:
+      xy = parsePositionString(v)
+    values.extend(xy)
+  return values
+
+def isPositionString(v):
+  """Answers if v is a string in the SketchPositionString format '{x, y}'.
+
+  >>> isPositionString('{0.5, 1}'), isPositionString('{{0, 0}, {1, 1}}'), isPositionString('Text')
+  (True, False, False)
+  """
+  return isinstance(v, str) and v.startswith('{') and v.endswith('}') and \
+    v.count('{') == 1 and v.count(',') == 1
+
+def findPositionStrings(d, found=None):
+  """Answers the list of all SketchPositionString values in the JSON of
+  d (e.g. a complete page), in the order of the JSON tree.
+
+  >>> page = dict(layers=[dict(points=[dict(point='{0, 1}', curveTo='{0.5, 1}')])], name='{1, 2}!')
+  >>> findPositionStrings(page)
+  ['{0, 1}', '{0.5, 1}']
+  >>> parsePositionStrings(findPositionStrings(page)).tolist()
+  [0.0, 1.0, 0.5, 1.0]
+  """
+  if found is None:
+    found = []
+  if isinstance(d, dict):
+    d = d.values()
+  for v in d:
+    if isinstance(v, str):
+      if isPositionString(v):
+        found.append(v)
+    elif isinstance(v, (dict, list)):
+      findPositionStrings(v, found)
+  return found
+
 def asColorNumber(v):
   try:
     return min(1, max(0, float(v)))
@@ -358,6 +1488,9 @@ def asDict(v):
 def asList(v):
   return list(v)
 
+# Decoder functions that answer a value that is no node or list.
+SCALAR_DECODERS = frozenset((asColorNumber, asNumber, asInt, asBool, asId, asString, asDict))
+
 def FontList(v):
   return []
 
@@ -380,11 +1513,13 @@ def SketchPositionString(v):
   <SketchPoint x=21 y=-12345>
   >>> SketchPositionString('{10.05, -10.66}')
   <SketchPoint x=10.05 y=-10.66>
-
+  >>> SketchPositionString(SketchPoint(x=1, y=2)) # Already a point, keep it.
+  <SketchPoint x=1 y=2>
   """
-  sxy = POINT_PATTERN.findall(v)
-  assert len(sxy) == 1 and len(sxy[0]) == 2, (sxy, v)
-  return SketchPoint(x=asNumber(sxy[0][0]), y=asNumber(sxy[0][1]))
+  if isinstance(v, SketchPoint):
+    return v
+  x, y = parsePositionString(v)
+  return SketchPoint(x, y)
 
 class SketchPoint(SketchBase):
   """Interprets the {x,y} string into a point2D.
@@ -398,13 +1533,19 @@ class SketchPoint(SketchBase):
   """
   REPR_ATTRS = ['x', 'y'] # Attributes to be show in __repr__
   CLASS = 'point'
-
-  def __init__(self, **kwargs):
-    self._class = self.CLASS
-
-    self.x = self.y = 0
+  __slots__ = ('x', 'y')
+
+  def __init__(self, x=0, y=0, **kwargs):
+    setattr = object.__setattr__ # A new point is no change.
+    setattr(self, '_class', self.CLASS)
+    setattr(self, '_parent', None)
+    setattr(self, 'x', x)
+    setattr(self, 'y', y)
     for attrName, value in kwargs.items():
-      setattr(self, attrName, value)
+      try:
+        setattr(self, attrName, value)
+      except AttributeError:
+        self._setExtra(attrName, value)
 
   def asJson(self):
     return '{%s, %s}' % (self.x, self.y)
@@ -434,6 +1575,202 @@ class SketchCurvePoint(SketchBase):
     'point': (SketchPositionString, POINT_ORIGIN),
   }
 
+def asPointString(x, y):
+  """Answers the SketchPositionString of the (x, y) values, with the same
+  number format as SketchPoint.asJson.
+
+  >>> asPointString(1.0, 0.25)
+  '{1, 0.25}'
+  """
+  if x == int(x):
+    x = int(x)
+  if y == int(y):
+    y = int(y)
+  return '{%s, %s}' % (x, y)
+
+class SketchPackedCurvePoints:
+  """Packed alternative for the list of SketchCurvePoint instances of shape
+  layers. Instead of a Python object for every point and every coordinate,
+  the values are kept in flat array('d') buffers, x and y interleaved, with
+  separate arrays for the curve modes and flags. Decoding reads the JSON
+  directly into the arrays and asJson answers the same list of dictionaries
+  as the SketchCurvePoint instances would do.
+
+  >>> curvePoints = [dict(point='{0, 0}', curveFrom='{0, 0.5}', curveTo='{0, 0}', hasCurveFrom=True),
+  ...   dict(point='{1, 0.25}', curveFrom='{1, 0}', curveTo='{1, 0}', curveMode=2)]
+  >>> points = SketchPackedCurvePoints(curvePoints)
+  >>> len(points), points.points.tolist()
+  (2, [0.0, 0.0, 1.0, 0.25])
+  >>> points[0]
+  <SketchCurvePoint>
+  >>> points[1].point, points[0].curveFrom, points[0].hasCurveFrom
+  (<SketchPoint x=1 y=0.25>, <SketchPoint x=0 y=0.5>, True)
+  >>> points.asJson() == [SketchCurvePoint(**d).asJson() for d in curvePoints]
+  True
+  >>> points == SketchCurvePointList(curvePoints)
+  True
+  >>> points.bounds()
+  (0.0, 0.0, 1.0, 0.25)
+  >>> points.transform(2, 0, 0, 2, 10, 20) # Scale by 2 and move
+  >>> points.bounds()
+  (10.0, 20.0, 12.0, 20.5)
+  """
+  # JSON name of the point attributes and the name of their array.
+  POINTS_ATTRS = (('point', 'points'), ('curveFrom', 'curveFrom'), ('curveTo', 'curveTo'))
+  _owner = None # Weakref to the shape that holds the points, see setParent()
+
+  def __init__(self, curvePoints=None):
+    self.points = array('d')
+    self.curveFrom = array('d')
+    self.curveTo = array('d')
+    self.cornerRadius = array('d')
+    self.curveMode = array('b')
+    self.hasCurveFrom = array('b')
+    self.hasCurveTo = array('b')
+    self.do_objectIDs = None # Only a list if any of the curve points has an id.
+    for curvePoint in curvePoints or ():
+      if isinstance(curvePoint, SketchCurvePoint):
+        curvePoint = curvePoint.asJson()
+      self.append(curvePoint)
+
+  def append(self, d):
+    """Append the JSON dictionary d of a curve point to the arrays."""
+    for name, arrayName in self.POINTS_ATTRS:
+      xy = d.get(name, POINT_ORIGIN)
+      if isinstance(xy, SketchPoint):
+        xy = xy.x, xy.y
+      else:
+        xy = parsePositionString(xy)
+      getattr(self, arrayName).extend(xy)
+    self.cornerRadius.append(float(d.get('cornerRadius', 0)))
+    self.curveMode.append(int(d.get('curveMode', 1)))
+    self.hasCurveFrom.append(bool(d.get('hasCurveFrom', False)))
+    self.hasCurveTo.append(bool(d.get('hasCurveTo', False)))
+    do_objectID = d.get('do_objectID')
+    if do_objectID is not None and self.do_objectIDs is None:
+      self.do_objectIDs = [None] * (len(self.curveMode) - 1)
+    if self.do_objectIDs is not None:
+      self.do_objectIDs.append(do_objectID)
+    self.changed()
+
+  def changed(self):
+    """Mark the shape that holds the points as changed. The methods that change
+    the points call this, call it after changing the arrays directly, e.g.
+    through asArrays()."""
+    owner = self._owner
+    if owner is not None and owner() is not None:
+      owner()._changed()
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state.pop('_owner', None) # Set again by the shape.
+    return state
+
+  def __len__(self):
+    return len(self.curveMode)
+
+  def copy(self):
+    """Answers a copy of self, with its own arrays.
+
+    >>> points = SketchPackedCurvePoints([dict(point='{1, 0.5}')])
+    >>> copy = points.copy()
+    >>> copy == points, copy.points is points.points
+    (True, False)
+    """
+    points = SketchPackedCurvePoints.__new__(SketchPackedCurvePoints)
+    for name in ('points', 'curveFrom', 'curveTo', 'cornerRadius', 'curveMode', 'hasCurveFrom', 'hasCurveTo'):
+      setattr(points, name, getattr(self, name)[:])
+    points.do_objectIDs = None
+    if self.do_objectIDs is not None:
+      points.do_objectIDs = list(self.do_objectIDs)
+    return points
+
+  def __getitem__(self, index):
+    """Answers a new SketchCurvePoint instance with the values at index.
+    Note that changing the instance does not alter the packed values."""
+    if index < 0:
+      index += len(self)
+    i = 2 * index
+    do_objectID = None
+    if self.do_objectIDs is not None:
+      do_objectID = self.do_objectIDs[index]
+    return SketchCurvePoint(do_objectID=do_objectID,
+      cornerRadius=self.cornerRadius[index],
+      curveMode=self.curveMode[index],
+      hasCurveFrom=bool(self.hasCurveFrom[index]),
+      hasCurveTo=bool(self.hasCurveTo[index]),
+      point=SketchPoint(x=asNumber(self.points[i]), y=asNumber(self.points[i+1])),
+      curveFrom=SketchPoint(x=asNumber(self.curveFrom[i]), y=asNumber(self.curveFrom[i+1])),
+      curveTo=SketchPoint(x=asNumber(self.curveTo[i]), y=asNumber(self.curveTo[i+1])))
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self[index]
+
+  def __eq__(self, points):
+    if isinstance(points, SketchPackedCurvePoints):
+      return self.asJson() == points.asJson()
+    return list(self) == points
+
+  def __ne__(self, points):
+    return not (self == points)
+
+  def __repr__(self):
+    return '<%s n=%d>' % (self.__class__.__name__, len(self))
+
+  def asJson(self):
+    l = []
+    points, curveFrom, curveTo = self.points, self.curveFrom, self.curveTo
+    for index in range(len(self)):
+      i = 2 * index
+      d = {}
+      if self.do_objectIDs is not None and self.do_objectIDs[index] is not None:
+        d['do_objectID'] = self.do_objectIDs[index]
+      d['cornerRadius'] = asNumber(self.cornerRadius[index])
+      d['curveFrom'] = asPointString(curveFrom[i], curveFrom[i+1])
+      d['curveMode'] = self.curveMode[index]
+      d['curveTo'] = asPointString(curveTo[i], curveTo[i+1])
+      d['hasCurveFrom'] = bool(self.hasCurveFrom[index])
+      d['hasCurveTo'] = bool(self.hasCurveTo[index])
+      d['point'] = asPointString(points[i], points[i+1])
+      d['_class'] = SketchCurvePoint.CLASS
+      l.append(d)
+    return l
+
+  def asArrays(self):
+    """Answers the (points, curveFrom, curveTo) as NumPy arrays of shape (n, 2),
+    sharing their memory with the packed arrays. Raises ImportError if NumPy
+    is not installed."""
+    if numpy is None:
+      raise ImportError('SketchPackedCurvePoints.asArrays needs NumPy')
+    return tuple(numpy.frombuffer(getattr(self, arrayName), dtype=numpy.float64).reshape(-1, 2)
+      for name, arrayName in self.POINTS_ATTRS)
+
+  def bounds(self):
+    """Answers the (minX, minY, maxX, maxY) of the points, or None if empty."""
+    if not len(self):
+      return None
+    xs = self.points[0::2]
+    ys = self.points[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+  def transform(self, a, b, c, d, tx, ty):
+    """Apply the affine transformation (a, b, c, d, tx, ty) to all points and
+    control points: x' = a*x + c*y + tx, y' = b*x + d*y + ty"""
+    if numpy is not None:
+      for xy in self.asArrays():
+        x = xy[:,0].copy()
+        xy[:,0] = a*x + c*xy[:,1] + tx
+        xy[:,1] = b*x + d*xy[:,1] + ty
+    else:
+      for name, arrayName in self.POINTS_ATTRS:
+        values = getattr(self, arrayName)
+        for i in range(0, len(values), 2):
+          x, y = values[i], values[i+1]
+          values[i] = a*x + c*y + tx
+          values[i+1] = b*x + d*y + ty
+    self.changed()
+
 class SketchImageCollection(SketchBase):
   """
   _class: 'imageCollection',
@@ -444,7 +1781,193 @@ class SketchImageCollection(SketchBase):
     'images': (asDict, {})
   }
 
-class SketchColor(SketchBase):
+SHARED_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+def _sharedKey(value):
+  """Answers a hashable key for the JSON value, or None if the value holds
+  other objects, such as SketchBase instances, that cannot be shared by value.
+  Numbers keep their type, so 1 and 1.0 have different keys.
+
+  >>> _sharedKey(dict(red=1, alpha=1.0)) == _sharedKey(dict(red=1, alpha=1.0))
+  True
+  >>> _sharedKey(dict(red=1)) == _sharedKey(dict(red=1.0))
+  False
+  >>> _sharedKey(dict(attributes=SketchFontDescriptorAttributes())) is None
+  True
+  """
+  cls = value.__class__
+  if cls is dict:
+    key = []
+    for name, v in value.items():
+      v = _sharedKey(v)
+      if v is None:
+        return None
+      key += (name, v)
+    return tuple(key)
+  if cls is list:
+    key = [list]
+    for v in value:
+      v = _sharedKey(v)
+      if v is None:
+        return None
+      key.append(v)
+    return tuple(key)
+  if cls in SHARED_SCALARS:
+    return cls, value
+  return None
+
+class SketchSharedStyles:
+  """Table of the shared instances of the SketchSharedBase classes, by class
+  and the value of the dictionary they are made from. Documents use a handful
+  of distinct colors, context settings, fonts and paragraph styles thousands
+  of times, so decoding them as one shared instance per value saves most of
+  their objects. The table keeps weak references, so instances that are no
+  longer used by any document are removed.
+  A table is only used while it is made active by useSharedStyles(table),
+  e.g. by SketchAppReader(shareStyles=True). Otherwise a new instance is
+  made for each value.
+
+  >>> shared = SketchSharedStyles()
+  >>> c1 = shared.get(SketchColor, dict(red=1))
+  >>> c2 = shared.get(SketchColor, dict(red=0.5))
+  >>> c1 is shared.get(SketchColor, dict(red=1)), c1 is c2
+  (True, False)
+  >>> c1.isShared, len(shared)
+  (True, 2)
+  >>> del c2
+  >>> len(shared) # Unused instances are removed from the table.
+  1
+  """
+  def __init__(self):
+    self.instances = weakref.WeakValueDictionary()
+
+  def __len__(self):
+    return len(self.instances)
+
+  def clear(self):
+    self.instances.clear()
+
+  def get(self, cls, d=None):
+    """Answers the shared instance of cls with the values of dictionary d.
+    Answers a new instance if d cannot be used as key."""
+    if d is None:
+      d = {}
+    key = _sharedKey(d)
+    if key is None:
+      return cls(**d)
+    key = cls, key
+    instance = self.instances.get(key)
+    if instance is None:
+      instance = cls(**d)
+      instance._shared = True
+      self.instances[key] = instance
+    return instance
+
+# The SketchSharedStyles table that is used while decoding, set by useSharedStyles.
+ACTIVE_SHARED_STYLES = contextvars.ContextVar('ACTIVE_SHARED_STYLES', default=None)
+
+@contextmanager
+def useSharedStyles(sharedStyles):
+  """Context manager that shares the SketchSharedBase instances that are
+  decoded in its block through the SketchSharedStyles table sharedStyles. If
+  sharedStyles is None, then nothing is shared.
+
+  >>> shared = SketchSharedStyles()
+  >>> with useSharedStyles(shared):
+  ...   fill = SketchFill(color=dict(red=1))
+  >>> fill.getValue('color').isShared, len(shared)
+  (True, 2)
+  """
+  token = ACTIVE_SHARED_STYLES.set(sharedStyles)
+  try:
+    yield sharedStyles
+  finally:
+    ACTIVE_SHARED_STYLES.reset(token)
+
+class SketchSharedBase(SketchBase):
+  """Base of the style classes that can be shared by value, such as
+  SketchColor. Instances that are decoded from a dictionary of their owner
+  inside useSharedStyles(table) are shared through the table. A shared
+  instance cannot be changed: reading it as attribute of its owner answers
+  a private copy that replaces it first (copy-on-write, see
+  SketchSharedAttr). Instances that are made directly, e.g.
+  SketchColor(red=1), are never shared.
+
+  >>> fill1 = SketchFill(color=dict(red=1, alpha=1))
+  >>> fill2 = SketchFill(color=dict(red=1, alpha=1))
+  >>> fill1.color is fill2.color, fill1.color.isShared # Sharing is off by default.
+  (False, False)
+  >>> with useSharedStyles(SketchSharedStyles()):
+  ...   fill1 = SketchFill(color=dict(red=1, alpha=1))
+  ...   fill2 = SketchFill(color=dict(red=1, alpha=1))
+  >>> fill1.getValue('color') is fill2.getValue('color'), fill1.getValue('color').isShared
+  (True, True)
+  >>> fill1.getValue('color').red = 0
+  Traceback (most recent call last):
+  ...
+  AttributeError: Shared SketchColor cannot be changed, change it as attribute of its owner
+  >>> fill1.color.red = 0
+  >>> fill1.color, fill2.getValue('color')
+  (<SketchColor red=0 green=0 blue=0 alpha=1>, <SketchColor red=1 green=0 blue=0 alpha=1>)
+  >>> fill1.color.isShared, fill1.color.parent is fill1, fill2.getValue('color').isShared
+  (False, True, True)
+  >>> color = SketchColor(blue=1)
+  >>> SketchFill(color=color).color is color, color.isShared
+  (True, False)
+  """
+  __slots__ = ('_shared',)
+
+  def __init__(self, **kwargs):
+    object.__setattr__(self, '_shared', False)
+    SketchBase.__init__(self, **kwargs)
+
+  def _setSharedAttr(self, name, value):
+    if self._shared:
+      raise AttributeError('Shared %s cannot be changed, change it as attribute of its owner' % self.__class__.__name__)
+    SketchBase._setDirtyAttr(self, name, value)
+  __setattr__ = _setSharedAttr
+
+  def __setstate__(self, state):
+    object.__setattr__(self, '_shared', False)
+    SketchBase.__setstate__(self, state)
+
+  @classmethod
+  def getShared(cls, d=None):
+    """Answers the shared instance of cls for the values in dictionary d, if
+    a SketchSharedStyles table is active. Otherwise answers a new instance."""
+    sharedStyles = ACTIVE_SHARED_STYLES.get()
+    if sharedStyles is None:
+      return cls(**(d or {}))
+    return sharedStyles.get(cls, d)
+
+  def setAttributes(self, **kwargs):
+    if self._shared:
+      raise AttributeError('Shared %s cannot be changed, change it as attribute of its owner' % self.__class__.__name__)
+    SketchBase.setAttributes(self, **kwargs)
+
+  def _get_isShared(self):
+    return self._shared
+  isShared = property(_get_isShared)
+
+  def copy(self):
+    """Answers a copy of self that is not shared and can be changed. Shared
+    attribute values of self, such as the attributes of a font descriptor,
+    are kept shared in the copy.
+
+    >>> color = SketchSharedStyles().get(SketchColor, dict(green=1))
+    >>> copy = color.copy()
+    >>> copy == color, copy.isShared
+    (True, False)
+    """
+    state = self.__getstate__()
+    state.pop('_shared', None)
+    if state.get('_extra'):
+      state['_extra'] = dict(state['_extra'])
+    copy = self.__class__.__new__(self.__class__)
+    copy.__setstate__(state)
+    return copy
+
+class SketchColor(SketchSharedBase):
   """
   _class: 'color',
   do_objectID: UUID,
@@ -584,7 +2107,7 @@ class SketchGradient(SketchBase):
     '_to': (SketchPositionString, POINT_ORIGIN),
   }
 
-class SketchGraphicsContextSettings(SketchBase):
+class SketchGraphicsContextSettings(SketchSharedBase):
   """
   _class: 'graphicsContextSettings',
   blendMode: number,
@@ -633,6 +2156,22 @@ class SketchMSJSONFileReference(SketchBase):
     '_ref': (asString, ''),
   }
 
+def _encodeFileReference(value, out):
+  """Encode the SketchMSJSONFileReference value, with the _ref from out.refs
+  if it is there, e.g. the name of the image as stored by SketchAppWriter.
+
+  >>> fileRef = SketchMSJSONFileReference(_ref='images/a.png')
+  >>> json.loads(fileRef.asJsonBytes())['_ref'], json.loads(fileRef.asJsonBytes({id(fileRef): 'images/b.png'}))['_ref']
+  ('images/a.png', 'images/b.png')
+  >>> fileRef._ref
+  'images/a.png'
+  """
+  refs = getattr(out, 'refs', None)
+  ref = refs.get(id(value)) if refs else None
+  if ref is not None:
+    value = SketchMSJSONFileReference(_ref_class=value._ref_class, _ref=ref)
+  return encodeFileReference(value, out)
+
 def SketchFillList(sketchFills):
   l = []
   for fill in sketchFills:
@@ -745,6 +2284,14 @@ class SketchRect(SketchBase):
     'height': (asNumber, 100),
     'constrainProportions': (asBool, False),
   }
+  def _changed(self):
+    """Changing the frame of a layer changes the geometry of the layer."""
+    layer = self.parent
+    if layer is not None and getattr(layer, 'frame', None) is self:
+      layer._geometryChanged()
+    else:
+      SketchBase._changed(self)
+
   def __getitem__(self, i):
     return (self.x, self.y, self.w, self.h)[i]
 
@@ -826,8 +2373,22 @@ def SketchShadowsList(sketchShadows):
     return l
   return None
 
-class SketchStyle(SketchBase):
-  """
+class SketchStyle(SketchSharedBase):
+  """A style can be shared by many layers, as SketchApi.rects does for the
+  shapes with the same fill. Unlike the other SketchSharedBase classes, a
+  style holds nodes and lists, so its copy is deep. Styles are never shared
+  by value when decoding: they have their own do_objectID.
+
+  >>> style = SketchStyle()
+  >>> style.fills = [SketchFill()]
+  >>> style._shared = True
+  >>> group1, group2 = SketchShapeGroup(style=style), SketchShapeGroup(style=style)
+  >>> group1.getValue('style') is group2.getValue('style')
+  True
+  >>> group1.style.fills[0].color.red = 1
+  >>> group1.style.parent is group1, group1.style.fills[0].color.red, style.fills[0].color.red
+  (True, 1, 0)
+
   _class: 'style',
   + do_objectID: UUID,
   blur: ?[SketchBlur],
@@ -859,6 +2420,18 @@ class SketchStyle(SketchBase):
     'windingRule': (asInt, 1)
   }
 
+  @classmethod
+  def getShared(cls, d=None):
+    """Answers a new instance for the values in dictionary d, decoded styles
+    are not shared."""
+    return cls(**(d or {}))
+
+  def copy(self):
+    """Answers a deep copy of self, that is not shared and can be changed."""
+    copy = pickle.loads(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+    object.__setattr__(copy, '_shared', False)
+    return copy
+
 class SketchSharedStyle(SketchBase):
   """
   _class: 'sharedStyle',
@@ -984,7 +2557,7 @@ class SketchCreated(SketchBase):
     'compatibilityVersion': (asInt, 99)
   }
 
-class SketchFontDescriptorAttributes(SketchBase):
+class SketchFontDescriptorAttributes(SketchSharedBase):
   """
   name: string
   size: number
@@ -995,7 +2568,7 @@ class SketchFontDescriptorAttributes(SketchBase):
     'size': (asNumber, DEFAULT_FONTSIZE),
   }
 
-class SketchFontDescriptor(SketchBase):
+class SketchFontDescriptor(SketchSharedBase):
   """
   _class: 'fontDescriptor',
   attributes: SketchFontDescriptorAttributes
@@ -1005,7 +2578,7 @@ class SketchFontDescriptor(SketchBase):
     'attributes': (SketchFontDescriptorAttributes, {})
   }
 
-class SketchParagraphStyle(SketchBase):
+class SketchParagraphStyle(SketchSharedBase):
   """
   _class: 'paragraphStyle',
   alignment: number,
@@ -1137,18 +2710,173 @@ class SketchText(SketchBase):
     'textBehaviour': (asInt, 0),
   }
 
+def getTreeOrder(layer):
+  """Answers the list of the positions of the parents of layer and of layer
+  itself in their parent, starting with the position of the page in its
+  SketchFile, as key to sort layers in reading order.
+
+  >>> page = SketchPage()
+  >>> artboard = SketchArtboard()
+  >>> page.extend([SketchArtboard(), artboard])
+  >>> group = SketchGroup()
+  >>> artboard.append(group)
+  >>> getTreeOrder(group), getTreeOrder(page)
+  ([1, 0], [])
+  """
+  order = []
+  parent = getattr(layer, 'parent', None)
+  while isinstance(parent, SketchLayer):
+    for position, child in enumerate(parent.layers):
+      if child is layer:
+        break
+    else:
+      position = len(parent.layers)
+    order.append(position)
+    layer = parent
+    parent = getattr(layer, 'parent', None)
+  if isinstance(parent, SketchFile):
+    pageIds = list(parent.pages)
+    pageId = getattr(layer, 'do_objectID', None)
+    order.append(pageIds.index(pageId) if pageId in parent.pages else len(pageIds))
+  order.reverse()
+  return order
+
+def walkLayers(roots, order=WALK_PRE, prune=None):
+  """Generator of (depth, parent, layer) tuples for the (depth, parent, layer)
+  items in roots and all layers in them, depth first without recursion, so
+  deep nesting does not hit the recursion limit. In WALK_PRE order a layer
+  comes before its layers, in WALK_POST order after them. If
+  prune(depth, parent, layer) answers True, then the layers inside layer are
+  skipped, the layer itself is still yielded. No list of results is built,
+  so iterating can stop early.
+
+  >>> page = SketchPage(name='Page')
+  >>> artboard = SketchArtboard(name='Board')
+  >>> page.append(artboard)
+  >>> group = SketchGroup(name='Group')
+  >>> artboard.append(group)
+  >>> group.append(SketchRectangle(name='Rect'))
+  >>> artboard.append(SketchOval(name='Oval'))
+  >>> [(depth, layer.name) for depth, parent, layer in page.walk()]
+  [(0, 'Page'), (1, 'Board'), (2, 'Group'), (3, 'Rect'), (2, 'Oval')]
+  >>> [layer.name for depth, parent, layer in page.walk(WALK_POST)]
+  ['Rect', 'Group', 'Oval', 'Board', 'Page']
+  >>> [layer.name for depth, parent, layer in page.walk(prune=lambda depth, parent, layer: layer is group)]
+  ['Page', 'Board', 'Group', 'Oval']
+  >>> next(page.iterLayers(SketchOval)).parent is artboard
+  True
+  >>> layer = page
+  >>> for n in range(2000):
+  ...   child = SketchGroup(name='Deep')
+  ...   layer.append(child)
+  ...   layer = child
+  >>> max(depth for depth, parent, layer in page.walk())
+  2000
+  """
+  if order not in (WALK_PRE, WALK_POST):
+    raise ValueError('Walk order "%s" should be "%s" or "%s"' % (order, WALK_PRE, WALK_POST))
+  post = order == WALK_POST
+  for root in roots:
+    stack = [(root, False)]
+    while stack:
+      item, expanded = stack.pop()
+      depth, parent, layer = item
+      if expanded:
+        yield item # Post order, all layers inside are done.
+        continue
+      isParent = isinstance(layer, SketchLayer) and (prune is None or not prune(depth, parent, layer))
+      if not post or not isParent:
+        yield item
+      if isParent:
+        if post:
+          stack.append((item, True))
+        depth += 1
+        for child in reversed(layer.layers):
+          if isinstance(child, SketchBase):
+            stack.append(((depth, layer, child), False))
+
 class SketchLayer(SketchBase):
-  """Abstract base layer class if there is an "self.layers" attributes."""
-  def __init__(self, **kwargs):
+  """Abstract base layer class if there is an "self.layers" attributes.
+  If packPoints is True, then shape layers in self.layers (recursively) keep
+  their curve points as SketchPackedCurvePoints."""
+  __slots__ = ('layers', '__dict__')
+  _dirty = False # Set to True in an instance if the layer changed.
+  _hashes = None # Cached result of getHashes(), cleared if the layer changes.
+  _spatialIndex = None # Cached SketchSpatialIndex, see getSpatialIndex()
+  _geometry = None # Cached SketchGeometry, see getGeometry()
+  _uncached = False # Set to True by markDirty() if self and its parents have no cached values.
+
+  def __init__(self, packPoints=False, **kwargs):
     SketchBase.__init__(self, **kwargs)
-    self._class = self.CLASS
-    self.layers = [] # List of Sketch element instances.
+    layers = [] # List of Sketch element instances.
     for layerDict in kwargs.get('layers', []):
       # Create new layer
       if not layerDict['_class'] in SKETCHLAYER_PY:
         print('SketchLayer: Layer class "%s" not implemented' % layerDict['_class'])
       else:
-        self.layers.append(SKETCHLAYER_PY[layerDict['_class']](**layerDict))
+        layerClass = SKETCHLAYER_PY[layerDict['_class']]
+        if packPoints and issubclass(layerClass, (SketchLayer, SketchShape)):
+          layer = layerClass(packPoints=packPoints, **layerDict)
+        else:
+          layer = layerClass(**layerDict)
+        layers.append(layer)
+    # The layers get self as parent.
+    object.__setattr__(self, 'layers', SketchList(layers, weakref.ref(self)))
+
+  def _setLayerAttr(self, name, value):
+    """The __setattr__ of layers. Setting self.layers is the same as replacing
+    all layers in the list."""
+    removed = None
+    if name == 'layers':
+      try:
+        removed = list(self.layers)
+      except AttributeError: # Not set yet, e.g. while decoding.
+        pass
+    SketchBase._setDirtyAttr(self, name, value)
+    if removed is not None:
+      self._listChanged(self.layers, list(self.layers), removed)
+  __setattr__ = _setLayerAttr
+
+  def _listChanged(self, values, added, removed):
+    """Keep the index of the SketchFile and the spatial indexes of self and
+    its parents up to date, if layers are added to or removed from self.layers."""
+    if values is not self.layers:
+      self._changed()
+      return
+    self.markDirty(added, removed) # Also updates the spatial indexes of self and its parents.
+    index = getattr(self.root, '_index', None)
+    if index is not None: # Keep the index of the SketchFile up to date.
+      for layer in removed:
+        index.remove(layer)
+      for layer in added:
+        index.add(layer, self)
+      if not added and not removed: # Sorted or reversed.
+        index.reorder()
+
+  def __getstate__(self):
+    state = SketchBase.__getstate__(self)
+    state.pop('_spatialIndex', None) # Rebuilt on first use.
+    state.pop('_geometry', None)
+    return state
+
+  def getHashes(self):
+    """Answers the cached (contentDigest, fullDigest) of self. The cache is
+    cleared by markDirty() when self or one of its layers changes.
+
+    >>> page = SketchPage()
+    >>> page.append(SketchArtboard())
+    >>> hashes = page.getHashes()
+    >>> page.getHashes() is hashes
+    True
+    >>> page.layers[0].name = 'Board'
+    >>> page.getHashes() is hashes, page.getHashes() == hashes
+    (False, False)
+    """
+    hashes = self._hashes
+    if hashes is None:
+      hashes = self._hashes = SketchBase.getHashes(self)
+      self.__dict__.pop('_uncached', None) # See markDirty()
+    return hashes
 
   def __getitem__(self, layerIndex):
     """In case the layer has layers, then answer them by index."""
@@ -1159,21 +2887,150 @@ class SketchLayer(SketchBase):
     return len(self.layers)
 
   def append(self, layer):
-    """Add layer to self.layers and set layer.parent to self.
+    """Add layer to self.layers and set layer.parent to self, see self.extend.
     TODO: If layer.parent is already set, then remove it from its parent
     TODO: If layer is already in self.layers, then move it to end of the list.
     """
-    assert isinstance(layer, SketchBase)
-    self.layers.append(layer)
-    layer.parent = self
+    self.extend([layer])
+
+  def extend(self, layers):
+    """Add all layers to self.layers and set their parent to self. The
+    SketchList of self.layers marks self as changed (only once for all
+    layers) and updates the index and spatial indexes.
+
+    >>> page = SketchPage()
+    >>> artboard = SketchArtboard()
+    >>> page.append(artboard)
+    >>> page.markClean()
+    >>> artboard.extend([SketchRectangle(), SketchOval()])
+    >>> [layer.parent is artboard for layer in artboard.layers], page.isDirty
+    ([True, True], True)
+    """
+    layers = list(layers)
+    for layer in layers:
+      assert isinstance(layer, SketchBase)
+    self.layers.extend(layers)
+
+  def getGeometry(self):
+    """Answers the SketchGeometry of self and the layers in it, computing it
+    on first use. Changing a layer (e.g. layer.frame.x or layer.rotation)
+    or adding a layer clears the cached geometry of its parents. The
+    geometry is computed again if the transform of the parents of self
+    changed.
+
+    >>> page = SketchPage()
+    >>> artboard = SketchArtboard(frame=SketchRect(x=100, y=100))
+    >>> page.append(artboard)
+    >>> geometry = page.getGeometry()
+    >>> page.getGeometry() is geometry, geometry.getBounds(artboard)
+    (True, (100.0, 100.0, 100.0, 100.0))
+    >>> artboard.rotation = 45
+    >>> page.getGeometry() is geometry
+    False
+    >>> geometry = artboard.getGeometry()
+    >>> round(geometry.getBounds(artboard)[0])
+    79
+    >>> page.frame.x = 10 # Moves the artboard, not cleared in its geometry.
+    >>> artboard.getGeometry() is geometry, round(artboard.getGeometry().getBounds(artboard)[0])
+    (False, 89)
+    """
+    geometry = self._geometry
+    if geometry is None or geometry.rootTransform != getAbsoluteTransform(self.parent):
+      geometry = self._geometry = SketchGeometry(self)
+    return geometry
+
+  def _get_absoluteBounds(self):
+    """Answers the (x, y, w, h) of the bounding box of self on the page,
+    including the rotation and flips of self and its parents. Uses the
+    cached geometry of the page.
+
+    >>> page = SketchPage()
+    >>> artboard = SketchArtboard(frame=SketchRect(x=100, y=100, width=200, height=100))
+    >>> page.append(artboard)
+    >>> group = SketchGroup(frame=SketchRect(x=0, y=0, width=100, height=50), rotation=90)
+    >>> artboard.append(group)
+    >>> [round(v) for v in group.absoluteBounds]
+    [125, 75, 50, 100]
+    """
+    return getAbsoluteBounds(self)
+  absoluteBounds = property(_get_absoluteBounds)
+
+  def getSpatialIndex(self):
+    """Answers the SketchSpatialIndex of the layers in self, building it on
+    first use. Added and removed layers and changes of the frame of layers
+    in self update the index. It is built again if the origin of self moved.
+
+    >>> page = SketchPage()
+    >>> page.getSpatialIndex() is page.getSpatialIndex()
+    True
+    >>> artboard = SketchArtboard(frame=SketchRect(x=10, y=20))
+    >>> page.append(artboard)
+    >>> page.getSpatialIndex().hitTest(50, 50)
+    [<SketchArtboard name=Artboard w=100 h=100>]
+    >>> rectangle = SketchRectangle(frame=SketchRect(x=0, y=0, width=10, height=10))
+    >>> artboard.append(rectangle)
+    >>> index = artboard.getSpatialIndex()
+    >>> page.getSpatialIndex().hitTest(15, 25), index.hitTest(15, 25)
+    ([<SketchArtboard name=Artboard w=100 h=100>, <SketchRectangle name=Rectangle>], [<SketchRectangle name=Rectangle>])
+    >>> rectangle.frame.x = 50
+    >>> page.getSpatialIndex().hitTest(15, 25), index.hitTest(15, 25)
+    ([<SketchArtboard name=Artboard w=100 h=100>], [])
+    >>> numpy is None or page.getSpatialIndex()._getArray()[-1].tolist() == [60, 20, 70, 30] # Vectorized bounds.
+    True
+    >>> artboard.frame.x = 0
+    >>> artboard.getSpatialIndex().hitTest(55, 25), artboard.getSpatialIndex() is index
+    ([<SketchRectangle name=Rectangle>], False)
+    """
+    spatialIndex = self._spatialIndex
+    if spatialIndex is None or spatialIndex.origin != getAbsoluteOrigin(self):
+      spatialIndex = self._spatialIndex = SketchSpatialIndex(self)
+    return spatialIndex
+
+  def _get_isDirty(self):
+    """Answers if self or any of its layers changed since reading or saving.
+
+    >>> page = SketchPage()
+    >>> page.isDirty
+    False
+    >>> page.append(SketchArtboard())
+    >>> page.isDirty
+    True
+    >>> page.markClean()
+    >>> page.isDirty, page.layers[0].isDirty
+    (False, False)
+    >>> page.layers[0].setAttributes(name='Board')
+    >>> page.isDirty
+    True
+    """
+    return self._dirty
+  isDirty = property(_get_isDirty)
+
+  def markClean(self):
+    """Mark self and all layers in it as unchanged."""
+    layers = [self]
+    while layers:
+      layer = layers.pop()
+      if layer._dirty:
+        del layer._dirty # Back to the class default False.
+        layer.__dict__.pop('_uncached', None) # See markDirty()
+        layers.extend(child for child in layer.layers if isinstance(child, SketchLayer))
 
   def find(self, _class=None, name=None, pattern=None, found=None):
     """Check if self matches class, name or pattern. Then search for
-    all layers in self.layers.
+    all layers in self.layers. Pages that are part of a SketchFile use
+    its index to find by class or by name.
     """
-    found = SketchBase.find(self, _class=_class, name=name, pattern=pattern, found=found)
-    for layer in self.layers:
-        layer.find(_class=_class, name=name, pattern=pattern, found=found)
+    if found is None and isinstance(self, SketchPage):
+      root = self.root
+      index = getattr(root, '_index', None)
+      if index is not None and index.pages.get(self.do_objectID) is self:
+        found = index.find(_class=_class, name=name, pattern=pattern, page=self)
+        if found is not None:
+          return found
+    if found is None:
+      found = []
+    for depth, parent, layer in self.walk():
+      SketchBase.find(layer, _class=_class, name=name, pattern=pattern, found=found)
     return found
 
   def _get_artBoards(self):
@@ -1275,13 +3132,51 @@ class SketchPath(SketchBase):
     'points': (SketchCurvePointList, []),
   }
 
+class SketchShape(SketchBase):
+  """Abstract base class of the shape layers that hold a points list.
+  If packPoints is True, then the curve points are read directly into
+  a SketchPackedCurvePoints, instead of a list of SketchCurvePoint.
+
+  >>> d = dict(points=[dict(point='{0, 0}'), dict(point='{1, 1}')])
+  >>> SketchRectangle(**d).points
+  [<SketchCurvePoint>, <SketchCurvePoint>]
+  >>> r = SketchRectangle(packPoints=True, **d)
+  >>> r.points
+  <SketchPackedCurvePoints n=2>
+  >>> r.asJson() == SketchRectangle(**d).asJson()
+  True
+  >>> r.unpackPoints()
+  >>> r.points
+  [<SketchCurvePoint>, <SketchCurvePoint>]
+  >>> r.packPoints()
+  >>> r.points
+  <SketchPackedCurvePoints n=2>
+  """
+  def __init__(self, packPoints=False, **kwargs):
+    if packPoints:
+      points = kwargs.pop('points', None) # Don't decode them as SketchCurvePoint
+      SketchBase.__init__(self, **kwargs)
+      self.points = SketchPackedCurvePoints(points)
+    else:
+      SketchBase.__init__(self, **kwargs)
+
+  def packPoints(self):
+    """Convert the list of SketchCurvePoint into SketchPackedCurvePoints."""
+    if not isinstance(self.points, SketchPackedCurvePoints):
+      self.points = SketchPackedCurvePoints(self.points)
+
+  def unpackPoints(self):
+    """Convert SketchPackedCurvePoints back into a list of SketchCurvePoint."""
+    if isinstance(self.points, SketchPackedCurvePoints):
+      self.points = list(self.points)
+
 def SketchPathOptional(sketchPath):
   sp = SketchPath(**sketchPath)
   if sp.points: # Any points, then keep it
     return sp
   return None # Otherwise ignore the pat.
 
-class SketchShapePath(SketchBase):
+class SketchShapePath(SketchShape):
   """
   _class: 'shapePath',
   do_objectID: UUID,
@@ -1456,6 +3351,36 @@ class SketchBitmap(SketchBase):
     'nineSliceScale': (asRect, None)
   }
 
+  def _get_imageData(self):
+    """Answers the binary data of the image, as memoryview. If the image was
+    extracted by the reader, it is read from the file in the _images/ folder,
+    by the name of self. Otherwise from the images of the root SketchFile.
+    Answers None if the image cannot be found.
+
+    >>> import shutil, tempfile
+    >>> from pysketchapp.sketchappreader import SketchAppReader
+    >>> path = shutil.copy('../../Test/TestImage.sketch', tempfile.mkdtemp())
+    >>> skf = SketchAppReader().read(path, extract=False)
+    >>> bitmap = skf.find(_class='bitmap')[0]
+    >>> bytes(bitmap.imageData[:4]), os.path.exists(skf.imagesPath)
+    (b'\\x89PNG', False)
+    """
+    if self.image is None:
+      return None
+    root = self.root
+    if root is None:
+      return None
+    imagePath = root.imagesPath + self.name + '.png'
+    if os.path.exists(imagePath):
+      f = open(imagePath, 'rb')
+      imageData = memoryview(f.read())
+      f.close()
+      return imageData
+    if root.images is not None and self.image._ref in root.images:
+      return root.images[self.image._ref]
+    return None
+  imageData = property(_get_imageData)
+
 class SketchSymbolInstance(SketchBase):
   """
   _class: 'symbolInstance',
@@ -1549,7 +3474,7 @@ class SketchGroup(SketchLayer):
     'hasClickThrough': (asBool, False),
   }
 
-class SketchRectangle(SketchBase):
+class SketchRectangle(SketchShape):
   """
   _class: 'rectangle',
   do_objectID: UUID,
@@ -1605,7 +3530,7 @@ class SketchRectangle(SketchBase):
     'style': (SketchStyle, None),
   }
 
-class SketchOval(SketchBase):
+class SketchOval(SketchShape):
   """
   _class: 'oval',
   do_objectID: UUID,
@@ -1651,7 +3576,7 @@ class SketchOval(SketchBase):
   }
 
 
-class SketchStar(SketchBase):
+class SketchStar(SketchShape):
   """
   _class: 'star',
   do_objectID: UUID,
@@ -1696,7 +3621,7 @@ class SketchStar(SketchBase):
     'points': (SketchCurvePointList, []),
   }
 
-class SketchPolygon(SketchBase):
+class SketchPolygon(SketchShape):
   """
   _class: 'polygon',
   do_objectID: UUID,
@@ -1902,6 +3827,180 @@ class SketchPage(SketchLayer):
     'clippingMaskMode': (asInt, 0),
   }
 
+class SketchPageProxy:
+  """Placeholder for a SketchPage in SketchFile.pages, as used by the lazy
+  mode of SketchAppReader.read. Only the page id is known on creation. The
+  load function, answering the real SketchPage, is called the first time
+  that any other attribute of the page is requested. Then the proxy replaces
+  itself by the page in parent.pages, so next lookups go directly to the page.
+
+  >>> page = SketchPage(do_objectID='ABC', name='Page 1')
+  >>> skf = SketchFile()
+  >>> proxy = SketchPageProxy(skf, 'ABC', lambda: page)
+  >>> skf.pages['ABC'] = proxy
+  >>> proxy.do_objectID, proxy.isLoaded
+  ('ABC', False)
+  >>> proxy.name, proxy.isLoaded
+  ('Page 1', True)
+  >>> skf.pages['ABC'] is page
+  True
+  >>> proxy, len(proxy)
+  (<SketchPage name=Page 1>, 0)
+  >>> SketchPageProxy.__new__(SketchPageProxy).isLoaded
+  Traceback (most recent call last):
+  ...
+  AttributeError: _page
+  """
+  def __init__(self, parent, do_objectID, load):
+    self._parent = weakref.ref(parent)
+    self.do_objectID = do_objectID
+    self._load = load
+    self._page = None
+
+  def _get_isLoaded(self):
+    return self._page is not None
+  isLoaded = property(_get_isLoaded)
+
+  def _get_page(self):
+    """Answers the real SketchPage, reading it if that was not done before."""
+    if self._page is None:
+      self._page = page = self._load()
+      self._load = None
+      parent = self._parent()
+      if parent is not None and parent.pages.get(self.do_objectID) is self:
+        parent.pages[self.do_objectID] = page
+        if parent._index is not None:
+          parent._index.add(page)
+    return self._page
+  page = property(_get_page)
+
+  def __getattr__(self, name):
+    # Only called for attributes that are not in the proxy itself. The own
+    # attributes are missing before __init__, e.g. while unpickling a copy.
+    if name in ('_parent', '_load', '_page') or name.startswith('__'):
+      raise AttributeError(name)
+    return getattr(self._get_page(), name)
+
+  def __repr__(self):
+    return repr(self.page)
+
+  def __eq__(self, sko):
+    if isinstance(sko, SketchPageProxy):
+      sko = sko.page
+    return self.page == sko
+
+  def __ne__(self, sko):
+    return not (self == sko)
+
+  def __getitem__(self, layerIndex):
+    return self.page[layerIndex]
+
+  def __len__(self):
+    return len(self.page)
+
+class SketchImageArchive:
+  """Access to the images and previews inside a .sketch file, without
+  extracting them. The binary data is read from the archive on demand, by the
+  name of the entry. Entries that are stored uncompressed (as written by
+  SketchAppWriter) are answered as memoryview on a mmap of the file, without
+  copying. Compressed entries are answered as memoryview on the decompressed
+  bytes. The files are opened on first use, close() or a with statement
+  closes them. Reading again opens them again.
+
+  >>> images = SketchImageArchive('../../Test/TestImage.sketch')
+  >>> sorted(images)
+  ['images/206e0b3f11f4d5ed9823234438bd68de1ef06967.png', 'previews/preview.png']
+  >>> bytes(images['previews/preview.png'][:4])
+  b'\\x89PNG'
+  >>> images = SketchImageArchive('../../Test/TestImageWrite.sketch')
+  >>> data = images['previews/preview.png']
+  >>> data.obj.__class__.__name__, bytes(data[:4])
+  ('mmap', b'\\x89PNG')
+  >>> images.close() # The mmap stays open until data is released.
+  >>> bytes(data[:4]), images._mmap is None
+  (b'\x89PNG', True)
+  >>> with SketchImageArchive('../../Test/TestImageWrite.sketch') as images:
+  ...   len(images['previews/preview.png']) > 0
+  True
+  >>> images._mmap is None
+  True
+  """
+  def __init__(self, path, zipInfos=None):
+    """Optional zipInfos is the infolist() of the archive, if it already is open."""
+    self.path = path
+    self.infos = {} # Archive name --> ZipInfo
+    if zipInfos is None:
+      zf = zipfile.ZipFile(path, mode='r')
+      zipInfos = zf.infolist()
+      zf.close()
+    for info in zipInfos:
+      if info.filename.startswith((IMAGES_JSON, PREVIEWS_JSON)):
+        self.infos[info.filename] = info
+    self._zipFile = None # Opened on first read of a compressed entry.
+    self._file = None
+    self._mmap = None # Opened on first read of a stored entry.
+
+  def __repr__(self):
+    return '<%s path=%s n=%d>' % (self.__class__.__name__, self.path.split('/')[-1], len(self))
+
+  def __getstate__(self):
+    return dict(path=self.path, infos=self.infos)
+
+  def __setstate__(self, state):
+    self.__init__(state['path'], state['infos'].values())
+
+  def __len__(self):
+    return len(self.infos)
+
+  def __iter__(self):
+    return iter(self.infos)
+
+  def __contains__(self, name):
+    return name in self.infos
+
+  def keys(self):
+    return self.infos.keys()
+
+  def addAlias(self, alias, name):
+    """Make the entry name also available as alias, e.g. after the writer
+    renamed the reference to the image."""
+    self.infos[alias] = self.infos[name]
+
+  def __getitem__(self, name):
+    info = self.infos[name]
+    if info.compress_type == zipfile.ZIP_STORED:
+      if self._mmap is None:
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+      # The data starts after the local file header, with its own name and extra lengths.
+      offset = info.header_offset + zipfile.sizeFileHeader
+      nameLength, extraLength = struct.unpack('<HH', self._mmap[offset-4:offset])
+      offset += nameLength + extraLength
+      return memoryview(self._mmap)[offset:offset+info.file_size]
+    if self._zipFile is None:
+      self._zipFile = zipfile.ZipFile(self.path, mode='r')
+    return memoryview(self._zipFile.read(info))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """Close the files that were opened for reading. If there still are
+    memoryviews on the mmap, then it is closed when they are released."""
+    if self._mmap is not None:
+      try:
+        self._mmap.close()
+      except BufferError: # Exported memoryviews keep the mmap open.
+        pass
+      self._file.close()
+      self._mmap = self._file = None
+    if self._zipFile is not None:
+      self._zipFile.close()
+      self._zipFile = None
+
 # meta.json
 class SketchMeta(SketchBase):
   """
@@ -1937,8 +4036,16 @@ class SketchMeta(SketchBase):
 
   def __init__(self, **kwargs):
     SketchBase.__init__(self, **kwargs)
+    pagesAndArtboards = kwargs.get('pagesAndArtboards')
+    if not isinstance(pagesAndArtboards, dict):
+      pagesAndArtboards = {}
     self.pagesAndArtboards = {} # Dictionary of Sketch element instances.
     for pageId, page in self.root.pages.items():
+      if isinstance(page, SketchPageProxy) and not page.isLoaded and \
+         pageId in pagesAndArtboards:
+        # Keep the page unread, using the reference as it was in meta.json
+        self.pagesAndArtboards[pageId] = pagesAndArtboards[pageId]
+        continue
       # Create page or artboard reference
       artboards = {}
       self.pagesAndArtboards[page.do_objectID] = dict(name=page.name, artboards=artboards)
@@ -1961,6 +4068,8 @@ class SketchUser(SketchBase):
   CLASS = 'user'
   ATTRS = {
   }
+  __slots__ = ('document',)
+
   def __init__(self, **kwargs):
     SketchBase.__init__(self, **kwargs)
     self.document = dict(pageListHeight=118)
@@ -1968,9 +4077,944 @@ class SketchUser(SketchBase):
   def asJson(self):
     return dict(document=dict(pageListHeight=self.document['pageListHeight']))
 
+class SketchLayerIndex:
+  """Index of the pages and layers of a SketchFile, by do_objectID, by _class
+  and by name, with the parent and page of each layer. Added, removed and
+  renamed layers are updated by their parents. Layers are answered in
+  reading order, the layers that are added after building the index are
+  sorted into that order on first use.
+
+  >>> page = SketchPage(do_objectID='P1', name='Page')
+  >>> artboard = SketchArtboard(do_objectID='A1', name='Board')
+  >>> page.append(artboard)
+  >>> index = SketchLayerIndex([page])
+  >>> index.ids['A1'], index.parents['A1'], index.pages['A1']
+  (<SketchArtboard name=Board w=100 h=100>, <SketchPage name=Page>, <SketchPage name=Page>)
+  >>> index.find(_class=SketchArtboard), index.find(name='Page')
+  ([<SketchArtboard name=Board w=100 h=100>], [<SketchPage name=Page>])
+  >>> index.find(pattern='oar') is None # Patterns are not indexed
+  True
+  >>> group = SketchGroup(name='Group')
+  >>> page.append(group)
+  >>> index.add(group, page)
+  >>> group.name = 'Other'
+  >>> index.update(group, 'name', 'Group')
+  >>> index.find(name='Group'), index.find(name='Other')
+  ([], [<SketchGroup name=Other>])
+  >>> first = SketchGroup(name='First')
+  >>> page.layers.insert(0, first)
+  >>> index.add(first, page)
+  >>> index.find(_class=SketchGroup) # In reading order, not as added.
+  [<SketchGroup name=First>, <SketchGroup name=Other>]
+  >>> index.remove(group)
+  >>> index.find(_class=SketchGroup)
+  [<SketchGroup name=First>]
+  """
+  def __init__(self, pages=()):
+    self.ids = {} # do_objectID --> layer
+    self.classes = {} # _class --> {id(layer): layer, ...}
+    self.names = {} # name --> {id(layer): layer, ...}
+    self.parents = {} # do_objectID --> parent layer
+    self.pages = {} # do_objectID --> page of the layer
+    self._unsorted = set() # (table name, key) of layer dicts not in reading order.
+    for page in pages:
+      self.add(page)
+    self._unsorted.clear() # Added in reading order.
+
+  def _addTo(self, tableName, key, layer):
+    layers = getattr(self, tableName).setdefault(key, {})
+    if layers:
+      self._unsorted.add((tableName, key))
+    layers[id(layer)] = layer
+
+  def _removeFrom(self, tableName, key, layer):
+    table = getattr(self, tableName)
+    layers = table.get(key)
+    if layers is not None and layers.pop(id(layer), None) is not None and not layers:
+      del table[key]
+      self._unsorted.discard((tableName, key))
+
+  def add(self, layer, parent=None):
+    """Add the layer and all its child layers to the index."""
+    if parent is None:
+      page = layer # No parent, then it is a page
+    else:
+      page = self.pages.get(parent.do_objectID)
+    stack = [(layer, parent)]
+    while stack:
+      layer, parent = stack.pop()
+      layerId = getattr(layer, 'do_objectID', None)
+      if layerId is not None:
+        self.ids[layerId] = layer
+        self.parents[layerId] = parent
+        self.pages[layerId] = page
+      self._addTo('classes', layer._class, layer)
+      name = getattr(layer, 'name', None)
+      if name is not None:
+        self._addTo('names', name, layer)
+      for child in reversed(getattr(layer, 'layers', None) or ()):
+        if isinstance(child, SketchBase):
+          stack.append((child, layer))
+
+  def remove(self, layer):
+    """Remove the layer and all its child layers from the index."""
+    stack = [layer]
+    while stack:
+      layer = stack.pop()
+      layerId = getattr(layer, 'do_objectID', None)
+      if layerId is not None and self.ids.get(layerId) is layer:
+        del self.ids[layerId]
+        self.parents.pop(layerId, None)
+        self.pages.pop(layerId, None)
+      self._removeFrom('classes', layer._class, layer)
+      self._removeFrom('names', getattr(layer, 'name', None), layer)
+      stack.extend(child for child in getattr(layer, 'layers', None) or () if isinstance(child, SketchBase))
+
+  def update(self, layer, attrName, oldValue):
+    """Move layer in the index, after its name or do_objectID changed from
+    oldValue. Layers that are not in the index are ignored."""
+    if attrName == 'name':
+      layers = self.names.get(oldValue)
+      if layers is not None and id(layer) in layers:
+        self._removeFrom('names', oldValue, layer)
+        if layer.name is not None:
+          self._addTo('names', layer.name, layer)
+    elif attrName == 'do_objectID' and oldValue is not None and self.ids.get(oldValue) is layer:
+      del self.ids[oldValue]
+      parent = self.parents.pop(oldValue, None)
+      page = self.pages.pop(oldValue, None)
+      if layer.do_objectID is not None:
+        self.ids[layer.do_objectID] = layer
+        self.parents[layer.do_objectID] = parent
+        self.pages[layer.do_objectID] = layer if page is layer else page
+
+  def reorder(self):
+    """Called after layers changed places, sorts all layer lists on next use."""
+    self._unsorted.update(('classes', key) for key in self.classes)
+    self._unsorted.update(('names', key) for key in self.names)
+
+  def _getLayers(self, tableName, key):
+    """Answers the list of layers of key in the table, in reading order."""
+    table = getattr(self, tableName)
+    layers = table.get(key)
+    if layers is None:
+      return []
+    if (tableName, key) in self._unsorted:
+      layers = table[key] = dict(sorted(layers.items(), key=lambda item: getTreeOrder(item[1])))
+      self._unsorted.discard((tableName, key))
+    return list(layers.values())
+
+  def find(self, _class=None, name=None, pattern=None, page=None):
+    """Answers the list of layers with class _class or with the exact name,
+    in reading order. If page is defined, then only layers on that page are
+    answered. Answers None for queries that cannot be answered by the index,
+    such as a pattern or both _class and name."""
+    if pattern is not None or (_class is None) == (name is None):
+      return None
+    if _class is not None:
+      if isclass(_class):
+        _class = _class.CLASS
+      found = self._getLayers('classes', _class)
+    else:
+      found = self._getLayers('names', name)
+    if page is not None:
+      pages = self.pages
+      found = [layer for layer in found if pages.get(layer.do_objectID) is page]
+    return found
+
+SPATIAL_CELL_LIMIT = 64 # Layers that cover more grid cells are tested in every query.
+
+def getAbsoluteOrigin(layer):
+  """Answers the (x, y) of the frame of layer on the page, adding the frame
+  positions of its parents.
+
+  >>> page = SketchPage()
+  >>> artboard = SketchArtboard(frame=SketchRect(x=100, y=200))
+  >>> page.append(artboard)
+  >>> group = SketchGroup(frame=SketchRect(x=10, y=20))
+  >>> artboard.append(group)
+  >>> getAbsoluteOrigin(group)
+  (110, 220)
+  """
+  x = y = 0
+  while layer is not None:
+    frame = getattr(layer, 'frame', None)
+    if isinstance(frame, SketchRect):
+      x += frame.x
+      y += frame.y
+    layer = getattr(layer, 'parent', None)
+  return x, y
+
+class SketchSpatialIndex:
+  """Spatial index of the absolute frames of all layers inside root (a page
+  or artboard), for hit-testing, rectangle and nearest queries and overlap
+  detection. The bounds (x1, y1, x2, y2) of the layers are stored in an array
+  of doubles. With NumPy installed, queries are vectorized over that array.
+  Otherwise the layers are put in the cells of a uniform grid, so queries
+  only test the layers in the cells they touch. Layers are answered in
+  reading order. The index of root.getSpatialIndex() is kept up to date by
+  the layers, other instances need a call to update(layer) after the frame
+  of a layer changed.
+
+  >>> page = SketchPage()
+  >>> artboard = SketchArtboard(frame=SketchRect(x=100, y=100, width=500, height=500))
+  >>> page.append(artboard)
+  >>> r1 = SketchRectangle(name='R1', frame=SketchRect(x=0, y=0, width=100, height=100))
+  >>> r2 = SketchRectangle(name='R2', frame=SketchRect(x=50, y=50, width=100, height=100))
+  >>> r3 = SketchRectangle(name='R3', frame=SketchRect(x=300, y=300, width=10, height=10))
+  >>> for r in (r1, r2, r3):
+  ...   artboard.append(r)
+  >>> index = SketchSpatialIndex(page)
+  >>> index.hitTest(175, 175)
+  [<SketchArtboard name=Artboard w=500 h=500>, <SketchRectangle name=R1>, <SketchRectangle name=R2>]
+  >>> index.intersect(390, 390, 20, 20)
+  [<SketchArtboard name=Artboard w=500 h=500>, <SketchRectangle name=R3>]
+  >>> index.nearest(0, 0, 2)
+  [<SketchArtboard name=Artboard w=500 h=500>, <SketchRectangle name=R1>]
+  >>> index.overlaps()
+  [(<SketchRectangle name=R1>, <SketchRectangle name=R2>)]
+  >>> r3.frame.x = r3.frame.y = 0
+  >>> index.update(r3)
+  >>> index.overlaps()
+  [(<SketchRectangle name=R1>, <SketchRectangle name=R2>), (<SketchRectangle name=R1>, <SketchRectangle name=R3>)]
+  >>> index.remove(r1)
+  >>> index.hitTest(175, 175)
+  [<SketchArtboard name=Artboard w=500 h=500>, <SketchRectangle name=R2>]
+  """
+  def __init__(self, root):
+    self.root = root
+    self.build()
+
+  def __repr__(self):
+    return '<%s root=%s n=%d>' % (self.__class__.__name__, self.root, len(self))
+
+  def __len__(self):
+    return len(self.layers) - len(self._removed)
+
+  def build(self):
+    """Build the index of all layers in self.root."""
+    self.layers = [] # Layers in reading order.
+    self.parents = [] # Index of the parent of each layer, or -1.
+    self.bounds = array('d') # x1, y1, x2, y2 of each layer.
+    self._indices = {} # id(layer) --> index
+    self._removed = set() # Indices of removed layers.
+    root = self.root
+    self.origin = getAbsoluteOrigin(root) # Checked by root.getSpatialIndex()
+    origins = {id(root): self.origin}
+    for depth, parent, layer in root.walk():
+      if layer is not root:
+        origins[id(layer)] = self._add(layer, parent, origins[id(parent)])
+    # Cells of about the average layer size.
+    size = 0
+    bounds = self.bounds
+    for i in range(0, len(bounds), 4):
+      size += max(bounds[i+2] - bounds[i], bounds[i+3] - bounds[i+1])
+    self.cellSize = max(1, size / max(1, len(self.layers)))
+    self._cells = {} # (cx, cy) --> [index, ...]
+    self._large = set() # Indices of layers that are in too many cells.
+    if numpy is None:
+      for index in range(len(self.layers)):
+        self._addCells(index)
+
+  def _add(self, layer, parent, origin):
+    """Add layer at the position of the parent origin. Answers the origin of layer."""
+    if isinstance(layer, SketchLayer):
+      layer.__dict__.pop('_uncached', None) # See markDirty()
+    x, y = origin
+    frame = getattr(layer, 'frame', None)
+    if isinstance(frame, SketchRect):
+      x += frame.x
+      y += frame.y
+      w, h = frame.width, frame.height
+    else:
+      w = h = 0
+    self._indices[id(layer)] = len(self.layers)
+    self.layers.append(layer)
+    self.parents.append(self._indices.get(id(parent), -1))
+    self.bounds.extend((x, y, x + w, y + h))
+    return x, y
+
+  def _cellRange(self, x1, y1, x2, y2):
+    cellSize = self.cellSize
+    return int(x1 // cellSize), int(y1 // cellSize), int(x2 // cellSize), int(y2 // cellSize)
+
+  def _addCells(self, index):
+    cx1, cy1, cx2, cy2 = self._cellRange(*self.bounds[4*index:4*index+4])
+    if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > SPATIAL_CELL_LIMIT:
+      self._large.add(index)
+      return
+    cells = self._cells
+    for cx in range(cx1, cx2+1):
+      for cy in range(cy1, cy2+1):
+        cells.setdefault((cx, cy), []).append(index)
+
+  def _removeCells(self, index):
+    if index in self._large:
+      self._large.remove(index)
+      return
+    cx1, cy1, cx2, cy2 = self._cellRange(*self.bounds[4*index:4*index+4])
+    for cx in range(cx1, cx2+1):
+      for cy in range(cy1, cy2+1):
+        self._cells[(cx, cy)].remove(index)
+
+  def update(self, layer):
+    """Update the bounds of layer and all layers inside it, after its frame
+    changed. Layers that are not in the index yet are added."""
+    if layer is self.root:
+      self.build()
+      return
+    parent = layer.parent
+    origins = {id(parent): getAbsoluteOrigin(parent)}
+    for depth, parent, child in layer.walk():
+      index = self._indices.get(id(child))
+      if index is None or index in self._removed:
+        if index is not None:
+          self._removed.remove(index)
+          self._indices.pop(id(child))
+        origins[id(child)] = self._add(child, parent, origins[id(parent)])
+        index = len(self.layers) - 1
+      else:
+        if numpy is None:
+          self._removeCells(index)
+        x, y = origins[id(parent)]
+        frame = getattr(child, 'frame', None)
+        if isinstance(frame, SketchRect):
+          x += frame.x
+          y += frame.y
+          w, h = frame.width, frame.height
+        else:
+          w = h = 0
+        self.bounds[4*index:4*index+4] = array('d', (x, y, x + w, y + h))
+        origins[id(child)] = x, y
+      if numpy is None:
+        self._addCells(index)
+
+  def remove(self, layer):
+    """Remove layer and all layers inside it from the index."""
+    for depth, parent, child in layer.walk():
+      index = self._indices.get(id(child))
+      if index is not None and index not in self._removed:
+        if numpy is None:
+          self._removeCells(index)
+        self._removed.add(index)
+
+  def _getCandidates(self, x1, y1, x2, y2):
+    """Answers the indices of the layers in the grid cells of the rectangle."""
+    cx1, cy1, cx2, cy2 = self._cellRange(x1, y1, x2, y2)
+    candidates = set(self._large)
+    cells = self._cells
+    if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(cells):
+      for (cx, cy), indices in cells.items():
+        if cx1 <= cx <= cx2 and cy1 <= cy <= cy2:
+          candidates.update(indices)
+    else:
+      for cx in range(cx1, cx2+1):
+        for cy in range(cy1, cy2+1):
+          candidates.update(cells.get((cx, cy), ()))
+    return candidates
+
+  def _getArray(self):
+    """Answers the bounds as NumPy array of shape (n, 4), removed layers
+    have NaN bounds, so they don't match any query."""
+    bounds = numpy.frombuffer(self.bounds, dtype=numpy.float64).reshape(-1, 4)
+    if self._removed:
+      bounds = bounds.copy()
+      bounds[sorted(self._removed)] = numpy.nan
+    return bounds
+
+  def _query(self, x1, y1, x2, y2, inclusive):
+    if numpy is not None:
+      b = self._getArray()
+      if inclusive:
+        mask = (b[:, 0] <= x2) & (x1 <= b[:, 2]) & (b[:, 1] <= y2) & (y1 <= b[:, 3])
+      else:
+        mask = (b[:, 0] < x2) & (x1 < b[:, 2]) & (b[:, 1] < y2) & (y1 < b[:, 3])
+      return [self.layers[index] for index in numpy.nonzero(mask)[0].tolist()]
+    found = []
+    bounds = self.bounds
+    for index in sorted(self._getCandidates(x1, y1, x2, y2)):
+      bx1, by1, bx2, by2 = bounds[4*index:4*index+4]
+      if inclusive:
+        if bx1 <= x2 and x1 <= bx2 and by1 <= y2 and y1 <= by2:
+          found.append(self.layers[index])
+      elif bx1 < x2 and x1 < bx2 and by1 < y2 and y1 < by2:
+        found.append(self.layers[index])
+    return found
+
+  def hitTest(self, x, y):
+    """Answers the layers of which the frame contains point (x, y), edges
+    included."""
+    return self._query(x, y, x, y, True)
+
+  def intersect(self, x, y, w, h):
+    """Answers the layers of which the frame overlaps the rectangle with an
+    area larger than 0."""
+    return self._query(x, y, x + w, y + h, False)
+
+  def nearest(self, x, y, count=1):
+    """Answers the count layers nearest to point (x, y), ordered by the
+    distance to their frame, which is 0 for frames that contain the point."""
+    if numpy is not None:
+      b = self._getArray()
+      dx = numpy.maximum(numpy.maximum(b[:, 0] - x, x - b[:, 2]), 0)
+      dy = numpy.maximum(numpy.maximum(b[:, 1] - y, y - b[:, 3]), 0)
+      distances = numpy.hypot(dx, dy)
+      indices = [index for index in numpy.argsort(distances, kind='stable').tolist()
+        if index not in self._removed]
+      return [self.layers[index] for index in indices[:count]]
+    bounds = self.bounds
+    def distance(index):
+      bx1, by1, bx2, by2 = bounds[4*index:4*index+4]
+      return math.hypot(max(bx1 - x, x - bx2, 0), max(by1 - y, y - by2, 0))
+    indices = (index for index in range(len(self.layers)) if index not in self._removed)
+    return [self.layers[index] for index in heapq.nsmallest(count, indices, key=distance)]
+
+  def _isAncestor(self, index, child):
+    parents = self.parents
+    child = parents[child]
+    while child != -1:
+      if child == index:
+        return True
+      child = parents[child]
+    return False
+
+  def overlaps(self, siblings=False):
+    """Answers the list of (layer1, layer2) pairs of which the frames overlap
+    with an area larger than 0, in reading order. Layers are not compared with
+    the layers inside them. If siblings is True, then only layers with the
+    same parent are compared. The layers are sorted by their left side, so
+    each layer is only compared with the layers that overlap it horizontally."""
+    bounds = self.bounds
+    parents = self.parents
+    indices = [index for index in range(len(self.layers)) if index not in self._removed]
+    indices.sort(key=lambda index: bounds[4*index])
+    active = []
+    pairs = []
+    for index in indices:
+      x1, y1, x2, y2 = bounds[4*index:4*index+4]
+      active = [other for other in active if bounds[4*other+2] > x1]
+      for other in active:
+        if bounds[4*other+1] < y2 and y1 < bounds[4*other+3]:
+          first, last = min(index, other), max(index, other)
+          if siblings:
+            if parents[first] == parents[last]:
+              pairs.append((first, last))
+          elif not self._isAncestor(first, last):
+            pairs.append((first, last))
+      if x2 > x1:
+        active.append(index)
+    pairs.sort()
+    return [(self.layers[first], self.layers[last]) for first, last in pairs]
+
+def getLocalTransform(layer):
+  """Answers the affine transform (a, b, c, d, tx, ty) from the coordinates
+  of layer to the coordinates of its parent, as x' = a*x + c*y + tx and
+  y' = b*x + d*y + ty. As in Sketch, the rotation (in degrees,
+  counterclockwise on screen) and the flips are around the center of the
+  frame.
+
+  >>> getLocalTransform(SketchGroup(frame=SketchRect(x=10, y=20)))
+  (1.0, 0.0, 0.0, 1.0, 10.0, 20.0)
+  >>> getLocalTransform(SketchGroup(frame=SketchRect(x=0, y=0, width=100, height=50), isFlippedHorizontal=True))
+  (-1.0, 0.0, 0.0, 1.0, 100.0, 0.0)
+  """
+  frame = getattr(layer, 'frame', None)
+  if not isinstance(frame, SketchRect):
+    return (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+  x, y, w, h = frame.x, frame.y, frame.width, frame.height
+  rotation = getattr(layer, 'rotation', 0) or 0
+  sx = -1.0 if getattr(layer, 'isFlippedHorizontal', False) else 1.0
+  sy = -1.0 if getattr(layer, 'isFlippedVertical', False) else 1.0
+  if rotation:
+    angle = math.radians(rotation)
+    cos, sin = math.cos(angle), math.sin(angle)
+  else:
+    cos, sin = 1.0, 0.0
+  a, b, c, d = cos*sx, -sin*sx if sin else 0.0, sin*sy, cos*sy
+  return (a, b, c, d, x + w/2 - (a*w + c*h)/2, y + h/2 - (b*w + d*h)/2)
+
+def _composeTransforms(p, l):
+  """Answers the transform p applied after transform l."""
+  pa, pb, pc, pd, ptx, pty = p
+  la, lb, lc, ld, ltx, lty = l
+  return (pa*la + pc*lb, pb*la + pd*lb, pa*lc + pc*ld, pb*lc + pd*ld,
+    pa*ltx + pc*lty + ptx, pb*ltx + pd*lty + pty)
+
+def getAbsoluteTransform(layer):
+  """Answers the transform from the coordinates of layer to the page,
+  composing the local transforms of layer and its parents."""
+  transform = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+  while layer is not None and not isinstance(layer, SketchFile):
+    transform = _composeTransforms(getLocalTransform(layer), transform)
+    layer = getattr(layer, 'parent', None)
+  return transform
+
+def getAbsoluteBounds(layer):
+  """Answers the (x, y, w, h) of the bounding box of layer on the page, from
+  the cached SketchGeometry of its top parent layer (usually the page).
+
+  >>> page = SketchPage()
+  >>> artboard = SketchArtboard(frame=SketchRect(x=100, y=200))
+  >>> page.append(artboard)
+  >>> getAbsoluteBounds(artboard)
+  (100.0, 200.0, 100.0, 100.0)
+  """
+  top = layer
+  while isinstance(getattr(top, 'parent', None), SketchLayer):
+    top = top.parent
+  if isinstance(top, SketchLayer):
+    return top.getGeometry().getBounds(layer)
+  return SketchGeometry(top).getBounds(layer)
+
+class SketchGeometry:
+  """Absolute transforms and bounding boxes of root and all layers in it,
+  computed in one pass. The transforms (a, b, c, d, tx, ty) and the bounds
+  (x1, y1, x2, y2) are stored in arrays of doubles. With NumPy installed,
+  the transforms of each nesting depth and all bounds are computed
+  vectorized. Use root.getGeometry() to get the cached instance.
+
+  >>> page = SketchPage()
+  >>> artboard = SketchArtboard(frame=SketchRect(x=100, y=100, width=400, height=400))
+  >>> page.append(artboard)
+  >>> group = SketchGroup(frame=SketchRect(x=100, y=100, width=200, height=100), rotation=90)
+  >>> artboard.append(group)
+  >>> r = SketchRectangle(frame=SketchRect(x=0, y=0, width=20, height=10))
+  >>> group.append(r)
+  >>> geometry = SketchGeometry(page)
+  >>> [round(v) for v in geometry.getBounds(group)]
+  [250, 150, 100, 200]
+  >>> [round(v) for v in geometry.getBounds(r)] # Top left of group is bottom left after rotation.
+  [250, 330, 10, 20]
+  >>> [round(v) for v in geometry.getUnionBounds(artboard.layers)]
+  [250, 150, 100, 200]
+  >>> [round(v) for v in geometry.getContentBounds(artboard)]
+  [250, 150, 100, 200]
+  """
+  def __init__(self, root):
+    self.root = root
+    self.layers = [] # Layers in reading order, starting with root.
+    self._indices = {} # id(layer) --> index
+    parents = [] # Index of the parent of each layer, or -1 for root.
+    depths = []
+    locals_ = array('d') # Local transform of each layer.
+    sizes = array('d') # Frame width and height of each layer.
+    for depth, parent, layer in root.walk():
+      if isinstance(layer, SketchLayer):
+        layer.__dict__.pop('_uncached', None) # See markDirty()
+      self._indices[id(layer)] = len(self.layers)
+      self.layers.append(layer)
+      parents.append(self._indices.get(id(parent), -1))
+      depths.append(depth)
+      locals_.extend(getLocalTransform(layer))
+      frame = getattr(layer, 'frame', None)
+      if isinstance(frame, SketchRect):
+        sizes.extend((frame.width, frame.height))
+      else:
+        sizes.extend((0, 0))
+    rootTransform = self.rootTransform = getAbsoluteTransform(getattr(root, 'parent', None))
+    if numpy is not None:
+      self._computeArrays(rootTransform, parents, depths, locals_, sizes)
+    else:
+      self._compute(rootTransform, parents, locals_, sizes)
+
+  def _compute(self, rootTransform, parents, locals_, sizes):
+    transforms = self.transforms = array('d')
+    bounds = self.bounds = array('d')
+    for index, parent in enumerate(parents):
+      p = rootTransform if parent == -1 else transforms[6*parent:6*parent+6]
+      a, b, c, d, tx, ty = t = _composeTransforms(p, locals_[6*index:6*index+6])
+      transforms.extend(t)
+      w, h = sizes[2*index], sizes[2*index+1]
+      xs = (tx, a*w + tx, c*h + tx, a*w + c*h + tx)
+      ys = (ty, b*w + ty, d*h + ty, b*w + d*h + ty)
+      bounds.extend((min(xs), min(ys), max(xs), max(ys)))
+
+  def _computeArrays(self, rootTransform, parents, depths, locals_, sizes):
+    n = len(parents)
+    l = numpy.frombuffer(locals_, dtype=numpy.float64).reshape(n, 6)
+    t = numpy.empty((n, 6))
+    parents = numpy.array(parents, dtype=numpy.intp)
+    depths = numpy.array(depths, dtype=numpy.intp)
+    for depth in range(int(depths.max()) + 1 if n else 0):
+      indices = numpy.nonzero(depths == depth)[0]
+      if depth == 0:
+        p = numpy.tile(numpy.array(rootTransform), (len(indices), 1))
+      else:
+        p = t[parents[indices]]
+      li = l[indices]
+      t[indices, 0] = p[:, 0]*li[:, 0] + p[:, 2]*li[:, 1]
+      t[indices, 1] = p[:, 1]*li[:, 0] + p[:, 3]*li[:, 1]
+      t[indices, 2] = p[:, 0]*li[:, 2] + p[:, 2]*li[:, 3]
+      t[indices, 3] = p[:, 1]*li[:, 2] + p[:, 3]*li[:, 3]
+      t[indices, 4] = p[:, 0]*li[:, 4] + p[:, 2]*li[:, 5] + p[:, 4]
+      t[indices, 5] = p[:, 1]*li[:, 4] + p[:, 3]*li[:, 5] + p[:, 5]
+    wh = numpy.frombuffer(sizes, dtype=numpy.float64).reshape(n, 2)
+    w, h = wh[:, 0], wh[:, 1]
+    a, b, c, d, tx, ty = t.T
+    xs = numpy.stack((tx, a*w + tx, c*h + tx, a*w + c*h + tx))
+    ys = numpy.stack((ty, b*w + ty, d*h + ty, b*w + d*h + ty))
+    self.transforms = array('d', t.tobytes())
+    self.bounds = array('d', numpy.stack((xs.min(0), ys.min(0), xs.max(0), ys.max(0)), axis=1).tobytes())
+
+  def __len__(self):
+    return len(self.layers)
+
+  def _getIndex(self, layer):
+    index = self._indices.get(id(layer))
+    if index is None:
+      raise KeyError('Layer %s is not in the geometry of %s' % (layer, self.root))
+    return index
+
+  def getTransform(self, layer):
+    """Answers the absolute transform (a, b, c, d, tx, ty) of layer."""
+    index = self._getIndex(layer)
+    return tuple(self.transforms[6*index:6*index+6])
+
+  def getBounds(self, layer):
+    """Answers the (x, y, w, h) of the bounding box of layer."""
+    index = self._getIndex(layer)
+    x1, y1, x2, y2 = self.bounds[4*index:4*index+4]
+    return x1, y1, x2 - x1, y2 - y1
+
+  def getUnionBounds(self, layers):
+    """Answers the (x, y, w, h) of the bounding box of all layers, or None
+    if there are no layers."""
+    x1 = y1 = x2 = y2 = None
+    bounds = self.bounds
+    for layer in layers:
+      index = self._getIndex(layer)
+      bx1, by1, bx2, by2 = bounds[4*index:4*index+4]
+      if x1 is None:
+        x1, y1, x2, y2 = bx1, by1, bx2, by2
+      else:
+        x1, y1, x2, y2 = min(x1, bx1), min(y1, by1), max(x2, bx2), max(y2, by2)
+    if x1 is None:
+      return None
+    return x1, y1, x2 - x1, y2 - y1
+
+  def getContentBounds(self, layer, visibleOnly=True):
+    """Answers the (x, y, w, h) of the bounding box of the layers inside
+    layer, for trimming exports. Hidden layers (and the layers inside them)
+    are skipped if visibleOnly is True. Content of artboards is clipped by
+    the artboard. Answers None if there is no content."""
+    def prune(depth, parent, child):
+      return visibleOnly and not getattr(child, 'isVisible', True)
+    layers = [child for depth, parent, child in layer.walk(prune=prune)
+      if child is not layer and not prune(depth, parent, child)]
+    contentBounds = self.getUnionBounds(layers)
+    if contentBounds is None or not isinstance(layer, SketchArtboard):
+      return contentBounds
+    x, y, w, h = contentBounds
+    ax, ay, aw, ah = self.getBounds(layer)
+    x1, y1 = max(x, ax), max(y, ay)
+    x2, y2 = min(x + w, ax + aw), min(y + h, ay + ah)
+    if x2 <= x1 or y2 <= y1:
+      return None
+    return x1, y1, x2 - x1, y2 - y1
+
+# Operators of attribute predicates in selectors, see compileSelector.
+SELECTOR_OPERATORS = {
+  '=': lambda v, value: v == value,
+  '!=': lambda v, value: v != value,
+  '^=': lambda v, value: str(v).startswith(str(value)),
+  '$=': lambda v, value: str(v).endswith(str(value)),
+  '*=': lambda v, value: str(value) in str(v),
+  '~=': lambda v, value: value.search(str(v)) is not None, # Value is compiled as regex.
+  '?=': lambda v, value: value.match(str(v)) is not None, # Value is compiled from glob.
+  '<': lambda v, value: v < value,
+  '<=': lambda v, value: v <= value,
+  '>': lambda v, value: v > value,
+  '>=': lambda v, value: v >= value,
+}
+# Pseudo classes in selectors, e.g. "group:hidden"
+SELECTOR_PSEUDO_CLASSES = {
+  'visible': lambda layer: bool(getattr(layer, 'isVisible', True)),
+  'hidden': lambda layer: not getattr(layer, 'isVisible', True),
+  'locked': lambda layer: bool(getattr(layer, 'isLocked', False)),
+  'unlocked': lambda layer: not getattr(layer, 'isLocked', False),
+  'empty': lambda layer: not getattr(layer, 'layers', None),
+  'first-child': lambda layer: _childIndex(layer) == 0,
+  'last-child': lambda layer: _childIndex(layer) == len(getattr(layer.parent, 'layers', ())) - 1,
+}
+SELECTOR_TOKENS = re.compile(r"""
+  (?P<space>\s+)|
+  (?P<combinator>\s*[>,]\s*)|
+  (?P<type>[A-Za-z_][\w-]*|\*)|
+  \#(?P<id>[\w-]+)|
+  \[\s*(?P<attr>[\w.]+)\s*(?:(?P<op>!=|\^=|\$=|\*=|~=|\?=|<=|>=|=|<|>)\s*
+    (?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<value>[^\]\s]+))\s*)?\]|
+  :(?P<pseudo>[\w-]+)
+""", re.VERBOSE)
+SELECTOR_CACHE_SIZE = 256
+SELECTOR_CACHE = {}
+
+def _childIndex(layer):
+  parent = getattr(layer, 'parent', None)
+  for index, child in enumerate(getattr(parent, 'layers', ())):
+    if child is layer:
+      return index
+  return None
+
+def _selectorValue(value):
+  """Answers the unquoted selector value as number, bool, None or string.
+  Values such as nan and inf are names, not numbers.
+
+  >>> [_selectorValue(value) for value in ('12', '1.5', 'true', 'null', 'nan', 'inf', 'Rect')]
+  [12, 1.5, True, None, 'nan', 'inf', 'Rect']
+  """
+  try:
+    return int(value)
+  except ValueError:
+    pass
+  try:
+    number = float(value)
+  except ValueError:
+    pass
+  else:
+    if math.isfinite(number):
+      return number
+  return dict(true=True, false=False, null=None).get(value, value)
+
+def _attrPredicate(attr, op, value):
+  """Answers the predicate function of an attribute selector. The attr can
+  be a path, e.g. "frame.width". Layers without the attribute don't match."""
+  names = attr.split('.')
+  if op == '~=':
+    value = re.compile(value)
+  elif op == '?=':
+    value = re.compile(fnmatch.translate(value))
+  compare = SELECTOR_OPERATORS.get(op)
+  def predicate(layer):
+    v = layer
+    for name in names:
+      v = getattr(v, name, None)
+      if v is None:
+        return False
+    if compare is None:
+      return bool(v) # Only the attribute is given, e.g. [isLocked]
+    try:
+      return compare(v, value)
+    except TypeError: # E.g. comparing a string with a number.
+      return False
+  return predicate
+
+class SketchSelector:
+  """Compiled selector, to select layers in the tree by class, id, name and
+  attribute values, pseudo classes and their ancestry, in a syntax like CSS.
+  Use compileSelector() to get a cached instance.
+
+    artboard              Layers with _class "artboard", * is any class.
+    #A1                   Layer with do_objectID "A1".
+    [name="Icon"]         Attribute predicate, with operators = != ^= $= *=,
+                          ~= (regex search), ?= (glob), < <= > >= and
+                          [isLocked] for true values. Attributes can be paths
+                          as [frame.width>100]. Unquoted values are numbers,
+                          true, false, null or strings.
+    :visible              Pseudo class, see SELECTOR_PSEUDO_CLASSES.
+    artboard group        Group somewhere inside an artboard.
+    artboard > group      Group that is a layer of an artboard.
+    rectangle, oval       Layers matching either selector.
+
+  >>> page = SketchPage(name='Page')
+  >>> icons = SketchArtboard(name='Icons')
+  >>> page.append(icons)
+  >>> icons.append(SketchShapeGroup(name='Icon Home'))
+  >>> icons.append(SketchShapeGroup(name='Icon Hidden', isVisible=False))
+  >>> group = SketchGroup(name='Group')
+  >>> icons.append(group)
+  >>> group.append(SketchShapeGroup(name='Icon Nested'))
+  >>> page.select('artboard[name^="Icon"] > shapeGroup:visible')
+  [<SketchShapeGroup name=Icon Home>]
+  >>> page.select('artboard shapeGroup')
+  [<SketchShapeGroup name=Icon Home>, <SketchShapeGroup name=Icon Hidden>, <SketchShapeGroup name=Icon Nested>]
+  >>> page.select('[name?="Icon *e*"]:hidden, group')
+  [<SketchShapeGroup name=Icon Hidden>, <SketchGroup name=Group>]
+  >>> page.select('* > [name~="^Icon (Home|Nested)$"][frame.width>=100]')
+  [<SketchShapeGroup name=Icon Home>, <SketchShapeGroup name=Icon Nested>]
+  >>> compileSelector('artboard >')
+  Traceback (most recent call last):
+  ...
+  ValueError: Selector "artboard >" has no layer after ">"
+  """
+  def __init__(self, selector):
+    self.selector = selector
+    self.alternatives = [] # List of [(combinator, _class, layerId, name, match), ...]
+    self._parse(selector)
+
+  def __repr__(self):
+    return '<%s %s>' % (self.__class__.__name__, self.selector)
+
+  def _parse(self, selector):
+    parts = []
+    combinator = None
+    compound = None
+    pos = 0
+    while pos < len(selector):
+      m = SELECTOR_TOKENS.match(selector, pos)
+      if m is None:
+        raise ValueError('Selector "%s" has an error at position %d' % (selector, pos))
+      pos = m.end()
+      kind = m.lastgroup
+      if kind in ('space', 'combinator'):
+        if compound is not None:
+          parts.append(compound)
+          compound = None
+          combinator = ' '
+        token = m.group().strip()
+        if token == ',':
+          self._addAlternative(parts, selector, token)
+          parts = []
+          combinator = None
+        elif token == '>':
+          if not parts:
+            raise ValueError('Selector "%s" has no layer before ">"' % selector)
+          combinator = '>'
+        continue
+      if compound is None:
+        compound = dict(combinator=combinator, _class=None, layerId=None, name=None, predicates=[])
+      if kind == 'type':
+        if m.group('type') != '*':
+          compound['_class'] = m.group('type')
+      elif kind == 'id':
+        compound['layerId'] = m.group('id')
+      elif kind == 'pseudo':
+        pseudo = m.group('pseudo')
+        if pseudo not in SELECTOR_PSEUDO_CLASSES:
+          raise ValueError('Selector "%s" has unknown pseudo class ":%s"' % (selector, pseudo))
+        compound['predicates'].append(SELECTOR_PSEUDO_CLASSES[pseudo])
+      else:
+        attr, op = m.group('attr'), m.group('op')
+        value = m.group('dq')
+        if value is None:
+          value = m.group('sq')
+        if value is None and m.group('value') is not None:
+          value = _selectorValue(m.group('value'))
+        if attr == 'name' and op == '=':
+          compound['name'] = value # Can be found by the index.
+        compound['predicates'].append(_attrPredicate(attr, op, value))
+    if compound is not None:
+      parts.append(compound)
+    elif combinator == '>':
+      raise ValueError('Selector "%s" has no layer after ">"' % selector)
+    self._addAlternative(parts, selector, ',')
+
+  def _addAlternative(self, parts, selector, token):
+    if not parts:
+      raise ValueError('Selector "%s" has no layer before "%s"' % (selector, token))
+    self.alternatives.append([(part['combinator'], part['_class'], part['layerId'], part['name'],
+      self._compileCompound(part)) for part in parts])
+
+  def _compileCompound(self, part):
+    """Answers the function that tests if a layer matches all conditions of part."""
+    _class, layerId, predicates = part['_class'], part['layerId'], part['predicates']
+    def match(layer):
+      if _class is not None and getattr(layer, '_class', None) != _class:
+        return False
+      if layerId is not None and getattr(layer, 'do_objectID', None) != layerId:
+        return False
+      for predicate in predicates:
+        if not predicate(layer):
+          return False
+      return True
+    return match
+
+  def _matchParts(self, parts, index, layer):
+    combinator, _class, layerId, name, match = parts[index]
+    if not match(layer):
+      return False
+    if index == 0:
+      return True
+    parent = getattr(layer, 'parent', None)
+    if combinator == '>':
+      return parent is not None and self._matchParts(parts, index-1, parent)
+    while parent is not None: # Any ancestor can match the previous parts.
+      if self._matchParts(parts, index-1, parent):
+        return True
+      parent = getattr(parent, 'parent', None)
+    return False
+
+  def match(self, layer):
+    """Answers if layer matches the selector."""
+    for parts in self.alternatives:
+      if self._matchParts(parts, len(parts)-1, layer):
+        return True
+    return False
+
+  def _getIndexCandidates(self, root):
+    """Answers the list of layers in the index of root that can match, or
+    None if the index cannot be used. That is when there is one alternative
+    that selects by id, class or exact name, and root is an indexed
+    SketchFile or a page in it. The candidates are in reading order.
+
+    >>> skf = SketchFile()
+    >>> skf.pages['P1'] = page = SketchPage(parent=skf, do_objectID='P1')
+    >>> page.append(SketchGroup(name='Second'))
+    >>> skf.buildIndex().find(_class='group')
+    [<SketchGroup name=Second>]
+    >>> page.layers.insert(0, SketchGroup(name='First'))
+    >>> compileSelector('group')._getIndexCandidates(skf)
+    [<SketchGroup name=First>, <SketchGroup name=Second>]
+    """
+    if len(self.alternatives) != 1:
+      return None
+    combinator, _class, layerId, name, match = self.alternatives[0][-1]
+    if layerId is None and _class is None and name is None:
+      return None
+    page = None
+    if isinstance(root, SketchFile):
+      if layerId is not None:
+        layer = root.findById(layerId)
+        return [] if layer is None else [layer]
+      root.readPages()
+      index = root.index
+    elif isinstance(root, SketchPage):
+      index = getattr(root.root, '_index', None)
+      if index is None or index.pages.get(root.do_objectID) is not root:
+        return None
+      page = root
+    else:
+      return None
+    if layerId is not None:
+      layer = index.ids.get(layerId)
+      if layer is None or (page is not None and index.pages.get(layerId) is not page):
+        return []
+      return [layer]
+    if _class is not None:
+      return index.find(_class=_class, page=page)
+    return index.find(name=name, page=page)
+
+  def iterSelect(self, root):
+    """Generator of the layers in root (including root itself) that match
+    the selector, in reading order. Uses the index of root if possible."""
+    candidates = self._getIndexCandidates(root)
+    if candidates is None:
+      candidates = (layer for depth, parent, layer in root.walk())
+    for layer in candidates:
+      if self.match(layer):
+        yield layer
+
+  def select(self, root):
+    """Answers the list of layers in root that match the selector."""
+    return list(self.iterSelect(root))
+
+def compileSelector(selector):
+  """Answers the SketchSelector of the selector string. Compiled selectors
+  are cached, until the cache reaches SELECTOR_CACHE_SIZE.
+
+  >>> compileSelector('artboard > group') is compileSelector('artboard > group')
+  True
+  """
+  compiled = SELECTOR_CACHE.get(selector)
+  if compiled is None:
+    compiled = SketchSelector(selector)
+    if len(SELECTOR_CACHE) < SELECTOR_CACHE_SIZE:
+      SELECTOR_CACHE[selector] = compiled
+  return compiled
+
 class SketchFile(SketchBase):
   """Holds entire data file. Top of layer.parent-->layer.parent-->sketchFile chain.
   """
+  __slots__ = ('path', '__dict__')
   ATTRS = {
     'pages': (asDict, {}),
     'document': (SketchDocument, None),
@@ -1978,21 +5022,171 @@ class SketchFile(SketchBase):
     'meta': (SketchMeta, None),
   }
   def __init__(self, path=None):
+    self._parent = None # Root of the tree of layers.
     self.path = path or UNTITLED_SKETCH
     self.pages = {}
     self.document = None
     self.user = None
     self.meta = None
+    self.images = None # Optional SketchImageArchive, set by the reader.
+    self.template = None # Optional SketchTemplate that self is forked from.
+    self._index = None # Created on first use of self.index
 
   def __repr__(self):
     return '<%s path=%s>' % (self.__class__.__name__, self.path.split('/')[-1])
 
+  def __getstate__(self):
+    state = SketchBase.__getstate__(self)
+    state['_index'] = None # Rebuild on first use.
+    return state
+
+  def __setstate__(self, state):
+    SketchBase.__setstate__(self, state)
+    for page in self.pages.values():
+      page.parent = self
+    for attrName in ('document', 'user', 'meta'):
+      if getattr(self, attrName, None) is not None:
+        getattr(self, attrName).parent = self
+
+  def _get_dirtyPages(self):
+    """Answers the list of pages that changed since reading or saving. Pages
+    that are not loaded yet (SketchPageProxy) are unchanged.
+
+    >>> skf = SketchFile()
+    >>> skf.pages['P1'] = page = SketchPage(parent=skf, do_objectID='P1')
+    >>> skf.pages['P2'] = SketchPage(parent=skf, do_objectID='P2')
+    >>> skf.dirtyPages
+    []
+    >>> page.layers.append(SketchArtboard())
+    >>> skf.dirtyPages
+    [<SketchPage name=Untitled>]
+    >>> skf.markClean()
+    >>> skf.dirtyPages
+    []
+    >>> page.layers[0].style.borders = [SketchBorder()]
+    >>> skf.dirtyPages
+    [<SketchPage name=Untitled>]
+    >>> skf.markClean()
+    >>> page.layers[0].style.borders[0].thickness = 2
+    >>> skf.dirtyPages
+    [<SketchPage name=Untitled>]
+    """
+    dirtyPages = []
+    for page in self.pages.values():
+      if isinstance(page, SketchLayer) and page.isDirty:
+        dirtyPages.append(page)
+    return dirtyPages
+  dirtyPages = property(_get_dirtyPages)
+
+  def markClean(self):
+    """Mark all pages as unchanged, e.g. after saving."""
+    for page in self.pages.values():
+      if isinstance(page, SketchLayer):
+        page.markClean()
+
   def find(self, _class=None, name=None, pattern=None):
-    found = []
-    for pageId, page in self.pages.items():
-      page.find(_class=_class, name=name, pattern=pattern, found=found)
+    """Answers the list of layers in all pages with class _class, the exact
+    name or the name matching pattern, in reading order. Pages that were
+    not read yet (lazy SketchPageProxy) are read, as their layers can match.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> skf = SketchAppReader().read('../../Test/TestRectangles.sketch', lazy=True, extract=False)
+    >>> skf.buildIndex().ids == {} # The index only holds the pages that are read.
+    True
+    >>> [layer.name for layer in skf.find(_class='rectangle')]
+    ['Rectangle2', 'Rectangle1', 'Rectangle1 Copy', 'Rectangle1 Copy 2']
+    """
+    index = self.index
+    found = index.find(_class=_class, name=name, pattern=pattern)
+    if found is None: # Query cannot be answered by the index.
+      found = []
+      for depth, parent, layer in self.walk():
+        SketchBase.find(layer, _class=_class, name=name, pattern=pattern, found=found)
+    elif self.readPages():
+      found = index.find(_class=_class, name=name, pattern=pattern)
     return found
 
+  def walk(self, order=WALK_PRE, prune=None):
+    """Generator of (depth, parent, layer) tuples for all pages (at depth 0,
+    with self as parent) and the layers in them, see walkLayers(). Pages that
+    were not read yet (lazy SketchPageProxy) are read when they are reached.
+
+    >>> from sketchappreader import SketchAppReader
+    >>> skf = SketchAppReader().read('../../Test/TestImage.sketch', lazy=True, extract=False)
+    >>> depth, parent, bitmap = next(item for item in skf.walk() if item[2]._class == 'bitmap')
+    >>> depth, parent, bitmap
+    (2, <SketchArtboard name=Artboard1 w=576 h=783>, <SketchBitmap name=Bitcount_cheese_e>)
+    >>> next(skf.iterLayers('bitmap')) is bitmap
+    True
+    """
+    return walkLayers(self._iterWalkPages(), order, prune)
+
+  def _iterWalkPages(self):
+    for page in list(self.pages.values()):
+      if isinstance(page, SketchPageProxy):
+        page = page.page
+      yield 0, self, page
+
+  def buildIndex(self):
+    """Build the index of all layers in the pages. Pages that were not read
+    yet (lazy SketchPageProxy) are added to the index when they are read."""
+    self._index = index = SketchLayerIndex(page for page in self.pages.values()
+      if not isinstance(page, SketchPageProxy))
+    return index
+
+  def readPages(self):
+    """Read the pages that were not read yet (lazy SketchPageProxy), which
+    adds them to the index. Answers the number of pages that were read."""
+    count = 0
+    for page in list(self.pages.values()):
+      if isinstance(page, SketchPageProxy) and not page.isLoaded:
+        page.page
+        count += 1
+    return count
+
+  def _get_index(self):
+    """Answers the SketchLayerIndex of self, building it on first use.
+
+    >>> skf = SketchFile()
+    >>> skf.pages['P1'] = page = SketchPage(parent=skf, do_objectID='P1')
+    >>> page.append(SketchArtboard(do_objectID='A1', name='Board'))
+    >>> skf.findById('A1')
+    <SketchArtboard name=Board w=100 h=100>
+    >>> page.append(SketchArtboard(do_objectID='A2', name='Board'))
+    >>> skf.find(name='Board')
+    [<SketchArtboard name=Board w=100 h=100>, <SketchArtboard name=Board w=100 h=100>]
+    >>> skf.getParent(skf.findById('A2')) is page
+    True
+    >>> skf.findById('A2').name = 'Other'
+    >>> skf.find(name='Board'), skf.find(name='Other')
+    ([<SketchArtboard name=Board w=100 h=100>], [<SketchArtboard name=Other w=100 h=100>])
+    >>> del page.layers[0]
+    >>> skf.findById('A1'), skf.find(_class='artboard')
+    (None, [<SketchArtboard name=Other w=100 h=100>])
+    """
+    if self._index is None:
+      self.buildIndex()
+    return self._index
+  index = property(_get_index)
+
+  def findById(self, do_objectID):
+    """Answers the layer with this do_objectID. Answers None if it does not
+    exist. Pages that were not read yet are read until the layer is found."""
+    ids = self.index.ids
+    layer = ids.get(do_objectID)
+    if layer is None:
+      for page in list(self.pages.values()):
+        if isinstance(page, SketchPageProxy) and not page.isLoaded:
+          page.page
+          layer = ids.get(do_objectID)
+          if layer is not None:
+            break
+    return layer
+
+  def getParent(self, layer):
+    """Answers the parent layer of layer, or None if it is a page or not indexed."""
+    return self.index.parents.get(layer.do_objectID)
+
   def _get_orderedPages(self):
     """Answer a list of pages in the order of the self.document.pages"""
     orderedPages = []
@@ -2031,6 +5225,108 @@ class SketchFile(SketchBase):
   imagesPath = property(_get_imagesPath) # Read only
 
 
+TEMPLATE_NODES = ('document', 'user', 'meta') # Attributes of SketchFile that a fork copies.
+
+class SketchTemplate:
+  """A SketchFile that is read once, to fork many copy-on-write SketchFile
+  clones from it, e.g. to generate variants of one template document.
+  The pages of a fork are SketchPageProxy instances, that only make their own
+  copy of the template page (from a cached pickle) when they are used. Pages
+  that are not used stay shared with the template. SketchAppWriter writes the
+  pages of a fork that are not loaded from the JSON bytes that are cached in
+  self.entries, instead of encoding them again. The same is done for the
+  document, user and meta of a fork that are equal to the ones of the
+  template. Note that the template itself should not be changed after forking.
+
+  >>> from sketchappreader import SketchAppReader
+  >>> template = SketchTemplate(SketchAppReader().read('../../Test/Re-Cover.sketch', extract=False))
+  >>> skf1, skf2 = template.fork(), template.fork()
+  >>> skf1.template is template, skf1.path == template.sketchFile.path
+  (True, True)
+  >>> page1, page2 = skf1.orderedPages[0], skf2.orderedPages[0]
+  >>> page1.isLoaded, page2.isLoaded
+  (False, False)
+  >>> page1.layers[0].name = 'Changed'
+  >>> page1 = skf1.orderedPages[0]
+  >>> page1.layers[0].name, page2.layers[0].name == template.sketchFile.orderedPages[0].layers[0].name
+  ('Changed', True)
+  >>> page1.isDirty, page2.isDirty, page1.parent is skf1
+  (True, False, True)
+  >>> skf1.document is template.sketchFile.document, skf1.document == template.sketchFile.document
+  (False, True)
+  """
+  def __init__(self, sketchFile):
+    self.sketchFile = sketchFile
+    self.pickles = {} # Pickled pages and documents of the template, by name.
+    self.entries = {} # Encoded JSON entries of the template pages, by key. Used by SketchAppWriter.
+
+  def __repr__(self):
+    return '<%s path=%s>' % (self.__class__.__name__, self.sketchFile.path.split('/')[-1])
+
+  def getPage(self, pageId):
+    """Answers the template page with pageId, reading it if it is a SketchPageProxy."""
+    page = self.sketchFile.pages[pageId]
+    if isinstance(page, SketchPageProxy):
+      page = page.page
+    return page
+
+  def getNode(self, name):
+    """Answers the document, user or meta of the template if name is one of
+    these attribute names. Otherwise answers the template page with id name."""
+    if name in TEMPLATE_NODES:
+      return getattr(self.sketchFile, name)
+    return self.getPage(name)
+
+  def getJson(self, name):
+    """Answers the cached JSON bytes of self.getNode(name).
+
+    >>> template = SketchTemplate(SketchFile())
+    >>> template.sketchFile.meta = SketchMeta(parent=template.sketchFile)
+    >>> template.getJson('meta') is template.getJson('meta')
+    True
+    """
+    data = self.entries.get(name)
+    if data is None:
+      data = self.entries[name] = self.getNode(name).asJsonBytes()
+    return data
+
+  def _copy(self, name, node):
+    """Answers a new copy of node, by the pickle that is cached as name."""
+    data = self.pickles.get(name)
+    if data is None:
+      data = self.pickles[name] = pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
+    return pickle.loads(data)
+
+  def _loadPage(self, skfRef, pageId):
+    """Load function of the SketchPageProxy pages of a fork."""
+    page = self._copy(pageId, self.getPage(pageId))
+    page.parent = skfRef()
+    return page
+
+  def fork(self):
+    """Answers a new SketchFile with the content of the template. The
+    document, user and meta are copied. The pages are SketchPageProxy
+    instances, that copy their template page on first use. The images are
+    shared with the template."""
+    template = self.sketchFile
+    skf = SketchFile(template.path)
+    skf.template = self
+    skf.images = template.images
+    for attrName in TEMPLATE_NODES:
+      node = getattr(template, attrName)
+      if node is not None:
+        node = self._copy(attrName, node)
+        node.parent = skf
+        setattr(skf, attrName, node)
+    skfRef = weakref.ref(skf)
+    for pageId in template.pages:
+      skf.pages[pageId] = SketchPageProxy(skf, pageId, partial(self._loadPage, skfRef, pageId))
+    return skf
+
+# Compiled after SketchLayer is defined, see _encodeFileReference.
+encodeFileReference = compileEncoder(SketchMSJSONFileReference)
+JSON_ENCODERS[SketchMSJSONFileReference] = _encodeFileReference
+
 if __name__ == '__main__':
   import doctest
   import sys